@@ -0,0 +1,284 @@
+"""
+Бенчмарки горячих путей tg_folder_manager и tg_summarise_chat на синтетических данных.
+
+    python -m benchmarks.bench --output bench.json
+    python -m benchmarks.bench --quick --compare bench.json
+
+Результаты пишутся в JSON вместе с коммитом и версией Python, чтобы прогоны
+разных коммитов можно было сравнить через --compare.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+from tg_folder_manager.fake_client import FakeTelegramClient, _WORDS
+from tg_folder_manager.tg_folder_manager import (
+    UNMATCHED_FOLDER,
+    ChatMatcher,
+    CompiledConfig,
+    TelegramFolderManager,
+    UnmatchedChatsStrategy,
+    msgpack
+)
+from tg_summarise_chat.tg_summarise_chat import MessageFormatter
+
+# Замедление сильнее этого порога отмечается в --compare как регрессия
+REGRESSION_THRESHOLD = 1.2
+
+
+class BenchmarkSuite:
+    def __init__(self, repeat: int = 5):
+        self.repeat = repeat
+        self.results: List[Dict] = []
+
+    def _record(self, name: str, params: Dict, samples: List[float], items: int):
+        best = min(samples)
+        self.results.append({
+            'name': name,
+            'params': params,
+            'repeat': len(samples),
+            'min_seconds': best,
+            'median_seconds': statistics.median(samples),
+            'items': items,
+            'items_per_second': items / best if best else None
+        })
+        print(f'{name:<28} {json.dumps(params, ensure_ascii=False):<44} '
+              f'{best * 1000:10.2f} мс  {items / best if best else 0:14,.0f} эл/с')
+
+    def run(self, name: str, params: Dict, fn: Callable[[], None], items: int):
+        samples = []
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - started)
+        self._record(name, params, samples, items)
+
+    async def run_async(self, name: str, params: Dict, fn: Callable, items: int):
+        samples = []
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            await fn()
+            samples.append(time.perf_counter() - started)
+        self._record(name, params, samples, items)
+
+
+def _patterns(folders: int, per_folder: int, rnd: random.Random) -> (Dict[str, List[str]], Dict[str, List[str]]):
+    """Смесь литералов и регулярных выражений, как в типичном config.yaml"""
+    include, exclude = {}, {}
+    for i in range(folders):
+        pats = []
+        for j in range(per_folder):
+            a, b = rnd.sample(_WORDS, 2)
+            pats.append(f'{a}{i}_{j}' if j % 3 else f'({a}|{b}) {i}')
+        pats.append(rnd.choice(_WORDS))
+        include[f'Folder {i}'] = pats
+        exclude[f'Folder {i}'] = [rnd.choice(_WORDS)]
+    return include, exclude
+
+
+def _titles(count: int, rnd: random.Random) -> List[str]:
+    return [' '.join(rnd.sample(_WORDS, 3)) + f' {i}' for i in range(count)]
+
+
+def bench_match_primary(suite: BenchmarkSuite, pattern_counts: List[int], chat_counts: List[int]):
+    rnd = random.Random(0)
+    for patterns in pattern_counts:
+        include, exclude = _patterns(max(1, patterns // 5), 5, rnd)
+        for chats in chat_counts:
+            titles = _titles(chats, rnd)
+            ChatMatcher.match_primary('', include, exclude)  # компиляция не входит в замер
+
+            def run():
+                for t in titles:
+                    ChatMatcher.match_primary(t, include, exclude)
+
+            suite.run('match_primary', {'patterns': patterns, 'chats': chats}, run, chats)
+
+
+async def _manager(tmp: str, chats: int, folders: int, peers_per_folder: int) -> TelegramFolderManager:
+    client = FakeTelegramClient(
+        channels=chats // 2, groups=chats // 4, megagroups=chats - chats // 2 - chats // 4,
+        folders=folders, peers_per_folder=peers_per_folder
+    )
+    # Сессия во временном каталоге: снимок, кэши и реестр шардов настоящей сессии не трогаются
+    manager = TelegramFolderManager(
+        unmatched_strategy=UnmatchedChatsStrategy.MOVE_TO_FOLDER, client=client, session=os.path.join(tmp, 'bench')
+    )
+    await manager.__aenter__()
+    manager.folder_peer_limit = 10 ** 9
+    manager.folder_limit = 0
+    # Справочник мог бы указывать на общий файл из .env (entity_store) — синтетические сущности туда не пишем
+    manager.entity_store_path = None
+    return manager
+
+
+async def bench_planning(suite: BenchmarkSuite, folder_counts: List[int], chats: int):
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        for folders in folder_counts:
+            manager = await _manager(tmp, chats, folders, peers_per_folder=min(200, chats // folders))
+            try:
+                all_chats = await manager.get_chats()
+                await manager._build_map()
+                include, exclude = _patterns(folders, 5, rnd)
+                config = CompiledConfig(
+                    content_hash='', include_patterns=include, exclude_patterns=exclude, settings={},
+                    matcher=ChatMatcher(include, exclude)
+                )
+
+                def run():
+                    targets, unmatched = manager._classify(all_chats, config)
+                    manager._plan_changes(targets, unmatched, unmatched_folder=UNMATCHED_FOLDER)
+
+                suite.run('plan_changes', {'folders': folders, 'chats': chats}, run, chats)
+            finally:
+                await manager.__aexit__(None, None, None)
+
+
+async def bench_export(suite: BenchmarkSuite, chat_counts: List[int], folders: int):
+    formats = ['yaml', 'jsonl'] + (['msgpack'] if msgpack is not None else [])
+    with tempfile.TemporaryDirectory() as tmp:
+        for chats in chat_counts:
+            manager = await _manager(tmp, chats, folders, peers_per_folder=chats // folders)
+            try:
+                await manager.get_chats()
+                await manager._build_map()
+                for fmt in formats:
+                    filename = os.path.join(tmp, f'export.{fmt}')
+                    if fmt == 'yaml':
+                        run = lambda: manager.export_folders_to_yaml(filename)
+                    else:
+                        run = lambda: manager.export_folders(filename, fmt=fmt)
+                    await suite.run_async('export_folders', {'format': fmt, 'chats': chats}, run, chats)
+            finally:
+                await manager.__aexit__(None, None, None)
+
+
+class _SenderClient:
+    """Отдаёт пользователей по id, как client.get_entity"""
+
+    def __init__(self, senders: int):
+        self.users = {
+            i: SimpleNamespace(id=i, username=f'user{i}' if i % 2 else None, first_name=f'Имя {i}',
+                               last_name='Фамилия' if i % 3 else None)
+            for i in range(1, senders + 1)
+        }
+
+    async def get_entity(self, sender_id: int):
+        return self.users[sender_id]
+
+
+def _messages(count: int, senders: int, rnd: random.Random) -> List[SimpleNamespace]:
+    start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return [
+        SimpleNamespace(
+            sender_id=rnd.randint(1, senders) if i % 50 else None,
+            date=start + timedelta(seconds=i * 5),
+            text=' '.join(rnd.choices(_WORDS, k=rnd.randint(3, 30))) if i % 10 else None
+        )
+        for i in range(count)
+    ]
+
+
+async def bench_formatter(suite: BenchmarkSuite, message_counts: List[int], senders: int):
+    rnd = random.Random(2)
+    client = _SenderClient(senders)
+    for count in message_counts:
+        messages = _messages(count, senders, rnd)
+
+        async def format_cold():
+            await MessageFormatter(client).format_for_llm(messages)
+
+        await suite.run_async('format_for_llm', {'messages': count, 'senders': senders}, format_cold, count)
+
+        formatter = MessageFormatter(client)
+        suite.run('get_statistics', {'messages': count}, lambda: formatter.get_statistics(messages), count)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict], baseline_path: str) -> int:
+    """Печатает изменение min_seconds относительно baseline и возвращает число регрессий"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    old = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in baseline['results']}
+    regressions = 0
+    print(f'\nСравнение с {baseline_path} (коммит {baseline.get("commit")}):')
+    for r in results:
+        b = old.get((r['name'], json.dumps(r['params'], sort_keys=True)))
+        if not b:
+            continue
+        ratio = r['min_seconds'] / b['min_seconds'] if b['min_seconds'] else 0
+        mark = ''
+        if ratio > REGRESSION_THRESHOLD:
+            mark = '  ⚠ регрессия'
+            regressions += 1
+        print(f'  {r["name"]:<28} {json.dumps(r["params"], ensure_ascii=False):<44} x{ratio:.2f}{mark}')
+    return regressions
+
+
+async def run_suite(quick: bool, repeat: int) -> List[Dict]:
+    suite = BenchmarkSuite(repeat=repeat)
+    if quick:
+        bench_match_primary(suite, pattern_counts=[10, 100], chat_counts=[1_000])
+        await bench_planning(suite, folder_counts=[5, 20], chats=2_000)
+        await bench_export(suite, chat_counts=[2_000], folders=10)
+        await bench_formatter(suite, message_counts=[1_000], senders=50)
+    else:
+        bench_match_primary(suite, pattern_counts=[10, 100, 500], chat_counts=[1_000, 10_000])
+        await bench_planning(suite, folder_counts=[5, 20, 100], chats=20_000)
+        await bench_export(suite, chat_counts=[10_000, 50_000], folders=20)
+        await bench_formatter(suite, message_counts=[1_000, 10_000], senders=200)
+    return suite.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки tg_folder_manager и tg_summarise_chat')
+    parser.add_argument('--output', default='bench.json', help='Куда записать результаты (по умолчанию: bench.json)')
+    parser.add_argument('--compare', help='JSON с результатами предыдущего прогона для сравнения')
+    parser.add_argument('--quick', action='store_true', help='Уменьшенные размеры данных для быстрой проверки')
+    parser.add_argument('--repeat', type=int, default=5, help='Повторов каждого замера (по умолчанию: 5)')
+    args = parser.parse_args()
+
+    # Логи менеджера и форматера только мешают замерам
+    logging.disable(logging.WARNING)
+
+    results = asyncio.run(run_suite(args.quick, args.repeat))
+    report = {
+        'commit': _git_commit(),
+        'date': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'results': results
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'\nРезультаты записаны в {args.output}')
+
+    if args.compare and compare(results, args.compare):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+from telethon.tl.types import DialogFilter, DialogFilterChatlist, TextWithEntities
+
+from tg_folder_manager.fake_client import FakeTelegramClient
+from tg_folder_manager.tg_folder_manager import FOLDER_ID_MAX, FOLDER_ID_MIN, TelegramFolderManager, _free_folder_id
+
+
+CONFIG = '''settings:
+  write_rate: 1000
+  write_burst: 100
+  folder_limit: {limit}
+  export_enabled: false
+folders:
+  A:
+    include_patterns: ['1001$']
+  B:
+    include_patterns: ['1002$']
+'''
+
+
+class FreeFolderIdTestCase(unittest.TestCase):
+    def test_lowest_free_id_in_range(self):
+        self.assertEqual(_free_folder_id([]), FOLDER_ID_MIN)
+        self.assertEqual(_free_folder_id([0, 1]), FOLDER_ID_MIN)
+        self.assertEqual(_free_folder_id([2, 3, 5]), 4)
+
+    def test_none_when_all_taken(self):
+        self.assertIsNone(_free_folder_id(range(FOLDER_ID_MIN, FOLDER_ID_MAX + 1)))
+        self.assertEqual(_free_folder_id(range(FOLDER_ID_MIN, FOLDER_ID_MAX)), FOLDER_ID_MAX)
+
+
+class SharedFolderTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.client = FakeTelegramClient(channels=10, groups=0, megagroups=0, folders=0)
+        # Общая папка занимает id 2: менеджер не должен её перезаписать
+        self.client.filters[2] = DialogFilterChatlist(
+            id=2, title=TextWithEntities(text='Shared', entities=[]), pinned_peers=[], include_peers=[]
+        )
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    async def _run(self, limit: int):
+        config = os.path.join(self._tmp.name, 'config.yaml')
+        with open(config, 'w', encoding='utf-8') as f:
+            f.write(CONFIG.format(limit=limit))
+        manager = TelegramFolderManager(client=self.client, session=os.path.join(self._tmp.name, 'test'))
+        async with manager:
+            manager.entity_store_path = None
+            await manager.organize_chats_by_config(config)
+        return {fid: (type(f), f.title.text) for fid, f in self.client.filters.items()}
+
+    async def test_shared_folder_id_is_skipped(self):
+        folders = await self._run(limit=0)
+        self.assertIs(folders[2][0], DialogFilterChatlist)
+        self.assertEqual(folders[3], (DialogFilter, 'A'))
+        self.assertEqual(folders[4], (DialogFilter, 'B'))
+
+    async def test_shared_folder_counts_towards_limit(self):
+        folders = await self._run(limit=2)
+        self.assertEqual(sorted(title for _, title in folders.values()), ['A', 'Shared'])
+
+
+if __name__ == '__main__':
+    unittest.main()
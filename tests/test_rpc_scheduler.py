@@ -0,0 +1,38 @@
+import unittest
+
+from telethon.tl.functions.messages import UpdateDialogFilterRequest
+from telethon.tl.types import DialogFilter, TextWithEntities
+
+from tg_folder_manager.fake_client import FakeTelegramClient
+from tg_folder_manager.tg_folder_manager import RpcScheduler
+
+
+def _update(client: FakeTelegramClient, folder_id: int) -> UpdateDialogFilterRequest:
+    peer = client._input_peer(client.dialogs[folder_id].entity)
+    return UpdateDialogFilterRequest(id=folder_id, filter=DialogFilter(
+        id=folder_id, title=TextWithEntities(text=f'Folder {folder_id}', entities=[]),
+        pinned_peers=[], include_peers=[peer], exclude_peers=[]
+    ))
+
+
+class RpcSchedulerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_short_flood_wait_pauses_queue(self):
+        # FLOOD_WAIT короче порога клиента Telethon проспал бы сам — очередь должна увидеть его
+        client = FakeTelegramClient(
+            channels=10, groups=0, megagroups=0, folders=0,
+            flood_limit=1, flood_window=0.5, flood_wait_seconds=1
+        )
+        scheduler = RpcScheduler(client, rate=100, burst=10)
+        try:
+            results = [await scheduler.submit(fid, _update(client, fid)) for fid in (2, 3)]
+        finally:
+            await scheduler.close()
+
+        self.assertEqual(results, [True, True])
+        self.assertEqual(client.flood_waits, 1)
+        self.assertEqual(scheduler.flood_wait_seconds, 1)
+        self.assertEqual(set(client.filters), {2, 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
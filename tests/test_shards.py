@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+from typing import Dict, Set
+
+from tg_folder_manager.fake_client import FakeTelegramClient
+from tg_folder_manager.tg_folder_manager import PeerFolderIndex, TelegramFolderManager
+
+
+CONFIG = '''settings:
+  write_rate: 1000
+  write_burst: 100
+  folder_peer_limit: 40
+  export_enabled: false
+folders:
+  News:
+    include_patterns: [a, e]
+    exclude_patterns: [{exclude}]
+'''
+
+
+class ShardPlacementTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.session = os.path.join(self._tmp.name, 'test')
+        self.config = os.path.join(self._tmp.name, 'config.yaml')
+        self.client = FakeTelegramClient(channels=300, groups=0, megagroups=0, folders=0)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    async def _run(self, exclude: str = 'zzzqqq') -> Dict[str, Set[int]]:
+        with open(self.config, 'w', encoding='utf-8') as f:
+            f.write(CONFIG.format(exclude=exclude))
+        manager = TelegramFolderManager(client=self.client, session=self.session)
+        async with manager:
+            manager.entity_store_path = None
+            await manager.organize_chats_by_config(self.config)
+        return {
+            f.title.text: {PeerFolderIndex.peer_id(p) for p in f.include_peers}
+            for f in self.client.filters.values()
+        }
+
+    async def test_repeat_run_keeps_shards(self):
+        first = await self._run()
+        self.assertGreater(len(first), 2)
+        self.assertTrue(all(len(peers) <= 40 for peers in first.values()))
+
+        self.client.rpc_counts.clear()
+        self.assertEqual(await self._run(), first)
+        self.assertEqual(self.client.rpc_counts['UpdateDialogFilterRequest'], 0)
+
+    async def test_removed_chat_does_not_shift_others(self):
+        first = await self._run()
+        gone = min(first['News'])
+        second = await self._run(exclude=f'{gone}$')
+
+        self.assertEqual(second['News'], first['News'] - {gone})
+        for title, peers in first.items():
+            if title != 'News':
+                self.assertEqual(second[title], peers, title)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+from tg_summarise_chat.tg_summarise_chat import _pack, split_transcript
+
+
+def _transcript(count: int, words: int = 5) -> str:
+    return '\n'.join(
+        f'[12:{i // 60:02d}:{i % 60:02d}] user{i}: ' + ' '.join(f'слово{j}' for j in range(words))
+        for i in range(count)
+    )
+
+
+class PackTestCase(unittest.TestCase):
+    def test_groups_in_order_within_limit(self):
+        groups = _pack(['aaa', 'bb', 'c', 'dddd'], 6, '-')
+        self.assertEqual(groups, ['aaa-bb', 'c-dddd'])
+
+    def test_oversized_part_is_its_own_group(self):
+        self.assertEqual(_pack(['a', 'toolong', 'b'], 3, '\n'), ['a', 'toolong', 'b'])
+
+    def test_everything_fits(self):
+        self.assertEqual(_pack(['a', 'b', 'c'], 100, '\n\n'), ['a\n\nb\n\nc'])
+
+
+class SplitTranscriptTestCase(unittest.TestCase):
+    def test_splits_on_message_boundaries(self):
+        text = _transcript(200)
+        chunks = split_transcript(text, max_tokens=100, chars_per_token=3.0)
+
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(c) <= 300 for c in chunks))
+        self.assertTrue(all(c.startswith('[12:') for c in chunks))
+        self.assertEqual('\n'.join(chunks), text)
+
+    def test_short_transcript_is_one_chunk(self):
+        text = _transcript(3)
+        self.assertEqual(split_transcript(text, max_tokens=1000), [text])
+
+    def test_long_message_is_split_by_words(self):
+        text = _transcript(1, words=200)
+        chunks = split_transcript(text, max_tokens=50, chars_per_token=2.0)
+
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(c) <= 100 for c in chunks))
+        self.assertEqual(' '.join(chunks).split(), text.split())
+
+
+if __name__ == '__main__':
+    unittest.main()
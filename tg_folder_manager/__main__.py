@@ -1,22 +1,103 @@
+import argparse
 import logging
 import asyncio
 import os
 from .tg_folder_manager import TelegramFolderManager, UnmatchedChatsStrategy
+from .runner import MultiAccountRunner, load_profiles
 
-async def main():
+async def main(
+        watch: bool = False,
+        debounce: float = 5.0,
+        all_accounts: bool = False,
+        processes: int = 1,
+        command: str = None,
+        plan_path: str = 'folders_plan.json',
+        full_resync: bool = False
+):
     # Автоматически находим config.yaml в корне проекта
     project_root = os.path.dirname(os.path.dirname(__file__))
     config_path = os.path.join(project_root, 'config.yaml')
 
+    if command == 'plan':
+        # Без подключения: всё берётся из снимка, сделанного командой sync
+        manager = TelegramFolderManager(
+            unmatched_strategy=UnmatchedChatsStrategy.MOVE_TO_FOLDER,
+            warn_on_duplicates=True
+        )
+        manager.plan_offline(config_path=config_path, plan_path=plan_path)
+        return
+
+    if all_accounts:
+        runner = MultiAccountRunner(
+            load_profiles(config_path),
+            config_path=config_path,
+            unmatched_strategy=UnmatchedChatsStrategy.MOVE_TO_FOLDER,
+            warn_on_duplicates=True,
+            processes=processes
+        )
+        await runner.run()
+        return
+
     async with TelegramFolderManager(
         unmatched_strategy=UnmatchedChatsStrategy.MOVE_TO_FOLDER,
         warn_on_duplicates=True
     ) as manager:
-        await manager.organize_chats_by_config(config_path=config_path)
+        if command == 'sync':
+            await manager.sync_snapshot(full_resync=full_resync)
+        elif command == 'apply':
+            await manager.apply_plan_file(plan_path=plan_path, config_path=config_path)
+        elif watch:
+            await manager.watch(config_path=config_path, debounce_seconds=debounce)
+        else:
+            await manager.organize_chats_by_config(config_path=config_path)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Сортировка чатов Telegram по папкам согласно config.yaml')
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Не завершаться после сортировки, а следить за изменениями чатов и config.yaml'
+    )
+    parser.add_argument(
+        '--debounce',
+        type=float,
+        default=5.0,
+        help='Сколько секунд копить события перед записью в режиме --watch (по умолчанию: 5)'
+    )
+    parser.add_argument(
+        '--all-accounts',
+        action='store_true',
+        help='Обработать все аккаунты из секции accounts в config.yaml параллельно'
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='На сколько процессов разложить аккаунты в режиме --all-accounts (по умолчанию: 1)'
+    )
+    commands = parser.add_subparsers(dest='command', metavar='{sync,plan,apply}')
+    sync_parser = commands.add_parser('sync', help='Скачать диалоги и папки в локальный снимок')
+    sync_parser.add_argument('--full', action='store_true', help='Перекачать все диалоги, а не только изменившиеся')
+    plan_parser = commands.add_parser('plan', help='Построить план по снимку без подключения к Telegram')
+    plan_parser.add_argument(
+        '--output',
+        default='folders_plan.json',
+        help='Куда записать план (по умолчанию: folders_plan.json)'
+    )
+    apply_parser = commands.add_parser('apply', help='Применить ранее построенный план')
+    apply_parser.add_argument('plan', nargs='?', default='folders_plan.json', help='Файл плана (по умолчанию: folders_plan.json)')
+    args = parser.parse_args()
+
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s'
     )
-    asyncio.run(main())
+    asyncio.run(main(
+        watch=args.watch,
+        debounce=args.debounce,
+        all_accounts=args.all_accounts,
+        processes=args.processes,
+        command=args.command,
+        plan_path=getattr(args, 'output', None) or getattr(args, 'plan', None) or 'folders_plan.json',
+        full_resync=getattr(args, 'full', False)
+    ))
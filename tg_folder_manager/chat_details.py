@@ -0,0 +1,48 @@
+import sqlite3
+import time
+from typing import Dict, Iterable, Tuple
+
+from .session_files import session_side_file
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS participants (
+    chat_id INTEGER PRIMARY KEY,
+    count INTEGER,
+    fetched_at REAL NOT NULL
+);
+'''
+
+
+class ChatDetailsCache:
+    """
+    Число участников каналов и супергрупп, полученное через GetFullChannel, в SQLite рядом
+    с файлом сессии. Запись считается свежей ttl секунд — после этого чат запрашивается заново.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(SCHEMA)
+
+    @classmethod
+    def for_session(cls, session: str) -> 'ChatDetailsCache':
+        return cls(session_side_file(session, 'details'))
+
+    def load(self, ttl: float) -> Dict[int, int]:
+        rows = self._conn.execute(
+            'SELECT chat_id, count FROM participants WHERE fetched_at >= ?', (time.time() - ttl,)
+        )
+        return {row[0]: row[1] for row in rows}
+
+    def store(self, rows: Iterable[Tuple[int, int]]):
+        """rows — пары (id чата, число участников)"""
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO participants (chat_id, count, fetched_at) VALUES (?, ?, ?)',
+                ((cid, count, now) for cid, count in rows)
+            )
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,70 @@
+import hashlib
+import sqlite3
+from typing import Dict, Iterable, Optional, Tuple
+
+from .session_files import session_side_file
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS assignments (
+    chat_id INTEGER PRIMARY KEY,
+    title_hash INTEGER NOT NULL,
+    folder TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+def title_hash(title: str) -> int:
+    """64-битный хеш названия в том виде, в котором его сравнивает ChatMatcher (нижний регистр)"""
+    return int.from_bytes(hashlib.blake2b(title.lower().encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+class ClassificationCache:
+    """
+    Результаты сопоставления чатов с папками между запусками, в SQLite рядом с файлом сессии.
+    Запись (id чата, хеш названия) → папка (или NULL, если чат не подошёл ни к одной) действительна,
+    пока не изменились правила папок: при другом хеше паттернов кэш очищается целиком.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(SCHEMA)
+
+    @classmethod
+    def for_session(cls, session: str) -> 'ClassificationCache':
+        return cls(session_side_file(session, 'classify'))
+
+    def bind(self, patterns_hash: str) -> bool:
+        """Привязывает кэш к правилам; возвращает True, если правила изменились и кэш сброшен"""
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'patterns_hash'").fetchone()
+        if row and row[0] == patterns_hash:
+            return False
+        with self._conn:
+            self._conn.execute('DELETE FROM assignments')
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('patterns_hash', ?)", (patterns_hash,)
+            )
+        return row is not None
+
+    def load(self) -> Dict[int, Tuple[int, Optional[str]]]:
+        rows = self._conn.execute('SELECT chat_id, title_hash, folder FROM assignments')
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def store(self, rows: Iterable[Tuple[int, int, Optional[str]]]):
+        """rows — тройки (id чата, хеш названия, папка)"""
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO assignments (chat_id, title_hash, folder) VALUES (?, ?, ?)', rows
+            )
+
+    def forget(self, chat_ids: Iterable[int]):
+        with self._conn:
+            self._conn.executemany('DELETE FROM assignments WHERE chat_id = ?', ((cid,) for cid in chat_ids))
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,217 @@
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Union
+
+from telethon.tl.types import (
+    Channel,
+    ChannelForbidden,
+    Chat,
+    ChatForbidden,
+    InputPeerChannel,
+    InputPeerChat,
+    InputPeerUser,
+    User
+)
+
+from .session_files import session_side_file
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entities (
+    peer_id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    access_hash INTEGER,
+    username TEXT,
+    title TEXT,
+    updated_at REAL NOT NULL,
+    -- Название в нижнем регистре: NOCASE в SQLite не понимает кириллицу
+    title_key TEXT
+);
+CREATE INDEX IF NOT EXISTS entities_username ON entities (lower(username));
+CREATE INDEX IF NOT EXISTS entities_title ON entities (title_key);
+'''
+
+_COLUMNS = 'peer_id, kind, id, access_hash, username, title, updated_at'
+
+# Сколько сущностей копится в памяти перед записью в SQLite
+FLUSH_SIZE = 1000
+
+# Сессия tg_folder_manager по умолчанию: от неё строится общий для обоих инструментов путь справочника
+DEFAULT_SESSION = 'telegram_session'
+_DISABLED = ('', '0', 'false', 'no', 'off')
+
+
+def entity_store_path(setting: Union[bool, str, None] = None, session: Optional[str] = None) -> Optional[str]:
+    """
+    Путь к справочнику сущностей — одинаковый для tg_folder_manager и tg_summarise_chat.
+    setting — значение entity_store из config.yaml; если его нет, берётся переменная entity_store из .env.
+    Без значения или true — <сессия>.entities.sqlite, где сессия по умолчанию — app_title из .env;
+    строка — свой путь ({session} заменяется на имя сессии); false — справочник не ведётся.
+    """
+    if setting is None:
+        setting = os.getenv('entity_store')
+    if isinstance(setting, str) and setting.strip().lower() in ('1', 'true', 'yes', 'on'):
+        setting = True
+    if setting is False or isinstance(setting, str) and setting.strip().lower() in _DISABLED:
+        return None
+    session = session or os.getenv('app_title') or DEFAULT_SESSION
+    if setting is None or setting is True:
+        return session_side_file(session, 'entities')
+    return setting.format(session=session)
+
+
+def peer_id(kind: str, id: int) -> int:
+    """Id с меткой типа, как у Telethon (utils.get_peer_id): -100… у каналов, -… у групп"""
+    if kind == 'channel':
+        return -(1000000000000 + id)
+    if kind == 'chat':
+        return -id
+    return id
+
+
+@dataclass
+class StoredEntity:
+    peer_id: int
+    kind: str  # user | chat | channel
+    id: int
+    access_hash: Optional[int]
+    username: Optional[str]
+    title: Optional[str]
+    updated_at: float
+
+    @property
+    def input_peer(self):
+        if self.kind == 'channel':
+            return InputPeerChannel(self.id, self.access_hash)
+        if self.kind == 'chat':
+            return InputPeerChat(self.id)
+        return InputPeerUser(self.id, self.access_hash)
+
+    @property
+    def name(self) -> str:
+        return self.title or (f'@{self.username}' if self.username else str(self.peer_id))
+
+
+def _stored(e) -> Optional[StoredEntity]:
+    """Сущность Telethon → запись; min-сущности пропускаются: их access_hash непригоден для запросов"""
+    if getattr(e, 'min', False):
+        return None
+    if isinstance(e, (Channel, ChannelForbidden)):
+        kind, title = 'channel', e.title
+    elif isinstance(e, (Chat, ChatForbidden)):
+        kind, title = 'chat', e.title
+    elif isinstance(e, User):
+        kind = 'user'
+        title = ' '.join(p for p in (e.first_name, e.last_name) if p) or None
+    else:
+        return None
+    if kind != 'chat' and getattr(e, 'access_hash', None) is None:
+        return None
+    username = getattr(e, 'username', None)
+    return StoredEntity(
+        peer_id=peer_id(kind, e.id), kind=kind, id=e.id, access_hash=getattr(e, 'access_hash', None),
+        username=username or None, title=title, updated_at=time.time()
+    )
+
+
+class EntityStore:
+    """
+    Общий для tg_folder_manager и tg_summarise_chat справочник сущностей Telegram в SQLite:
+    id, access_hash, username и название пользователей, групп и каналов. По нему InputPeer
+    строится и чат находится по @username, названию или id без resolve-запросов к серверу.
+    access_hash привязан к аккаунту — один файл можно делить только между сессиями одного аккаунта.
+
+    Записи обновляются всякий раз, когда сущность приходит от сервера; username, перешедший
+    к другому чату, у прежнего владельца стирается. Записи, на которые сервер ответил ошибкой
+    доступа, и чаты, из которых аккаунт вышел, удаляются через forget().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(SCHEMA)
+        self._pending: List[StoredEntity] = []
+
+    @staticmethod
+    def path_for(session: str) -> str:
+        return session_side_file(session, 'entities')
+
+    @classmethod
+    def for_session(cls, session: str) -> 'EntityStore':
+        return cls(cls.path_for(session))
+
+    def add(self, entity):
+        """Откладывает сущность Telethon для записи; пишется пачками по FLUSH_SIZE"""
+        record = _stored(entity)
+        if record is not None:
+            self._pending.append(record)
+            if len(self._pending) >= FLUSH_SIZE:
+                self.flush()
+
+    def remember(self, entities: Iterable):
+        for e in entities:
+            self.add(e)
+        self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        records, self._pending = self._pending, []
+        with self._conn:
+            self._conn.executemany(
+                'UPDATE entities SET username = NULL WHERE lower(username) = ? AND peer_id != ?',
+                ((r.username.lower(), r.peer_id) for r in records if r.username)
+            )
+            self._conn.executemany(
+                f'INSERT OR REPLACE INTO entities ({_COLUMNS}, title_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    (r.peer_id, r.kind, r.id, r.access_hash, r.username, r.title, r.updated_at,
+                     r.title.lower() if r.title else None)
+                    for r in records
+                )
+            )
+
+    def get(self, pid: int) -> Optional[StoredEntity]:
+        """Запись по id с меткой типа (как --chat-id: -100… для каналов)"""
+        self.flush()
+        return self._one('peer_id = ?', pid)
+
+    def find(self, name: str) -> Optional[StoredEntity]:
+        """
+        Запись по @username, ссылке t.me/username или точному названию (без учёта регистра).
+        Из одноимённых чатов берётся обновлённый последним.
+        """
+        self.flush()
+        name = name.strip()
+        for prefix in ('https://', 'http://'):
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+        if name.startswith(('t.me/', 'telegram.me/')):
+            name = '@' + name.split('/', 1)[1].strip('/')
+        if name.startswith('@'):
+            return self._one('lower(username) = ?', name[1:].lower())
+        # Как и у Telethon, строка без @ может оказаться и username
+        return self._one('title_key = ?', name.lower()) or self._one('lower(username) = ?', name.lower())
+
+    def _one(self, where: str, value) -> Optional[StoredEntity]:
+        row = self._conn.execute(
+            f'SELECT {_COLUMNS} FROM entities WHERE {where} ORDER BY updated_at DESC LIMIT 1', (value,)
+        ).fetchone()
+        return StoredEntity(*row) if row else None
+
+    def lookup(self, identifier: Union[str, int]) -> Optional[StoredEntity]:
+        if isinstance(identifier, int):
+            return self.get(identifier)
+        return self.find(identifier)
+
+    def forget(self, peer_ids: Iterable[int]):
+        self.flush()
+        with self._conn:
+            self._conn.executemany('DELETE FROM entities WHERE peer_id = ?', ((pid,) for pid in peer_ids))
+
+    def close(self):
+        self.flush()
+        self._conn.close()
@@ -0,0 +1,294 @@
+"""
+Детерминированный in-memory бэкенд Telegram для профилирования и бенчмарков.
+
+Реализует ту часть интерфейса TelegramClient, которой пользуется TelegramFolderManager:
+get_dialogs / iter_dialogs, GetDialogFiltersRequest, UpdateDialogFilterRequest, GetFullChannelRequest,
+get_me / get_entity, контейнеры из нескольких запросов и подписку на события. Умеет имитировать задержку сети и
+FLOOD_WAIT и считает RPC, которые отправил бы реальный клиент.
+
+    client = FakeTelegramClient(channels=60_000, groups=20_000, megagroups=20_000, folders=10)
+    async with TelegramFolderManager(client=client, session='fake') as manager:
+        await manager.organize_chats_by_config('config.yaml')
+    print(client.rpc_counts)
+"""
+
+import asyncio
+import random
+from collections import Counter, deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.channels import GetChannelsRequest, GetFullChannelRequest
+from telethon.tl.functions.messages import (
+    GetChatsRequest,
+    GetDialogFiltersRequest,
+    GetDialogsRequest,
+    UpdateDialogFilterRequest
+)
+from telethon.tl.functions.users import GetUsersRequest
+from telethon.tl.types import (
+    Channel,
+    Chat,
+    ChatPhotoEmpty,
+    DialogFilter,
+    InputChannel,
+    InputPeerChannel,
+    InputPeerChat,
+    InputPeerEmpty,
+    InputUserSelf,
+    PeerChannel,
+    TextWithEntities
+)
+from telethon.tl.types.messages import DialogFilters
+
+# Telegram отдаёт диалоги страницами по 100
+DIALOGS_PAGE_SIZE = 100
+
+_WORDS = [
+    'work', 'проект', 'python', 'django', 'bitcoin', 'ethereum', 'крипто', 'news', 'новости',
+    'dev', 'team', 'чат', 'группа', 'канал', 'music', 'travel', 'спорт', 'books', 'demo', 'test',
+    'архив', 'family', 'school', 'crypto', 'trading', 'jobs', 'вакансии', 'memes', 'design', 'ai'
+]
+
+
+@dataclass
+class FakeDialog:
+    entity: object
+    dialog: SimpleNamespace
+    date: Optional[datetime] = None
+    pinned: bool = False
+    archived: bool = False
+
+
+def _title_slug(title: str) -> str:
+    return ''.join(ch for ch in title.split()[0] if ch.isascii() and ch.isalnum()) or 'chat'
+
+
+class FakeTelegramClient:
+    def __init__(
+            self,
+            channels: int = 1000,
+            groups: int = 500,
+            megagroups: int = 500,
+            users: int = 0,
+            archived: int = 0,
+            folders: int = 5,
+            peers_per_folder: int = 50,
+            seed: int = 0,
+            latency: float = 0.0,
+            flood_limit: Optional[int] = None,
+            flood_window: float = 60.0,
+            flood_wait_seconds: int = 1,
+            flood_sleep_threshold: int = 60
+    ):
+        """
+        Args:
+            channels / groups / megagroups / users: сколько диалогов каждого типа сгенерировать
+            archived: сколько из них (случайных) лежит в архиве
+            folders: сколько папок уже существует на «сервере»
+            peers_per_folder: сколько случайных чатов лежит в каждой из них
+            seed: зерно генератора, одинаковое зерно даёт одинаковый аккаунт
+            latency: задержка каждого RPC в секундах
+            flood_limit: сколько записей папок разрешено за flood_window секунд,
+                после чего сервер отвечает FLOOD_WAIT на flood_wait_seconds
+            flood_sleep_threshold: как у TelegramClient — FLOOD_WAIT не длиннее порога
+                клиент пережидает сам и повторяет запрос, не поднимая FloodWaitError
+        """
+        rnd = random.Random(seed)
+        self.latency = latency
+        self.flood_limit = flood_limit
+        self.flood_window = flood_window
+        self.flood_wait_seconds = flood_wait_seconds
+        self.flood_sleep_threshold = flood_sleep_threshold
+        self.rpc_counts: Counter = Counter()
+        self.flood_waits = 0
+        self._writes: deque = deque()
+        self._handlers: List[tuple] = []
+        self._connected = False
+
+        now = datetime.now(timezone.utc)
+        self.entities: Dict[int, object] = {}
+        # Число участников каналов и супергрупп — в списке диалогов его нет, только в GetFullChannel
+        self.participants: Dict[int, int] = {}
+        self.dialogs: List[FakeDialog] = []
+        next_id = 1000
+        kinds = ['channel'] * channels + ['group'] * groups + ['megagroup'] * megagroups + ['user'] * users
+        rnd.shuffle(kinds)
+        for top_message, kind in enumerate(reversed(kinds), start=1):
+            next_id += 1
+            title = ' '.join(rnd.sample(_WORDS, 2)) + f' {next_id}'
+            if kind == 'group':
+                e = Chat(id=next_id, title=title, photo=ChatPhotoEmpty(), participants_count=rnd.randint(2, 200),
+                         date=now, version=1)
+            elif kind == 'user':
+                e = SimpleNamespace(id=next_id, first_name=title, username=None)
+            else:
+                e = Channel(id=next_id, title=title, photo=ChatPhotoEmpty(), date=now,
+                            access_hash=rnd.getrandbits(63), megagroup=kind == 'megagroup',
+                            broadcast=kind == 'channel')
+            self.entities[next_id] = e
+            self.dialogs.append(FakeDialog(e, SimpleNamespace(top_message=top_message)))
+        # Имена, размеры и даты — отдельным генератором, чтобы не менять остальной аккаунт при том же seed
+        extra = random.Random(seed + 2)
+        for d in self.dialogs:
+            e = d.entity
+            d.date = now - timedelta(minutes=len(self.dialogs) - d.dialog.top_message) * extra.choice([1, 60])
+            if isinstance(e, Channel):
+                self.participants[e.id] = int(extra.paretovariate(1.2) * 10)
+                if extra.random() < 0.3:
+                    e.username = f'{_title_slug(e.title)}_{e.id}'
+
+        # Самые свежие диалоги — первыми, как у Telegram
+        self.dialogs.reverse()
+        # Отдельный генератор, чтобы архив не менял остальной аккаунт при том же seed
+        for d in random.Random(seed + 1).sample(self.dialogs, min(archived, len(self.dialogs))):
+            d.archived = True
+        self._folders = {
+            0: [d for d in self.dialogs if not d.archived],
+            1: [d for d in self.dialogs if d.archived]
+        }
+
+        chats = [e for e in self.entities.values() if isinstance(e, (Channel, Chat))]
+        self.filters: Dict[int, DialogFilter] = {}
+        for fid in range(2, 2 + folders):
+            peers = rnd.sample(chats, min(peers_per_folder, len(chats)))
+            self.filters[fid] = DialogFilter(
+                id=fid, title=TextWithEntities(text=f'Folder {fid}', entities=[]),
+                pinned_peers=[], include_peers=[self._input_peer(e) for e in peers],
+                exclude_peers=[]
+            )
+
+    @staticmethod
+    def _input_peer(e):
+        return InputPeerChannel(e.id, e.access_hash) if isinstance(e, Channel) else InputPeerChat(e.id)
+
+    @property
+    def rpc_total(self) -> int:
+        return sum(self.rpc_counts.values())
+
+    async def start(self):
+        self._connected = True
+        return self
+
+    async def disconnect(self):
+        self._connected = False
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    async def get_me(self):
+        return (await self(GetUsersRequest([InputUserSelf()])))[0]
+
+    async def get_entity(self, peer):
+        if isinstance(peer, (PeerChannel, InputPeerChannel)):
+            request = GetChannelsRequest([InputChannel(peer.channel_id, getattr(peer, 'access_hash', 0))])
+        else:
+            request = GetChatsRequest([getattr(peer, 'chat_id', peer)])
+        result = await self(request)
+        if not result.chats:
+            raise ValueError(f'Could not find the input entity for {peer!r}')
+        return result.chats[0]
+
+    def _folder_dialogs(self, folder_id: Optional[int]) -> List[FakeDialog]:
+        # Как у Telegram: папка 1 — архив, 0 — всё остальное, None — оба списка
+        return self.dialogs if folder_id is None else self._folders.get(folder_id, [])
+
+    async def iter_dialogs(
+            self, limit: Optional[int] = None, folder: Optional[int] = None, archived: Optional[bool] = None
+    ):
+        if archived is not None:
+            folder = 1 if archived else 0
+        count = len(self._folder_dialogs(folder))
+        total = count if limit is None else min(limit, count)
+        for offset in range(0, total, DIALOGS_PAGE_SIZE):
+            # offset_id здесь — позиция в списке диалогов, а не id сообщения
+            page = await self(GetDialogsRequest(
+                offset_date=None, offset_id=offset, offset_peer=InputPeerEmpty(),
+                limit=min(DIALOGS_PAGE_SIZE, total - offset), hash=0, folder_id=folder
+            ))
+            for d in page:
+                yield d
+
+    async def get_dialogs(
+            self, limit: Optional[int] = None, folder: Optional[int] = None, archived: Optional[bool] = None
+    ) -> List[FakeDialog]:
+        return [d async for d in self.iter_dialogs(limit=limit, folder=folder, archived=archived)]
+
+    def add_event_handler(self, callback, event=None):
+        self._handlers.append((callback, event))
+
+    def remove_event_handler(self, callback, event=None):
+        self._handlers = [(cb, ev) for cb, ev in self._handlers if cb is not callback]
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        return await self._call(None, request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold)
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        # Та же точка входа, что у TelegramClient: через неё идут все запросы.
+        # Список запросов уходит одним контейнером — с одной задержкой сети
+        if flood_sleep_threshold is None:
+            flood_sleep_threshold = self.flood_sleep_threshold
+        while True:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            try:
+                if isinstance(request, list):
+                    return [self._handle(r) for r in request]
+                return self._handle(request)
+            except FloodWaitError as e:
+                # Короткий FLOOD_WAIT Telethon пережидает внутри _call, вызывающий его не видит
+                if e.seconds > flood_sleep_threshold:
+                    raise
+                await asyncio.sleep(e.seconds)
+
+    def _handle(self, request):
+        self.rpc_counts[type(request).__name__] += 1
+
+        if isinstance(request, GetDialogsRequest):
+            return self._folder_dialogs(request.folder_id)[request.offset_id:request.offset_id + request.limit]
+
+        if isinstance(request, GetUsersRequest):
+            return [SimpleNamespace(id=1)]
+
+        if isinstance(request, GetChannelsRequest):
+            ids = [c.channel_id for c in request.id]
+            return SimpleNamespace(chats=[self.entities[i] for i in ids if isinstance(self.entities.get(i), Channel)])
+
+        if isinstance(request, GetFullChannelRequest):
+            count = self.participants.get(request.channel.channel_id)
+            if count is None:
+                raise ValueError('CHANNEL_INVALID')
+            return SimpleNamespace(full_chat=SimpleNamespace(id=request.channel.channel_id, participants_count=count))
+
+        if isinstance(request, GetChatsRequest):
+            return SimpleNamespace(chats=[self.entities[i] for i in request.id if isinstance(self.entities.get(i), Chat)])
+
+        if isinstance(request, GetDialogFiltersRequest):
+            return DialogFilters(filters=list(self.filters.values()), tags_enabled=False)
+
+        if isinstance(request, UpdateDialogFilterRequest):
+            self._check_flood(request)
+            if request.filter is None:
+                self.filters.pop(request.id, None)
+            else:
+                if not request.filter.include_peers:
+                    raise ValueError('FILTER_INCLUDE_EMPTY')
+                self.filters[request.id] = request.filter
+            return True
+
+        raise NotImplementedError(f'FakeTelegramClient does not support {type(request).__name__}')
+
+    def _check_flood(self, request):
+        if not self.flood_limit:
+            return
+        now = asyncio.get_running_loop().time()
+        while self._writes and now - self._writes[0] > self.flood_window:
+            self._writes.popleft()
+        if len(self._writes) >= self.flood_limit:
+            self.flood_waits += 1
+            self.rpc_counts['FLOOD_WAIT'] += 1
+            raise FloodWaitError(request=request, capture=self.flood_wait_seconds)
+        self._writes.append(now)
@@ -0,0 +1,140 @@
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+def _label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path: str, text: str):
+    # node_exporter может прочитать файл в любой момент — подменяем его целиком
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class RunMetrics:
+    """
+    Метрики одного запуска organize_chats_by_config: время по фазам, RPC по типам запросов,
+    FLOOD_WAIT, число чатов, сопоставленных с каждой папкой, и число проверок паттернов.
+    """
+
+    def __init__(self, account: str):
+        self.account = account
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+        self.total_seconds = 0.0
+        # Сколько прошло от начала запуска до первого чата, для которого выбрана папка
+        self.first_decision_seconds: Optional[float] = None
+        self.phases: Dict[str, float] = {}
+        self.rpc_counts: Counter = Counter()
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.folder_chats: Dict[str, int] = {}
+        self.unmatched_chats = 0
+        self.pattern_evaluations: Counter = Counter()
+        # Расхождений с сервером при verify_after_apply (None — проверка не выполнялась)
+        self.drift_folders: Optional[int] = None
+        # Попаданий и промахов кэша классификации (None — кэш выключен)
+        self.cache_hits: Optional[int] = None
+        self.cache_misses: Optional[int] = None
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started
+
+    def count_request(self, request):
+        # В контейнер может входить несколько запросов
+        for r in request if isinstance(request, list) else [request]:
+            self.rpc_counts[type(r).__name__] += 1
+
+    def count_flood_wait(self, seconds: int):
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+
+    def mark_first_decision(self):
+        if self.first_decision_seconds is None:
+            self.first_decision_seconds = time.perf_counter() - self._started
+
+    def finish(self):
+        self.total_seconds = time.perf_counter() - self._started
+
+    def to_dict(self) -> Dict:
+        return {
+            'account': self.account,
+            'started_at': self.started_at.isoformat(),
+            'total_seconds': round(self.total_seconds, 6),
+            'first_decision_seconds': None if self.first_decision_seconds is None
+            else round(self.first_decision_seconds, 6),
+            'phases': {name: round(sec, 6) for name, sec in self.phases.items()},
+            'rpc': dict(self.rpc_counts),
+            'rpc_total': sum(self.rpc_counts.values()),
+            'flood_waits': self.flood_waits,
+            'flood_wait_seconds': self.flood_wait_seconds,
+            'folder_chats': self.folder_chats,
+            'unmatched_chats': self.unmatched_chats,
+            'pattern_evaluations': dict(self.pattern_evaluations),
+            'drift_folders': self.drift_folders,
+            'classify_cache': None if self.cache_hits is None else {
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'hit_ratio': round(self.cache_hits / max(1, self.cache_hits + self.cache_misses), 4)
+            }
+        }
+
+    def write_json(self, path: str):
+        _write_atomic(path, json.dumps(self.to_dict(), ensure_ascii=False, indent=2) + '\n')
+
+    def to_prometheus(self) -> str:
+        """Текстовый формат Prometheus для textfile collector node_exporter"""
+        account = f'account="{_label(self.account)}"'
+        lines: List[str] = []
+
+        def metric(name: str, kind: str, help_text: str, samples: List[tuple]):
+            lines.append(f'# HELP tg_folder_manager_{name} {help_text}')
+            lines.append(f'# TYPE tg_folder_manager_{name} {kind}')
+            for labels, value in samples:
+                labels = ','.join([account] + [f'{k}="{_label(v)}"' for k, v in labels])
+                lines.append(f'tg_folder_manager_{name}{{{labels}}} {value}')
+
+        metric('run_seconds', 'gauge', 'Длительность последнего запуска',
+               [((), round(self.total_seconds, 6))])
+        if self.first_decision_seconds is not None:
+            metric('first_decision_seconds', 'gauge', 'Время до первого сопоставленного чата',
+                   [((), round(self.first_decision_seconds, 6))])
+        metric('last_run_timestamp_seconds', 'gauge', 'Время начала последнего запуска (unix)',
+               [((), int(self.started_at.timestamp()))])
+        metric('phase_seconds', 'gauge', 'Длительность фаз последнего запуска',
+               [((('phase', name),), round(sec, 6)) for name, sec in self.phases.items()])
+        metric('rpc_requests', 'gauge', 'RPC за последний запуск по типам запросов',
+               [((('request', name),), n) for name, n in sorted(self.rpc_counts.items())])
+        metric('flood_waits', 'gauge', 'Ответов FLOOD_WAIT за последний запуск',
+               [((), self.flood_waits)])
+        metric('flood_wait_seconds', 'gauge', 'Суммарная пауза FLOOD_WAIT за последний запуск',
+               [((), self.flood_wait_seconds)])
+        metric('folder_chats', 'gauge', 'Чатов, сопоставленных с папкой',
+               [((('folder', name),), n) for name, n in self.folder_chats.items()])
+        metric('unmatched_chats', 'gauge', 'Чатов без подходящей папки',
+               [((), self.unmatched_chats)])
+        metric('pattern_evaluations', 'gauge', 'Проверок паттернов за последний запуск',
+               [((('kind', kind),), n) for kind, n in sorted(self.pattern_evaluations.items())])
+        if self.drift_folders is not None:
+            metric('drift_folders', 'gauge', 'Папок, расходящихся с сервером после записи',
+                   [((), self.drift_folders)])
+        if self.cache_hits is not None:
+            metric('classify_cache_lookups', 'gauge', 'Обращений к кэшу классификации за последний запуск',
+                   [((('result', 'hit'),), self.cache_hits), ((('result', 'miss'),), self.cache_misses)])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        _write_atomic(path, self.to_prometheus())
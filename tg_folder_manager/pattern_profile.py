@@ -0,0 +1,138 @@
+import os
+import re
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+import yaml
+
+# Сколько самых медленных паттернов показывать в логе и в сводке отчёта
+SLOWEST_TOP = 10
+
+
+def report_path(export_filename: str) -> str:
+    """Отчёт кладётся рядом с экспортом: folders_export.yaml → folders_export.patterns.yaml"""
+    return f'{os.path.splitext(export_filename)[0]}.patterns.yaml'
+
+
+class PatternProfile:
+    """
+    Профиль правил config.yaml на реальных названиях чатов. Каждый паттерн проверяется
+    отдельно (в рабочем матчере литералы и regex объединены, и вклад одного паттерна не виден):
+    сколько названий он находит, сколько раз именно он решил исход и сколько времени занял.
+    Условия where здесь не проверяются — профилируются только паттерны названий.
+
+    Статусы:
+        dead — не нашёл ни одного названия;
+        shadowed — все найденные названия забрали папки выше по конфигу;
+        unused — находит названия, но исход не меняет (их и так решили другие паттерны папки);
+        active — всё остальное.
+    """
+
+    def __init__(self, matcher, titles: List[str]):
+        self.titles = len(titles)
+        lowered = [t.lower() for t in titles]
+        folders = list(dict.fromkeys(folder for folder, *_ in matcher.patterns))
+        order = {folder: i for i, folder in enumerate(folders)}
+        errors = {(folder, pat): err for folder, pat, err in matcher.invalid_patterns}
+
+        self.patterns: List[Dict] = []
+        hits: List[Set[int]] = []
+        for folder, kind, pat, mode in matcher.patterns:
+            if mode == 'regex':
+                search = re.compile(pat).search
+                started = time.perf_counter()
+                found = {i for i, t in enumerate(lowered) if search(t)}
+            else:
+                started = time.perf_counter()
+                found = {i for i, t in enumerate(lowered) if pat in t}
+            entry = {
+                'folder': folder, 'kind': kind, 'pattern': pat, 'mode': mode,
+                'hits': len(found), 'seconds': time.perf_counter() - started
+            }
+            if mode == 'fallback':
+                entry['error'] = errors.get((folder, pat))
+            self.patterns.append(entry)
+            hits.append(found)
+
+        include: Dict[str, Set[int]] = {folder: set() for folder in folders}
+        exclude: Dict[str, Set[int]] = {folder: set() for folder in folders}
+        for entry, found in zip(self.patterns, hits):
+            (include if entry['kind'] == 'include' else exclude)[entry['folder']].update(found)
+
+        # Та же семантика, что у ChatMatcher.match: побеждает первая подходящая папка
+        winner: Dict[int, int] = {}
+        for i in range(len(lowered)):
+            for k, folder in enumerate(folders):
+                if i in exclude[folder]:
+                    continue
+                if i in include[folder]:
+                    winner[i] = k
+                    break
+        self.folder_chats = Counter(folders[k] for k in winner.values())
+
+        for entry, found in zip(self.patterns, hits):
+            k = order[entry['folder']]
+            if entry['kind'] == 'include':
+                entry['decisive'] = sum(1 for i in found if winner.get(i) == k)
+                earlier = Counter(folders[winner[i]] for i in found if winner.get(i, k) < k)
+                if found and sum(earlier.values()) == len(found):
+                    entry['shadowed_by'] = earlier.most_common(1)[0][0]
+            else:
+                # Исключение важно, только если без него название досталось бы этой папке
+                inc = include[entry['folder']]
+                entry['decisive'] = sum(1 for i in found if i in inc and winner.get(i, len(folders)) > k)
+            entry['status'] = self._status(entry)
+
+    @staticmethod
+    def _status(entry: Dict) -> str:
+        if not entry['hits']:
+            return 'dead'
+        if 'shadowed_by' in entry:
+            return 'shadowed'
+        if not entry['decisive']:
+            return 'unused'
+        return 'active'
+
+    def slowest(self, top: int = SLOWEST_TOP) -> List[Dict]:
+        return sorted(self.patterns, key=lambda e: e['seconds'], reverse=True)[:top]
+
+    def with_status(self, *statuses: str) -> List[Dict]:
+        return [e for e in self.patterns if e['status'] in statuses]
+
+    def to_dict(self) -> Dict:
+        def brief(e: Dict, extra: Optional[str] = None) -> Dict:
+            out = {'folder': e['folder'], 'kind': e['kind'], 'pattern': e['pattern']}
+            if extra:
+                out[extra] = e[extra]
+            return out
+
+        folders: Dict[str, Dict] = {}
+        for e in self.patterns:
+            folder = folders.setdefault(e['folder'], {
+                'chats': self.folder_chats.get(e['folder'], 0), 'patterns': []
+            })
+            folder['patterns'].append({
+                k: round(v, 6) if k == 'seconds' else v
+                for k, v in e.items() if k != 'folder'
+            })
+        return {
+            'generated_at': datetime.now().isoformat(),
+            'titles': self.titles,
+            'summary': {
+                'patterns': len(self.patterns),
+                'seconds': round(sum(e['seconds'] for e in self.patterns), 6),
+                'dead': [brief(e) for e in self.with_status('dead')],
+                'shadowed': [brief(e, 'shadowed_by') for e in self.with_status('shadowed')],
+                'unused': [brief(e) for e in self.with_status('unused')],
+                'fallback': [brief(e, 'error') for e in self.patterns if e['mode'] == 'fallback'],
+                'slowest': [{**brief(e), 'seconds': round(e['seconds'], 6)} for e in self.slowest()]
+            },
+            'folders': folders
+        }
+
+    def write(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            # Чистый Python-эмиттер: CDumper экранирует эмодзи в паттернах и названиях папок
+            yaml.dump(self.to_dict(), f, allow_unicode=True, sort_keys=False, default_flow_style=False)
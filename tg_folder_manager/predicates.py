@@ -0,0 +1,89 @@
+import re
+import time
+from typing import Callable, Dict, List, Optional
+
+# Типы чатов, которые различает менеджер (как ChatInfo.type)
+CHAT_TYPES = ('channel', 'megagroup', 'group')
+
+_DAY = 86400
+
+
+def _username_test(pattern: str) -> Callable[[str], bool]:
+    pattern = str(pattern).lower()
+    try:
+        return re.compile(pattern).search
+    except re.error:
+        # Как и у названий: невалидный regex ищется как подстрока
+        return lambda username: pattern in username
+
+
+class ChatPredicates:
+    """
+    Условия секции where у папки в config.yaml: тип чата, число участников, давность
+    последней активности и username. Проверяются от дешёвых к дорогим: всё, кроме числа
+    участников каналов и супергрупп, есть в списке диалогов; число участников берётся из
+    списка, если оно там есть, иначе check() возвращает None — нужен GetFullChannel.
+    """
+
+    FIELDS = (
+        'types', 'has_username', 'username_patterns', 'active_within_days', 'inactive_for_days',
+        'min_participants', 'max_participants'
+    )
+
+    def __init__(self, folder: str, spec: Dict):
+        unknown = set(spec) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(
+                f'Папка "{folder}": неизвестные условия where: {", ".join(sorted(unknown))} '
+                f'(доступны {", ".join(self.FIELDS)})'
+            )
+        types = spec.get('types')
+        if isinstance(types, str):
+            types = [types]
+        if types is not None and not set(types) <= set(CHAT_TYPES):
+            raise ValueError(f'Папка "{folder}": where.types — список из {", ".join(CHAT_TYPES)}')
+        self.spec = spec
+        self.types = frozenset(types) if types is not None else None
+        self.has_username: Optional[bool] = spec.get('has_username')
+        patterns = spec.get('username_patterns') or []
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+        self._username_tests: List[Callable[[str], bool]] = [_username_test(p) for p in patterns if p]
+        self.active_within_days: Optional[float] = spec.get('active_within_days')
+        self.inactive_for_days: Optional[float] = spec.get('inactive_for_days')
+        self.min_participants: Optional[int] = spec.get('min_participants')
+        self.max_participants: Optional[int] = spec.get('max_participants')
+
+    @property
+    def needs_participants(self) -> bool:
+        return self.min_participants is not None or self.max_participants is not None
+
+    def check(self, chat, now: Optional[float] = None) -> Optional[bool]:
+        """True/False — чат подходит или нет; None — не хватает числа участников"""
+        if self.types is not None and chat.type not in self.types:
+            return False
+
+        username = (chat.username or '').lower()
+        if self.has_username is not None and bool(username) != self.has_username:
+            return False
+        if self._username_tests and not (username and any(test(username) for test in self._username_tests)):
+            return False
+
+        if self.active_within_days is not None or self.inactive_for_days is not None:
+            if chat.last_activity is None:
+                return False
+            idle = (time.time() if now is None else now) - chat.last_activity
+            if self.active_within_days is not None and idle > self.active_within_days * _DAY:
+                return False
+            if self.inactive_for_days is not None and idle < self.inactive_for_days * _DAY:
+                return False
+
+        if not self.needs_participants:
+            return True
+        if chat.participants is None:
+            return None
+        if self.min_participants is not None and chat.participants < self.min_participants:
+            return False
+        if self.max_participants is not None and chat.participants > self.max_participants:
+            return False
+        return True
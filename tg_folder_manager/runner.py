@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional
+
+import yaml
+
+from .tg_folder_manager import TelegramFolderManager, UnmatchedChatsStrategy
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AccountProfile:
+    name: str
+    session: str
+    api_id: Optional[int] = None
+    api_hash: Optional[str] = None
+
+
+@dataclass
+class AccountResult:
+    name: str
+    ok: bool
+    seconds: float
+    error: Optional[str] = None
+
+
+def load_profiles(config_path: str) -> List[AccountProfile]:
+    """
+    Читает секцию accounts из config.yaml. api_id/api_hash можно не указывать —
+    тогда берутся значения из .env.
+    """
+    with open(config_path, encoding='utf-8') as f:
+        cfg = yaml.safe_load(f) or {}
+
+    profiles: List[AccountProfile] = []
+    for item in cfg.get('accounts', []) or []:
+        if not item.get('session'):
+            raise ValueError('accounts: каждому аккаунту нужен параметр session')
+        profiles.append(AccountProfile(
+            name=item.get('name', item['session']),
+            session=item['session'],
+            api_id=int(item['api_id']) if item.get('api_id') else None,
+            api_hash=item.get('api_hash')
+        ))
+    return profiles
+
+
+class MultiAccountRunner:
+    """
+    Запускает organize_chats_by_config для нескольких аккаунтов с общими правилами.
+    Аккаунты одного процесса работают параллельно в одном event loop; при processes > 1
+    они раскладываются по процессам. У каждого аккаунта свой клиент и своя очередь записей,
+    поэтому ограничения частоты не делятся между аккаунтами.
+    Сессии должны быть авторизованы заранее: в дочерних процессах ввод кода недоступен.
+    """
+
+    def __init__(
+            self,
+            profiles: List[AccountProfile],
+            config_path: str,
+            unmatched_strategy: UnmatchedChatsStrategy = UnmatchedChatsStrategy.IGNORE,
+            warn_on_duplicates: bool = True,
+            processes: int = 1
+    ):
+        if not profiles:
+            raise ValueError('Не задано ни одного аккаунта')
+        self.profiles = profiles
+        self.config_path = config_path
+        self.strategy = unmatched_strategy
+        self.warn_dupes = warn_on_duplicates
+        self.processes = max(1, processes)
+
+    async def _run_account(self, profile: AccountProfile) -> AccountResult:
+        started = time.perf_counter()
+        try:
+            async with TelegramFolderManager(
+                unmatched_strategy=self.strategy,
+                warn_on_duplicates=self.warn_dupes,
+                session=profile.session,
+                api_id=profile.api_id,
+                api_hash=profile.api_hash
+            ) as manager:
+                await manager.organize_chats_by_config(config_path=self.config_path)
+        except Exception as e:
+            logger.error(f'✗ [{profile.name}] {e}')
+            return AccountResult(profile.name, False, time.perf_counter() - started, str(e))
+        return AccountResult(profile.name, True, time.perf_counter() - started)
+
+    async def _run_shard(self, profiles: List[AccountProfile]) -> List[AccountResult]:
+        return list(await asyncio.gather(*(self._run_account(p) for p in profiles)))
+
+    def _run_shard_sync(self, profiles: List[AccountProfile]) -> List[AccountResult]:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        return asyncio.run(self._run_shard(profiles))
+
+    async def run(self) -> List[AccountResult]:
+        started = time.perf_counter()
+        if self.processes == 1 or len(self.profiles) == 1:
+            results = await self._run_shard(self.profiles)
+        else:
+            workers = min(self.processes, len(self.profiles))
+            shards = [self.profiles[i::workers] for i in range(workers)]
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                parts = await asyncio.gather(
+                    *(loop.run_in_executor(pool, self._run_shard_sync, shard) for shard in shards)
+                )
+            results = [r for part in parts for r in part]
+
+        self._print_report(results, time.perf_counter() - started)
+        return results
+
+    @staticmethod
+    def _print_report(results: List[AccountResult], total: float):
+        logger.info(f'📊 Итог по аккаунтам ({len(results)}), общее время {total:.1f} сек:')
+        for r in sorted(results, key=lambda x: x.name):
+            status = '✔' if r.ok else f'✗ {r.error}'
+            logger.info(f'   👤 {r.name}: {r.seconds:.1f} сек {status}')
@@ -0,0 +1,4 @@
+def session_side_file(session: str, suffix: str) -> str:
+    """Путь к файлу рядом с файлом сессии Telethon: "acc.session", "dialogs" → "acc.dialogs.sqlite\""""
+    base = session[:-len('.session')] if session.endswith('.session') else session
+    return f'{base}.{suffix}.sqlite'
@@ -0,0 +1,59 @@
+import os
+import sqlite3
+from typing import Dict
+
+from .session_files import session_side_file
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS shards (
+    folder_id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL
+);
+'''
+
+
+class ShardRegistry:
+    """
+    Папки-шарды, созданные менеджером, в SQLite рядом с файлом сессии: id папки → папка конфига,
+    которую шард продолжает ("Новости 2" → "Новости"). Шардом считается только папка из реестра,
+    поэтому одноимённые папки пользователя и папки конфига вроде "Новости 2" не перезаписываются.
+    Файл создаётся при первой записи непустого реестра.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def path_for(session: str) -> str:
+        return session_side_file(session, 'shards')
+
+    @classmethod
+    def for_session(cls, session: str) -> 'ShardRegistry':
+        return cls(cls.path_for(session))
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.executescript(SCHEMA)
+        return conn
+
+    def load(self) -> Dict[int, str]:
+        if not os.path.exists(self.path):
+            return {}
+        conn = self._connect()
+        try:
+            return dict(conn.execute('SELECT folder_id, folder FROM shards'))
+        finally:
+            conn.close()
+
+    def save(self, shards: Dict[int, str]):
+        """Заменяет реестр целиком"""
+        if not shards and not os.path.exists(self.path):
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM shards')
+                conn.executemany('INSERT INTO shards (folder_id, folder) VALUES (?, ?)', shards.items())
+        finally:
+            conn.close()
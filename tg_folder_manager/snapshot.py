@@ -0,0 +1,185 @@
+import json
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerSelf, InputPeerUser
+
+from .session_files import session_side_file
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dialogs (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    type TEXT NOT NULL,
+    access_hash INTEGER,
+    top_message INTEGER NOT NULL DEFAULT 0,
+    username TEXT,
+    last_activity INTEGER,
+    participants INTEGER,
+    -- Место в списке диалогов: меньше — выше. top_message у каналов свой, по нему диалоги не сравнить
+    seq INTEGER
+);
+CREATE TABLE IF NOT EXISTS folders (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    include_peers TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+_ADDED_COLUMNS = [
+    ('username', 'TEXT'), ('last_activity', 'INTEGER'), ('participants', 'INTEGER'), ('seq', 'INTEGER')
+]
+
+
+@dataclass
+class DialogRecord:
+    id: int
+    title: str
+    type: str  # channel | megagroup | group
+    access_hash: Optional[int]
+    top_message: int
+    # Для условий where: username, время последнего сообщения (unix) и число участников, если известно
+    username: Optional[str] = None
+    last_activity: Optional[int] = None
+    participants: Optional[int] = None
+
+
+@dataclass
+class FolderRecord:
+    id: int
+    title: str
+    include_peers: List[any]
+
+
+def encode_peer(p) -> Optional[list]:
+    """InputPeer → компактный JSON-список; неизвестные типы пиров не сохраняются"""
+    if isinstance(p, InputPeerChannel):
+        return ['channel', p.channel_id, p.access_hash]
+    if isinstance(p, InputPeerChat):
+        return ['chat', p.chat_id]
+    if isinstance(p, InputPeerUser):
+        return ['user', p.user_id, p.access_hash]
+    if isinstance(p, InputPeerSelf):
+        return ['self']
+    return None
+
+
+def decode_peer(data: list):
+    kind = data[0]
+    if kind == 'channel':
+        return InputPeerChannel(data[1], data[2])
+    if kind == 'chat':
+        return InputPeerChat(data[1])
+    if kind == 'user':
+        return InputPeerUser(data[1], data[2])
+    if kind == 'self':
+        return InputPeerSelf()
+    raise ValueError(f'Неизвестный тип пира: {kind}')
+
+
+class DialogSnapshot:
+    """
+    Локальный снимок групп и каналов аккаунта в SQLite рядом с файлом сессии.
+    Хранит id, название, тип, access_hash и id последнего сообщения диалога,
+    чтобы следующий запуск мог докачать только изменившиеся диалоги.
+    Там же хранится последнее известное состояние папок — для офлайн-планирования.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(SCHEMA)
+        # Снимки, созданные до появления условий where, дополняем недостающими колонками
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(dialogs)')}
+        with self._conn:
+            for column, kind in _ADDED_COLUMNS:
+                if column not in columns:
+                    self._conn.execute(f'ALTER TABLE dialogs ADD COLUMN {column} {kind}')
+
+    @staticmethod
+    def path_for(session: str) -> str:
+        return session_side_file(session, 'dialogs')
+
+    @classmethod
+    def for_session(cls, session: str) -> 'DialogSnapshot':
+        return cls(cls.path_for(session))
+
+    def load(self) -> Dict[int, DialogRecord]:
+        # В порядке списка диалогов (свежие первыми), как их отдаёт Telegram;
+        # записи из снимков без seq — в конце
+        rows = self._conn.execute(
+            'SELECT id, title, type, access_hash, top_message, username, last_activity, participants '
+            'FROM dialogs ORDER BY seq IS NULL, seq, top_message DESC'
+        )
+        return {row[0]: DialogRecord(*row) for row in rows}
+
+    def upsert(self, records: Iterable[DialogRecord]):
+        """
+        Записывает диалоги в порядке списка диалогов. Докачанные диалоги — самые свежие,
+        поэтому встают выше всех, что уже есть в снимке
+        """
+        records = list(records)
+        with self._conn:
+            top = self._conn.execute('SELECT COALESCE(MIN(seq), 0) FROM dialogs').fetchone()[0]
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO dialogs '
+                '(id, title, type, access_hash, top_message, username, last_activity, participants, seq) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    (r.id, r.title, r.type, r.access_hash, r.top_message, r.username, r.last_activity,
+                     r.participants, top - len(records) + i)
+                    for i, r in enumerate(records)
+                )
+            )
+
+    def replace_all(self, records: Iterable[DialogRecord]):
+        """Полная пересинхронизация: диалоги, которых больше нет, удаляются из снимка"""
+        with self._conn:
+            self._conn.execute('DELETE FROM dialogs')
+        self.upsert(records)
+
+    def load_folders(self) -> List[FolderRecord]:
+        rows = self._conn.execute('SELECT id, title, include_peers FROM folders ORDER BY id')
+        return [FolderRecord(row[0], row[1], [decode_peer(p) for p in json.loads(row[2])]) for row in rows]
+
+    def load_chatlist_ids(self) -> List[int]:
+        return json.loads(self.get_meta('chatlist_ids') or '[]')
+
+    def save_folders(self, folders: Iterable[FolderRecord], chatlist_ids: Iterable[int] = ()):
+        """Заменяет сохранённое состояние папок целиком; chatlist_ids — id общих папок (их состав не хранится)"""
+        with self._conn:
+            self._conn.execute('DELETE FROM folders')
+            self._conn.executemany(
+                'INSERT INTO folders (id, title, include_peers) VALUES (?, ?, ?)',
+                (
+                    (f.id, f.title, json.dumps([e for e in map(encode_peer, f.include_peers) if e]))
+                    for f in folders
+                )
+            )
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                [('folders_synced', datetime.now().isoformat()), ('chatlist_ids', json.dumps(sorted(chatlist_ids)))]
+            )
+
+    def mark_synced(self, full: bool):
+        now = datetime.now().isoformat()
+        keys = ['last_sync', 'last_full_sync'] if full else ['last_sync']
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                ((key, now) for key in keys)
+            )
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        self._conn.close()
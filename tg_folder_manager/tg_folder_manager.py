@@ -1,30 +1,99 @@
+import asyncio
+import hashlib
 import logging
+import os
+import time
 from enum import Enum
-from collections import defaultdict
-from typing import List, Dict, Optional, Set
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
+from typing import Callable, List, Dict, Hashable, Iterable, Optional, Protocol, Set
 from dataclasses import dataclass, field
 from datetime import datetime
 
 from dotenv import load_dotenv
 from os import getenv
+import json
 import yaml
 import re
 
-from telethon import TelegramClient
+try:
+    import msgpack
+except ImportError:  # необязательная зависимость, нужна только для export_format=msgpack
+    msgpack = None
+
+from telethon import TelegramClient, events, utils
+from telethon.errors import (
+    ChannelInvalidError,
+    ChannelPrivateError,
+    ChatIdInvalidError,
+    FloodWaitError,
+    MultiError,
+    RPCError
+)
+from telethon.tl.functions.channels import GetFullChannelRequest
 from telethon.tl.functions.messages import GetDialogFiltersRequest, UpdateDialogFilterRequest
 from telethon.tl.types import (
     DialogFilter,
     TextWithEntities,
     Channel,
     Chat,
+    InputChannel,
     InputPeerChannel,
-    InputPeerChat
+    InputPeerChat,
+    PeerChannel,
+    PeerChat,
+    UpdateChannel,
+    UpdateDialogFilter,
+    UpdateDialogFilters
 )
 
+from .classify_cache import ClassificationCache, title_hash
+from .metrics import RunMetrics
+from .pattern_profile import PatternProfile, report_path
+from .predicates import ChatPredicates
+from .chat_details import ChatDetailsCache
+from .entity_store import DEFAULT_SESSION, EntityStore, entity_store_path, peer_id
+from .shards import ShardRegistry
+from .snapshot import DialogSnapshot, DialogRecord, FolderRecord, decode_peer, encode_peer
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
+UNMATCHED_FOLDER = 'Прочие'
+
+# Сколько чатов Telegram разрешает явно включить в одну папку (у Premium-аккаунтов больше)
+DEFAULT_FOLDER_PEER_LIMIT = 100
+
+# Сколько папок разрешено аккаунту (у Premium — 20)
+DEFAULT_FOLDER_LIMIT = 10
+
+# Меньше этого числа названий классификация идёт в текущем процессе: запуск пула дороже выигрыша
+DEFAULT_CLASSIFY_PARALLEL_THRESHOLD = 20000
+
+# Telegram отдаёт диалоги страницами по 100 — примерно столько названий сопоставляется за раз при потоковой загрузке
+CLASSIFY_FLUSH_SIZE = 100
+
+# Сколько GetFullChannel отправлять одним контейнером и как долго помнить число участников
+DEFAULT_DETAILS_BATCH = 20
+DEFAULT_DETAILS_TTL = 86400
+
+# Допустимые id папок: 0 — «Все чаты», 1 — архив
+FOLDER_ID_MIN = 2
+FOLDER_ID_MAX = 255
+
+# dialogs_archived → параметр archived у iter_dialogs
+DIALOG_ARCHIVE_SCOPES = {'include': None, 'exclude': False, 'only': True}
+
+
+def _free_folder_id(taken: Iterable[int]) -> Optional[int]:
+    """Наименьший свободный id папки из допустимого диапазона; None, если заняты все"""
+    taken = set(taken)
+    return next((fid for fid in range(FOLDER_ID_MIN, FOLDER_ID_MAX + 1) if fid not in taken), None)
+
+
 class UnmatchedChatsStrategy(Enum):
     IGNORE = 'ignore'
     MOVE_TO_FOLDER = 'move_to_folder'
@@ -32,15 +101,66 @@ class UnmatchedChatsStrategy(Enum):
     LOG_ONLY = 'log_only'
 
 
-@dataclass
 class ChatInfo:
-    id: int
-    title: str
-    access_hash: Optional[int]
-    is_megagroup: bool
-    is_channel: bool
-    is_group: bool
-    input_peer: any
+    """
+    Компактная запись о чате: на больших аккаунтах их сотни тысяч, поэтому без __dict__,
+    тип хранится одной строкой, а InputPeer строится только при обращении — то есть
+    для тех чатов, которые действительно попадают в папку.
+    """
+
+    __slots__ = ('id', 'title', 'access_hash', 'type', 'username', 'last_activity', 'participants')
+
+    def __init__(
+            self,
+            id: int,
+            title: str,
+            access_hash: Optional[int],
+            is_megagroup: bool = False,
+            is_channel: bool = False,
+            is_group: bool = False,
+            type: Optional[str] = None,
+            username: Optional[str] = None,
+            last_activity: Optional[int] = None,
+            participants: Optional[int] = None
+    ):
+        self.id = id
+        self.title = title
+        self.access_hash = access_hash
+        # channel | megagroup | group, как в DialogRecord
+        self.type = type or ('group' if is_group else 'megagroup' if is_megagroup else 'channel')
+        # Поля для условий where; participants у каналов обычно неизвестно до GetFullChannel
+        self.username = username
+        self.last_activity = last_activity
+        self.participants = participants
+
+    @property
+    def is_megagroup(self) -> bool:
+        return self.type == 'megagroup'
+
+    @property
+    def is_channel(self) -> bool:
+        return self.type == 'channel'
+
+    @property
+    def is_group(self) -> bool:
+        return self.type == 'group'
+
+    @property
+    def input_peer(self):
+        if self.type == 'group':
+            return InputPeerChat(self.id)
+        return InputPeerChannel(self.id, self.access_hash)
+
+    def __eq__(self, other):
+        if not isinstance(other, ChatInfo):
+            return NotImplemented
+        return (self.id, self.title, self.access_hash, self.type) == \
+            (other.id, other.title, other.access_hash, other.type)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'ChatInfo(id={self.id}, title={self.title!r}, type={self.type!r})'
 
 
 @dataclass
@@ -62,27 +182,529 @@ class ChatDuplicateInfo:
         return len(self.folders) > 1
 
 
+class FolderOperationType(Enum):
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+
+
+@dataclass
+class FolderOperation:
+    kind: FolderOperationType
+    folder_id: int
+    title: str
+    include_peers: List[any] = field(default_factory=list)
+    added: int = 0
+    removed: int = 0
+    # Папка конфига, которую продолжает шард ("Новости" для "Новости 2"); None — не шард
+    shard_of: Optional[str] = None
+
+
+class PeerFolderIndex:
+    """
+    Инвертированный индекс: id пира → множество id папок и id папки → упорядоченный набор пиров.
+    Поддерживается инкрементально. overlay() даёт копию-при-записи поверх индекса:
+    планировщик меняет только затронутые папки и пиры, не копируя всё состояние.
+    """
+
+    def __init__(self, base: Optional['PeerFolderIndex'] = None):
+        self._base = base
+        self._folder_peers: Dict[int, Dict[any, any]] = {}
+        self._peer_folders: Dict[any, Set[int]] = {}
+        self._removed: Set[int] = set()
+        self._multi: Set[any] = set()
+        self.changed: Set[int] = set()
+
+    @staticmethod
+    def peer_id(p) -> Optional[int]:
+        if isinstance(p, (InputPeerChannel, PeerChannel)):
+            return p.channel_id
+        if isinstance(p, (InputPeerChat, PeerChat)):
+            return p.chat_id
+        return getattr(p, 'user_id', None)
+
+    @classmethod
+    def peer_key(cls, fid: int, pos: int, p) -> any:
+        # Пиры без id (например, InputPeerSelf) не трогаем, но сохраняем в папке
+        pid = cls.peer_id(p)
+        return pid if pid else ('peer', fid, pos)
+
+    def overlay(self) -> 'PeerFolderIndex':
+        return PeerFolderIndex(base=self)
+
+    def clear(self):
+        self._folder_peers.clear()
+        self._peer_folders.clear()
+        self._removed.clear()
+        self._multi.clear()
+        self.changed.clear()
+
+    def folder_ids(self) -> List[int]:
+        ids = list(self._folder_peers)
+        if self._base:
+            ids += [fid for fid in self._base.folder_ids() if fid not in self._folder_peers]
+        return [fid for fid in ids if fid not in self._removed]
+
+    def has_folder(self, fid: int) -> bool:
+        if fid in self._removed:
+            return False
+        return fid in self._folder_peers or bool(self._base and self._base.has_folder(fid))
+
+    def peers(self, fid: int) -> Dict[any, any]:
+        """Упорядоченный набор пиров папки (ключ → пир); только для чтения"""
+        if fid in self._removed:
+            return {}
+        peers = self._folder_peers.get(fid)
+        if peers is None and self._base:
+            return self._base.peers(fid)
+        return peers or {}
+
+    def folders_of(self, key) -> Set[int]:
+        """Папки, в которые входит пир; только для чтения"""
+        folders = self._peer_folders.get(key)
+        if folders is None and self._base:
+            return self._base.folders_of(key)
+        return folders or set()
+
+    def _peers_for_write(self, fid: int) -> Dict[any, any]:
+        self.changed.add(fid)
+        self._removed.discard(fid)
+        peers = self._folder_peers.get(fid)
+        if peers is None:
+            peers = dict(self._base.peers(fid)) if self._base else {}
+            self._folder_peers[fid] = peers
+        return peers
+
+    def _folders_for_write(self, key) -> Set[int]:
+        folders = self._peer_folders.get(key)
+        if folders is None:
+            folders = set(self._base.folders_of(key)) if self._base else set()
+            self._peer_folders[key] = folders
+        return folders
+
+    def _link(self, fid: int, key, linked: bool):
+        folders = self._folders_for_write(key)
+        if linked:
+            folders.add(fid)
+        else:
+            folders.discard(fid)
+        if len(folders) > 1:
+            self._multi.add(key)
+        else:
+            self._multi.discard(key)
+
+    def add(self, fid: int, key, peer):
+        self._peers_for_write(fid).setdefault(key, peer)
+        self._link(fid, key, True)
+
+    def discard(self, fid: int, key) -> bool:
+        peers = self._peers_for_write(fid)
+        if key not in peers:
+            return False
+        del peers[key]
+        self._link(fid, key, False)
+        return True
+
+    def set_folder(self, fid: int, items):
+        """Заменяет состав папки; items — пары (ключ, пир) в нужном порядке"""
+        peers = self._peers_for_write(fid)
+        new = dict(items)
+        for key in peers.keys() - new.keys():
+            self._link(fid, key, False)
+        for key in new.keys() - peers.keys():
+            self._link(fid, key, True)
+        peers.clear()
+        peers.update(new)
+
+    def set_folder_peers(self, fid: int, include_peers: List[any]):
+        self.set_folder(fid, ((self.peer_key(fid, i, p), p) for i, p in enumerate(include_peers)))
+
+    def remove_folder(self, fid: int):
+        self.set_folder(fid, ())
+        self._folder_peers.pop(fid, None)
+        self._removed.add(fid)
+
+    def duplicates(self) -> Dict[any, Set[int]]:
+        """Пиры, входящие больше чем в одну папку"""
+        keys = self._multi | self._base._multi if self._base else self._multi
+        out = {}
+        for key in keys:
+            folders = self.folders_of(key)
+            if len(folders) > 1:
+                out[key] = folders
+        return out
+
+
+_REGEX_META = frozenset('.^$*+?{}[]\\|()')
+_BACKREF_RE = re.compile(r'\\\d|\(\?P=')
+
+
+class _AhoCorasick:
+    """Автомат Ахо-Корасик: за один проход по строке находит все литералы, встречающиеся в ней"""
+
+    def __init__(self, keywords: Dict[str, Set[int]]):
+        goto: List[Dict[str, int]] = [{}]
+        out: List[Set[int]] = [set()]
+        for word, labels in keywords.items():
+            node = 0
+            for ch in word:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    out.append(set())
+                node = nxt
+            out[node].update(labels)
+
+        # Суффиксные ссылки строим обходом в ширину, попутно сливая выходы
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in goto[node].items():
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] |= out[fail[nxt]]
+                queue.append(nxt)
+
+        self._goto = goto
+        self._fail = fail
+        self._out = [frozenset(o) for o in out]
+
+    def __bool__(self) -> bool:
+        return len(self._goto) > 1
+
+    def search(self, text: str) -> Set[int]:
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        found: Set[int] = set()
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found |= out[node]
+        return found
+
+
+class ChatMatcher:
+    """
+    Скомпилированные правила папок. Строится один раз на конфиг:
+    литералы всех папок (включения и исключения) собираются в один автомат Ахо-Корасик,
+    регулярные выражения компилируются заранее (по возможности — в одну альтернацию на папку).
+    Семантика совпадает с прежним поиском: побеждает первая подходящая папка в порядке конфига.
+    Папки с условиями where (predicates) дополнительно проверяют поля чата — после названия,
+    от дешёвых к дорогим; без чата такие папки не подходят.
+    """
+
+    # match() не может выбрать папку, пока у чата неизвестно число участников
+    UNDECIDED = object()
+
+    def __init__(
+            self,
+            include_patterns: Dict[str, List[str]],
+            exclude_patterns: Dict[str, List[str]],
+            predicates: Optional[Dict[str, ChatPredicates]] = None
+    ):
+        literals: Dict[str, Set[int]] = defaultdict(set)
+        # Правила в хешируемом виде — по ним рабочие процессы match_batch собирают (и кэшируют) свою копию матчера
+        self._key = _matcher_key(include_patterns, exclude_patterns)
+        self._rules: List[tuple] = []
+        self.predicates: Dict[str, ChatPredicates] = predicates or {}
+        # (папка, паттерн, ошибка) для regex, которые не компилируются и ищутся как подстрока
+        self.invalid_patterns: List[tuple] = []
+        # (папка, include | exclude, паттерн, literal | regex | fallback) в порядке конфига — для профилирования
+        self.patterns: List[tuple] = []
+        for idx, folder in enumerate(include_patterns):
+            inc_label, exc_label = idx * 2, idx * 2 + 1
+            inc_regex = self._compile_group(folder, include_patterns[folder], inc_label, literals)
+            exc_regex = self._compile_group(folder, exclude_patterns.get(folder, []), exc_label, literals)
+            # Папка только с условиями where (без include_patterns) подходит по любому названию
+            title_required = bool(include_patterns[folder]) or folder not in self.predicates
+            self._rules.append(
+                (folder, inc_label, exc_label, inc_regex, exc_regex, title_required, self.predicates.get(folder))
+            )
+        self._literals = _AhoCorasick(literals)
+
+    def _compile_group(
+            self,
+            folder: str,
+            patterns: List[str],
+            label: int,
+            literals: Dict[str, Set[int]]
+    ) -> List[re.Pattern]:
+        regexes: List[str] = []
+        for pat in patterns:
+            if not pat:
+                continue
+            pat = str(pat).lower()
+            kind = 'exclude' if label % 2 else 'include'
+            if not _REGEX_META.intersection(pat):
+                self.patterns.append((folder, kind, pat, 'literal'))
+                literals[pat].add(label)
+                continue
+            try:
+                re.compile(pat)
+            except re.error as e:
+                # Невалидный regex ищется как подстрока — так же, как раньше
+                self.invalid_patterns.append((folder, pat, str(e)))
+                self.patterns.append((folder, kind, pat, 'fallback'))
+                literals[pat].add(label)
+                continue
+            self.patterns.append((folder, kind, pat, 'regex'))
+            regexes.append(pat)
+
+        if len(regexes) > 1 and not any(_BACKREF_RE.search(p) for p in regexes):
+            try:
+                return [re.compile('|'.join(f'(?:{p})' for p in regexes))]
+            except re.error:
+                # Например, глобальные флаги (?i) не в начале выражения
+                pass
+        return [re.compile(p) for p in regexes]
+
+    def match(
+            self,
+            chat_title: str,
+            chat: Optional[ChatInfo] = None,
+            final: bool = False,
+            stats: Optional[Counter] = None
+    ):
+        """
+        Папка для названия (и чата, если у папок есть условия where) или None.
+        Если решение зависит от неизвестного числа участников, возвращает UNDECIDED;
+        с final=True такое условие считается невыполненным. В stats (если передан)
+        считаются проверки: 'title' — названий через автомат, 'regex_search' — вызовов regex.search.
+        Матчер общий для всех аккаунтов с одним конфигом, поэтому счётчики — у вызывающего.
+        """
+        if stats is not None:
+            stats['title'] += 1
+        title = chat_title.lower()
+        hits = self._literals.search(title) if self._literals else ()
+        now = time.time()
+        for folder, inc_label, exc_label, inc_regex, exc_regex, title_required, preds in self._rules:
+            if exc_label in hits or (exc_regex and self._search(exc_regex, title, stats)):
+                continue
+            if title_required and not (inc_label in hits or (inc_regex and self._search(inc_regex, title, stats))):
+                continue
+            if preds is not None:
+                if chat is None:
+                    continue
+                ok = preds.check(chat, now)
+                if ok is None and not final:
+                    return self.UNDECIDED
+                if not ok:
+                    continue
+            return folder
+        return None
+
+    @staticmethod
+    def _search(regexes: List[re.Pattern], title: str, stats: Optional[Counter]) -> bool:
+        for r in regexes:
+            if stats is not None:
+                stats['regex_search'] += 1
+            if r.search(title):
+                return True
+        return False
+
+    def match_batch(
+            self,
+            titles: List[str],
+            processes: int = 1,
+            threshold: int = DEFAULT_CLASSIFY_PARALLEL_THRESHOLD,
+            stats: Optional[Counter] = None,
+            executor: Optional[Executor] = None
+    ) -> List[Optional[str]]:
+        """
+        Сопоставляет список названий; результат совпадает с [match(t, stats=stats) for t in titles].
+        При processes != 1 и не меньше threshold названий список режется на куски,
+        которые разбираются в пуле процессов (processes=0 — по числу ядер): в executor,
+        если он передан, иначе во временном пуле на время вызова.
+        """
+        workers = processes or os.cpu_count() or 1
+        if workers == 1 or len(titles) < threshold:
+            return [self.match(t, stats=stats) for t in titles]
+
+        chunks = self._chunks(titles, workers)
+        if executor is not None:
+            return self._merge(executor.map(_match_chunk, [self._key] * len(chunks), chunks), stats)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return self._merge(pool.map(_match_chunk, [self._key] * len(chunks), chunks), stats)
+
+    async def match_batch_async(
+            self,
+            titles: List[str],
+            executor: Optional[Executor],
+            processes: int = 1,
+            threshold: int = DEFAULT_CLASSIFY_PARALLEL_THRESHOLD,
+            stats: Optional[Counter] = None
+    ) -> List[Optional[str]]:
+        """
+        Как match_batch, но куски уходят в долгоживущий пул executor через run_in_executor:
+        цикл событий не блокируется, пока их разбирают рабочие процессы. Без executor — в текущем процессе.
+        """
+        workers = processes or os.cpu_count() or 1
+        if executor is None or workers == 1 or len(titles) < threshold:
+            return [self.match(t, stats=stats) for t in titles]
+
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(executor, _match_chunk, self._key, chunk)
+            for chunk in self._chunks(titles, workers)
+        ))
+        return self._merge(results, stats)
+
+    @staticmethod
+    def _chunks(titles: List[str], workers: int) -> List[List[str]]:
+        size = -(-len(titles) // (workers * 4))
+        return [titles[i:i + size] for i in range(0, len(titles), size)]
+
+    @staticmethod
+    def _merge(results: Iterable[tuple], stats: Optional[Counter]) -> List[Optional[str]]:
+        out: List[Optional[str]] = []
+        for folders, chunk_stats in results:
+            out.extend(folders)
+            if stats is not None:
+                stats.update(chunk_stats)
+        return out
+
+    @staticmethod
+    def match_primary(
+            chat_title: str,
+            include_patterns: Dict[str, List[str]],
+            exclude_patterns: Dict[str, List[str]]
+    ) -> Optional[str]:
+        """Совместимый интерфейс: правила компилируются один раз и берутся из кэша"""
+        return _compiled_matcher(_matcher_key(include_patterns, exclude_patterns)).match(chat_title)
+
+
+def _matcher_key(include_patterns: Dict[str, List[str]], exclude_patterns: Dict[str, List[str]]) -> tuple:
+    return (
+        tuple((name, tuple(pats)) for name, pats in include_patterns.items()),
+        tuple((name, tuple(pats)) for name, pats in exclude_patterns.items())
+    )
+
+
+def _match_chunk(key: tuple, titles: List[str]) -> (List[Optional[str]], Counter):
+    # Рабочий процесс пула живёт дольше одного конфига: матчер берётся из кэша по правилам
+    stats: Counter = Counter()
+    matcher = _compiled_matcher(key)
+    folders = [matcher.match(t, stats=stats) for t in titles]
+    return folders, stats
+
+
+@lru_cache(maxsize=32)
+def _compiled_matcher(key: tuple) -> ChatMatcher:
+    include, exclude = key
+    return ChatMatcher(
+        {name: list(pats) for name, pats in include},
+        {name: list(pats) for name, pats in exclude}
+    )
+
+
+@dataclass
+class CompiledConfig:
+    content_hash: str
+    include_patterns: Dict[str, List[str]]
+    exclude_patterns: Dict[str, List[str]]
+    settings: Dict
+    matcher: ChatMatcher
+    # Хеш только правил папок (без settings) — ключ кэша классификации
+    patterns_hash: str = ''
+
+
+# C-загрузчик libyaml, если PyYAML собран с ним
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
 class ConfigLoader:
+    # Разобранные конфиги по sha256 содержимого: повторная загрузка того же файла
+    # (режим наблюдения, несколько аккаунтов) не парсит YAML и не компилирует правила заново
+    _cache: Dict[str, CompiledConfig] = {}
+    _cache_size = 8
+
+    @classmethod
+    def load(cls, config_path: str = 'config.yaml') -> CompiledConfig:
+        with open(config_path, 'rb') as f:
+            raw = f.read()
+        content_hash = hashlib.sha256(raw).hexdigest()
+        cached = cls._cache.get(content_hash)
+        if cached:
+            return cached
+
+        cfg = yaml.load(raw.decode('utf-8'), Loader=_YamlLoader) or {}
+        if not isinstance(cfg, dict):
+            raise ValueError(f'{config_path}: ожидается YAML-словарь с секциями settings и folders')
+        include_patterns, exclude_patterns, export_settings = cls._parse(cfg)
+        predicates = cls._parse_predicates(cfg)
+
+        matcher = ChatMatcher(include_patterns, exclude_patterns, predicates)
+        for folder, pat, err in matcher.invalid_patterns:
+            logger.warning(f'⚠ Папка "{folder}": "{pat}" — невалидный regex ({err}), ищется как подстрока')
+
+        patterns_hash = hashlib.sha256(json.dumps(
+            [list(include_patterns.items()), list(exclude_patterns.items()),
+             [(name, p.spec) for name, p in predicates.items()]],
+            ensure_ascii=False, default=str
+        ).encode('utf-8')).hexdigest()
+        compiled = CompiledConfig(
+            content_hash, include_patterns, exclude_patterns, export_settings, matcher, patterns_hash
+        )
+        if len(cls._cache) >= cls._cache_size:
+            cls._cache.pop(next(iter(cls._cache)))
+        cls._cache[content_hash] = compiled
+        return compiled
+
     @staticmethod
     def load_config(config_path: str = 'config.yaml') -> (
             Dict[str, List[str]], Dict[str, List[str]], Dict
     ):
-        with open(config_path, encoding='utf-8') as f:
-            cfg = yaml.safe_load(f) or {}
+        compiled = ConfigLoader.load(config_path)
+        return compiled.include_patterns, compiled.exclude_patterns, compiled.settings
 
+    @staticmethod
+    def _parse(cfg: Dict) -> (Dict[str, List[str]], Dict[str, List[str]], Dict):
         # Загружаем настройки
-        settings = cfg.get('settings', {})
+        settings = cfg.get('settings') or {}
         export_settings = {
             'enabled': settings.get('export_enabled', False),
             'filename': settings.get('export_filename', 'folders_export.yaml'),
-            'dry_run': settings.get('dry_run', False)
+            'format': settings.get('export_format', 'yaml'),
+            'dry_run': settings.get('dry_run', False),
+            'snapshot_enabled': settings.get('snapshot_enabled', False),
+            'snapshot_full_resync': settings.get('snapshot_full_resync', False),
+            'write_rate': settings.get('write_rate', 1.0),
+            'write_burst': settings.get('write_burst', 3),
+            'write_concurrency': settings.get('write_concurrency', 1),
+            'folder_peer_limit': settings.get('folder_peer_limit', DEFAULT_FOLDER_PEER_LIMIT),
+            'folder_limit': settings.get('folder_limit', DEFAULT_FOLDER_LIMIT),
+            'dialogs_archived': settings.get('dialogs_archived', 'include'),
+            'max_dialogs': settings.get('max_dialogs'),
+            'verify_after_apply': settings.get('verify_after_apply', False),
+            'classify_processes': settings.get('classify_processes', 1),
+            'classify_cache': settings.get('classify_cache', False),
+            'classify_parallel_threshold': settings.get(
+                'classify_parallel_threshold', DEFAULT_CLASSIFY_PARALLEL_THRESHOLD
+            ),
+            'metrics_file': settings.get('metrics_file'),
+            'profile_patterns': settings.get('profile_patterns', False),
+            'details_batch': settings.get('details_batch', DEFAULT_DETAILS_BATCH),
+            'details_rate': settings.get('details_rate', 1.0),
+            'details_ttl': settings.get('details_ttl', DEFAULT_DETAILS_TTL),
+            'entity_store': settings.get('entity_store'),
+            'metrics_prometheus_file': settings.get('metrics_prometheus_file')
         }
 
-        folders_cfg = cfg.get('folders', {})
+        folders_cfg = cfg.get('folders') or {}
+        if not isinstance(folders_cfg, dict):
+            raise ValueError('Секция folders должна быть словарём "название папки: параметры"')
         include_patterns: Dict[str, List[str]] = {}
         exclude_patterns: Dict[str, List[str]] = {}
 
         for name, params in folders_cfg.items():
+            params = params or {}
             inc = params.get('include_patterns', [])
             exc = params.get('exclude_patterns', [])
             if not isinstance(inc, list):
@@ -94,42 +716,303 @@ class ConfigLoader:
 
         return include_patterns, exclude_patterns, export_settings
 
-
-class ChatMatcher:
     @staticmethod
-    def match_primary(
-            chat_title: str,
-            include_patterns: Dict[str, List[str]],
-            exclude_patterns: Dict[str, List[str]]
-    ) -> Optional[str]:
-        title = chat_title.lower()
-        for folder, inc_pats in include_patterns.items():
-            # проверка исключений
-            skip = False
-            for pat in exclude_patterns.get(folder, []):
-                if not pat:
-                    continue
-                try:
-                    if re.search(pat.lower(), title):
-                        skip = True
-                        break
-                except re.error:
-                    if pat.lower() in title:
-                        skip = True
-                        break
-            if skip:
+    def _parse_predicates(cfg: Dict) -> Dict[str, ChatPredicates]:
+        predicates: Dict[str, ChatPredicates] = {}
+        for name, params in (cfg.get('folders') or {}).items():
+            where = (params or {}).get('where')
+            if not where:
                 continue
-            # проверка включений
-            for pat in inc_pats:
-                if not pat:
-                    continue
-                try:
-                    if re.search(pat.lower(), title):
-                        return folder
-                except re.error:
-                    if pat.lower() in title:
-                        return folder
-        return None
+            if not isinstance(where, dict):
+                raise ValueError(f'Папка "{name}": where должен быть словарём условий')
+            predicates[name] = ChatPredicates(name, where)
+        return predicates
+
+
+class ChatClassifier:
+    """
+    Раскладывает чаты по папкам по мере поступления, не дожидаясь всего списка диалогов.
+    Чаты из кэша решаются сразу, остальные копятся; когда add() сообщает, что набралась пачка
+    из flush_size названий, её сопоставляют flush() или flush_async() (пул процессов executor
+    не блокирует цикл событий). finish() возвращает результат в порядке поступления.
+    Если у папок есть условия where, чаты сопоставляются по одному вместе с полями; те, кому
+    не хватает числа участников, откладываются в undecided до finish().
+    """
+
+    def __init__(
+            self,
+            config: CompiledConfig,
+            cache: Optional[ClassificationCache] = None,
+            flush_size: int = CLASSIFY_FLUSH_SIZE,
+            metrics: Optional[RunMetrics] = None,
+            executor: Optional[Executor] = None
+    ):
+        self.config = config
+        self.cache = cache
+        self.flush_size = flush_size
+        self.metrics = metrics
+        self.executor = executor
+        self.chats: List[ChatInfo] = []
+        self._assigned: Dict[int, Optional[str]] = {}
+        self._hashes: Dict[int, int] = {}
+        self._known = cache.load() if cache is not None else {}
+        self._pending: List[ChatInfo] = []
+        self._store: List[tuple] = []
+        self.undecided: List[ChatInfo] = []
+        # Проверки паттернов считаются в метриках этого запуска, а не в общем матчере
+        self._stats = metrics.pattern_evaluations if metrics is not None else None
+
+    def add(self, ci: ChatInfo) -> bool:
+        """Добавляет чат; True — набралась пачка, пора вызвать flush()"""
+        self.chats.append(ci)
+        if self.cache is not None:
+            h = self._hashes[ci.id] = title_hash(ci.title)
+            entry = self._known.get(ci.id)
+            if entry and entry[0] == h:
+                self._decide(ci.id, entry[1])
+                return False
+        self._pending.append(ci)
+        return len(self._pending) >= self.flush_size
+
+    def flush(self):
+        if not self._pending:
+            return
+        settings = self.config.settings
+        matcher = self.config.matcher
+        with self.metrics.phase('classify') if self.metrics else nullcontext():
+            if matcher.predicates:
+                folders = [matcher.match(ci.title, ci, stats=self._stats) for ci in self._pending]
+            else:
+                folders = matcher.match_batch(
+                    [ci.title for ci in self._pending],
+                    processes=settings.get('classify_processes', 1),
+                    threshold=settings.get('classify_parallel_threshold', DEFAULT_CLASSIFY_PARALLEL_THRESHOLD),
+                    stats=self._stats,
+                    executor=self.executor
+                )
+        self._settle(folders)
+
+    async def flush_async(self):
+        """Как flush(), но пачка для пула процессов разбирается, не блокируя цикл событий"""
+        matcher = self.config.matcher
+        if not self._pending or matcher.predicates:
+            self.flush()
+            return
+        settings = self.config.settings
+        with self.metrics.phase('classify') if self.metrics else nullcontext():
+            folders = await matcher.match_batch_async(
+                [ci.title for ci in self._pending],
+                self.executor,
+                processes=settings.get('classify_processes', 1),
+                threshold=settings.get('classify_parallel_threshold', DEFAULT_CLASSIFY_PARALLEL_THRESHOLD),
+                stats=self._stats
+            )
+        self._settle(folders)
+
+    def _settle(self, folders: List[Optional[str]]):
+        for ci, folder in zip(self._pending, folders):
+            if folder is ChatMatcher.UNDECIDED:
+                self.undecided.append(ci)
+                continue
+            self._decide(ci.id, folder)
+            if self.cache is not None:
+                self._store.append((ci.id, self._hashes[ci.id], folder))
+        self._pending = []
+
+    def _decide(self, chat_id: int, folder: Optional[str]):
+        self._assigned[chat_id] = folder
+        if self.metrics is not None:
+            self.metrics.mark_first_decision()
+
+    def finish(self) -> (Dict[str, Set[int]], List[ChatInfo]):
+        """
+        Досопоставляет остаток и обновляет кэш. Записи кэша о чатах, которых не было
+        среди добавленных, удаляются — поэтому добавлять нужно полный список чатов.
+        Отложенные чаты решаются с тем числом участников, которое удалось получить.
+        """
+        self.flush()
+        for ci in self.undecided:
+            self._decide(ci.id, self.config.matcher.match(ci.title, ci, final=True, stats=self._stats))
+        self.undecided = []
+        if self.cache is not None:
+            self.cache.store(self._store)
+            self.cache.forget(self._known.keys() - self._hashes.keys())
+            misses = len(self._store)
+            hits = len(self.chats) - misses
+            if self.metrics is not None:
+                self.metrics.cache_hits, self.metrics.cache_misses = hits, misses
+            ratio = hits / len(self.chats) if self.chats else 0
+            logger.info(f'🗃 Кэш классификации: {hits} из {len(self.chats)} чатов ({ratio:.0%}), пересчитано {misses}')
+
+        targets: Dict[str, Set[int]] = {name: set() for name in self.config.include_patterns}
+        unmatched: List[ChatInfo] = []
+        for ci in self.chats:
+            primary = self._assigned[ci.id]
+            if primary:
+                targets[primary].add(ci.id)
+            else:
+                unmatched.append(ci)
+        return targets, unmatched
+
+
+class RpcScheduler:
+    """
+    Очередь запросов к Telegram: записи папок (UpdateDialogFilterRequest) и пачки GetFullChannel.
+    Частота ограничивается token bucket, параллелизм — числом воркеров. FloodWaitError
+    приостанавливает всю очередь на время, указанное сервером, после чего запрос повторяется.
+    Ещё не отправленный запрос заменяется более новым с тем же ключом (например, запись в ту же папку).
+    """
+
+    def __init__(
+            self,
+            client,
+            rate: float = 1.0,
+            burst: int = 3,
+            concurrency: int = 1,
+            max_retries: int = 5,
+            on_flood_wait: Optional[Callable[[int], None]] = None,
+            name: str = 'записей папок'
+    ):
+        self.client = client
+        # Для логов: «в очереди <name>»
+        self.name = name
+        # Вызывается с длительностью каждого FLOOD_WAIT, который пережидает очередь
+        self.on_flood_wait = on_flood_wait
+        self.configure(rate=rate, burst=burst, concurrency=concurrency, max_retries=max_retries)
+        self._tokens = float(self.burst)
+        self._stamp: Optional[float] = None
+        self._blocked_until = 0.0
+        self._pending: Dict[Hashable, tuple] = {}
+        self._in_flight: Set[Hashable] = set()
+        # Будит воркеры, когда появился запрос или освободился ключ; set() синхронный — submit не ждёт
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self.flood_wait_seconds = 0
+        self.superseded = 0
+
+    def configure(self, rate: float = 1.0, burst: int = 3, concurrency: int = 1, max_retries: int = 5):
+        if rate <= 0 or burst < 1 or concurrency < 1:
+            raise ValueError(f'rate must be > 0, burst and concurrency must be >= 1 (очередь {self.name})')
+        self.rate = float(rate)
+        self.burst = int(burst)
+        self.concurrency = int(concurrency)
+        self.max_retries = int(max_retries)
+
+    @property
+    def queue_depth(self) -> int:
+        """Сколько запросов ждёт отправки или выполняется прямо сейчас"""
+        return len(self._pending) + len(self._in_flight)
+
+    def submit(self, key: Hashable, request) -> asyncio.Future:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        while len(self._workers) < self.concurrency:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+        future = asyncio.get_running_loop().create_future()
+        if key in self._pending:
+            # Старый запрос ещё не ушёл — его ожидающие получат результат нового
+            _, futures = self._pending.pop(key)
+            futures.append(future)
+            self.superseded += 1
+        else:
+            futures = [future]
+        self._pending[key] = (request, futures)
+        self._wakeup.set()
+        return future
+
+    async def _next_ready(self) -> Hashable:
+        while True:
+            key = next((k for k in self._pending if k not in self._in_flight), None)
+            if key is not None:
+                self._in_flight.add(key)
+                return key
+            # Между проверкой и clear() нет await: пропустить set() из submit воркер не может
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def _worker(self):
+        while True:
+            key = await self._next_ready()
+            request, futures = self._pending.pop(key)
+            try:
+                result = await self._send(request)
+            except Exception as e:
+                for f in futures:
+                    if not f.done():
+                        f.set_exception(e)
+            else:
+                for f in futures:
+                    if not f.done():
+                        f.set_result(result)
+            finally:
+                self._in_flight.discard(key)
+                self._wakeup.set()
+
+    async def _acquire_token(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            if self._stamp is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _send(self, request):
+        for attempt in range(self.max_retries + 1):
+            await self._acquire_token()
+            try:
+                # Порог 0: любой FLOOD_WAIT возвращается сюда и приостанавливает всю очередь,
+                # а не усыпляет один воркер внутри клиента
+                return await self.client(request, flood_sleep_threshold=0)
+            except FloodWaitError as e:
+                if attempt == self.max_retries:
+                    raise
+                self.flood_wait_seconds += e.seconds
+                if self.on_flood_wait is not None:
+                    self.on_flood_wait(e.seconds)
+                self._blocked_until = asyncio.get_running_loop().time() + e.seconds
+                logger.warning(f'⏳ FLOOD_WAIT: пауза {e.seconds} сек (в очереди {self.name}: {self.queue_depth})')
+
+    async def close(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        self._wakeup = None
+
+
+class TelegramBackend(Protocol):
+    """
+    Часть TelegramClient, которой пользуется менеджер. Позволяет подставить другой бэкенд,
+    например FakeTelegramClient из fake_client для профилирования без аккаунта.
+    """
+
+    async def start(self): ...
+
+    async def disconnect(self): ...
+
+    async def get_me(self): ...
+
+    async def get_entity(self, peer): ...
+
+    async def get_dialogs(self, limit: Optional[int] = None, folder: Optional[int] = None): ...
+
+    def iter_dialogs(
+            self, limit: Optional[int] = None, folder: Optional[int] = None, archived: Optional[bool] = None
+    ): ...
+
+    def add_event_handler(self, callback, event=None): ...
+
+    def remove_event_handler(self, callback, event=None): ...
+
+    async def __call__(self, request, ordered: bool = False, flood_sleep_threshold: Optional[int] = None): ...
 
 
 class TelegramFolderManager:
@@ -137,21 +1020,81 @@ class TelegramFolderManager:
             self,
             unmatched_strategy: UnmatchedChatsStrategy = UnmatchedChatsStrategy.IGNORE,
             warn_on_duplicates: bool = True,
-            dry_run: bool = False
+            dry_run: bool = False,
+            session: Optional[str] = None,
+            api_id: Optional[int] = None,
+            api_hash: Optional[str] = None,
+            client: Optional[TelegramBackend] = None
     ):
+        # Явно переданные параметры аккаунта важнее значений из .env
         load_dotenv()
-        session = getenv('app_title', 'telegram_session')
-        api_id = getenv('app_api_id')
-        api_hash = getenv('app_api_hash')
-        if not api_id or not api_hash:
-            raise ValueError('API credentials not set')
-        self.client = TelegramClient(session, int(api_id), api_hash)
+        session = session or getenv('app_title', DEFAULT_SESSION)
+        if client is None:
+            api_id = api_id or getenv('app_api_id')
+            api_hash = api_hash or getenv('app_api_hash')
+            if not api_id or not api_hash:
+                raise ValueError('API credentials not set')
+            client = TelegramClient(session, int(api_id), api_hash)
+        self.client = client
+        self.session_name = session
+        self.folder_writes = RpcScheduler(self.client, on_flood_wait=self._count_flood_wait)
+        # Та же очередь с token bucket — для GetFullChannel по условиям where
+        self.details = RpcScheduler(self.client, on_flood_wait=self._count_flood_wait, name='GetFullChannel')
+        self.details_batch = DEFAULT_DETAILS_BATCH
+        self.details_ttl = DEFAULT_DETAILS_TTL
         self.strategy = unmatched_strategy
         self.warn_dupes = warn_on_duplicates
         self.dry_run = dry_run
+        self.folder_peer_limit = DEFAULT_FOLDER_PEER_LIMIT
+        self.folder_limit = DEFAULT_FOLDER_LIMIT
+        # Какие диалоги просматривать: None — все, False — без архива, True — только архив
+        self.dialogs_archived: Optional[bool] = None
+        self.max_dialogs: Optional[int] = None
         self._chat_map: Dict[int, ChatInfo] = {}
         self._folder_map: Dict[int, FolderInfo] = {}
-        self._chat_folders: Dict[int, List[str]] = defaultdict(list)
+        # id общих папок (DialogFilterChatlist): менеджер их не трогает, но они занимают id и место в лимите
+        self._chatlist_ids: Set[int] = set()
+        self._index = PeerFolderIndex()
+        # Шарды: подтверждённые записью (из реестра) и те, что учитывает текущий план
+        self._shards: Optional[Dict[int, str]] = None
+        self._plan_shards: Dict[int, str] = {}
+        # Папки конфига последнего плана: их названия шардам не достаются
+        self._config_folders: Set[str] = set()
+        self._snapshot: Optional[DialogSnapshot] = None
+        self._classify_cache: Optional[ClassificationCache] = None
+        self._details_cache: Optional[ChatDetailsCache] = None
+        # Пул процессов для сопоставления названий: живёт, пока жив менеджер, и пересоздаётся
+        # только при смене classify_processes
+        self._match_pool: Optional[ProcessPoolExecutor] = None
+        self._match_workers = 0
+        # Общий с tg_summarise_chat справочник сущностей (None — не вести)
+        self.entity_store_path: Optional[str] = entity_store_path(session=session)
+        self._entities: Optional[EntityStore] = None
+        # Метрики текущего (или последнего) запуска organize_chats_by_config
+        self.metrics: Optional[RunMetrics] = None
+        self._install_rpc_counter()
+
+    def _install_rpc_counter(self):
+        """
+        Оборачивает _call клиента — через него проходят все запросы TelegramClient,
+        включая внутренние (страницы iter_dialogs, get_entity), — и считает их в self.metrics.
+        """
+        call = getattr(self.client, '_call', None)
+        if call is None:
+            return
+
+        async def counted_call(sender, request, ordered=False, flood_sleep_threshold=None):
+            if self.metrics is not None:
+                self.metrics.count_request(request)
+            return await call(sender, request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold)
+
+        self.client._call = counted_call
+
+    def _count_flood_wait(self, seconds: int):
+        # FLOOD_WAIT считается там, где его пережидают, — в очередях записей:
+        # короткие паузы Telethon проспал бы внутри _call, и обёртка их бы не увидела
+        if self.metrics is not None:
+            self.metrics.count_flood_wait(seconds)
 
     async def __aenter__(self):
         await self.client.start()
@@ -162,37 +1105,260 @@ class TelegramFolderManager:
         return self
 
     async def __aexit__(self, *args):
+        await self.folder_writes.close()
+        await self.details.close()
         await self.client.disconnect()
+        self._close_match_pool()
+        if self._snapshot:
+            self._snapshot.close()
+            self._snapshot = None
+        if self._classify_cache:
+            self._classify_cache.close()
+            self._classify_cache = None
+        if self._details_cache:
+            self._details_cache.close()
+            self._details_cache = None
+        self._close_entity_store()
         if self.dry_run:
             logger.info('✔ Disconnected from Telegram (DRY RUN MODE)')
         else:
             logger.info('✔ Disconnected from Telegram')
 
-    async def get_chats(self) -> List[ChatInfo]:
-        dialogs = await self.client.get_dialogs()
-        out: List[ChatInfo] = []
-        for d in dialogs:
-            e = d.entity
-            if isinstance(e, (Channel, Chat)):
-                peer = InputPeerChannel(e.id, e.access_hash) if isinstance(e, Channel) else InputPeerChat(e.id)
-                title = e.title if isinstance(e.title, str) else e.title.text
-                ci = ChatInfo(
-                    id=e.id, title=title,
-                    access_hash=getattr(e, 'access_hash', None),
-                    is_megagroup=getattr(e, 'megagroup', False),
-                    is_channel=isinstance(e, Channel) and not getattr(e, 'megagroup', False),
-                    is_group=isinstance(e, Chat),
-                    input_peer=peer
-                )
-                out.append(ci)
+    @staticmethod
+    def _dialog_record(d) -> Optional[DialogRecord]:
+        date = getattr(d, 'date', None)
+        return TelegramFolderManager._entity_record(
+            d.entity, getattr(d.dialog, 'top_message', 0) or 0,
+            last_activity=int(date.timestamp()) if date else None
+        )
+
+    @staticmethod
+    def _entity_record(e, top_message: int = 0, last_activity: Optional[int] = None) -> Optional[DialogRecord]:
+        if not isinstance(e, (Channel, Chat)):
+            return None
+        title = e.title if isinstance(e.title, str) else e.title.text
+        if isinstance(e, Channel):
+            chat_type = 'megagroup' if getattr(e, 'megagroup', False) else 'channel'
+        else:
+            chat_type = 'group'
+        return DialogRecord(
+            id=e.id, title=title, type=chat_type,
+            access_hash=getattr(e, 'access_hash', None),
+            top_message=top_message,
+            username=getattr(e, 'username', None),
+            last_activity=last_activity,
+            participants=getattr(e, 'participants_count', None)
+        )
+
+    @staticmethod
+    def _chat_from_record(r: DialogRecord) -> ChatInfo:
+        return ChatInfo(
+            id=r.id, title=r.title, access_hash=r.access_hash, type=r.type,
+            username=r.username, last_activity=r.last_activity, participants=r.participants
+        )
+
+    def _iter_dialogs(self):
+        """Диалоги в пределах dialogs_archived и max_dialogs, постранично"""
+        return self.client.iter_dialogs(limit=self.max_dialogs, archived=self.dialogs_archived)
+
+    @property
+    def _partial_scope(self) -> bool:
+        # Просматривается не весь список диалогов — чаты вне него нельзя считать покинутыми
+        return self.dialogs_archived is not None or bool(self.max_dialogs)
+
+    async def _iter_dialog_records(self):
+        # Диалоги обрабатываются по мере получения страниц: объекты Telethon
+        # не копятся в списке, а пользователи и боты отбрасываются сразу
+        # (в справочник сущностей попадают и они — по ним tg_summarise_chat находит личные чаты)
+        store = self._entity_store()
+        async for d in self._iter_dialogs():
+            if store is not None:
+                store.add(d.entity)
+            r = self._dialog_record(d)
+            if r:
+                yield r
+        if store is not None:
+            store.flush()
+
+    def _entity_store(self) -> Optional[EntityStore]:
+        if self._entities is None and self.entity_store_path:
+            self._entities = EntityStore(self.entity_store_path)
+        return self._entities
+
+    def _close_entity_store(self):
+        if self._entities:
+            self._entities.close()
+            self._entities = None
+
+    async def _ingest_chats(
+            self,
+            config: CompiledConfig,
+            cache: Optional[ClassificationCache] = None,
+            chats: Optional[List[ChatInfo]] = None
+    ) -> (Dict[str, Set[int]], List[ChatInfo]):
+        """
+        Загружает чаты как get_chats и раскладывает их по папкам по ходу загрузки:
+        сопоставление очередной пачки не ждёт, пока придут остальные страницы.
+        Если chats уже загружены (снимок), раскладываются они. Чатам, которым для условий
+        where не хватило числа участников, оно дозапрашивается пачками, пока идёт загрузка.
+        """
+        settings = config.settings
+        flush_size = CLASSIFY_FLUSH_SIZE if chats is None else max(1, len(chats))
+        processes = settings.get('classify_processes', 1)
+        if chats is None and (processes or os.cpu_count() or 1) != 1:
+            # Пул процессов окупается только на больших пачках
+            flush_size = settings.get('classify_parallel_threshold', DEFAULT_CLASSIFY_PARALLEL_THRESHOLD)
+        classifier = ChatClassifier(
+            config, cache, flush_size=flush_size, metrics=self.metrics, executor=self._match_executor(settings)
+        )
+        known = self._cached_participants(config.matcher)
+        fetches: List[asyncio.Future] = []
+        sent = 0
+
+        async def stream():
+            if chats is not None:
+                for ci in chats:
+                    yield ci
+                return
+            async for r in self._iter_dialog_records():
+                ci = self._chat_from_record(r)
                 self._chat_map[ci.id] = ci
+                yield ci
+
+        async for ci in stream():
+            if ci.participants is None and ci.id in known:
+                ci.participants = known[ci.id]
+            if classifier.add(ci):
+                await classifier.flush_async()
+            while len(classifier.undecided) - sent >= self.details_batch:
+                batch = classifier.undecided[sent:sent + self.details_batch]
+                fetches.append(asyncio.ensure_future(self._fetch_participants(batch)))
+                sent += len(batch)
+        await classifier.flush_async()
+        if len(classifier.undecided) > sent:
+            fetches.append(asyncio.ensure_future(self._fetch_participants(classifier.undecided[sent:])))
+        if fetches:
+            fetched = sum(await asyncio.gather(*fetches))
+            logger.info(
+                f'👥 Число участников для условий where: запрошено для {len(classifier.undecided)} чатов, '
+                f'получено {fetched} (в кэше было {len(known)})'
+            )
+        return classifier.finish()
+
+    def _cached_participants(self, matcher: ChatMatcher) -> Dict[int, int]:
+        """Число участников из кэша GetFullChannel — только если оно нужно какому-то условию where"""
+        if not any(p.needs_participants for p in matcher.predicates.values()):
+            return {}
+        if self._details_cache is None:
+            self._details_cache = ChatDetailsCache.for_session(self.session_name)
+        return self._details_cache.load(self.details_ttl)
+
+    async def _fetch_participants(self, chats: List[ChatInfo]) -> int:
+        """
+        Запрашивает число участников каналов и супергрупп через GetFullChannel: по details_batch
+        запросов в одном контейнере, контейнеры — через очередь с ограничением частоты.
+        Полученные значения записываются в ChatInfo и в кэш; ошибки только логируются.
+        Возвращает, для скольких чатов число получено.
+        """
+        chats = [ci for ci in chats if ci.type != 'group']
+        if not chats:
+            return 0
+        batches = [chats[i:i + self.details_batch] for i in range(0, len(chats), self.details_batch)]
+        # Ключ — id чатов пачки: заменить друг друга могут только пачки с одинаковыми запросами
+        futures = [
+            self.details.submit(
+                tuple(ci.id for ci in batch), [GetFullChannelRequest(InputChannel(ci.id, ci.access_hash)) for ci in batch]
+            )
+            for batch in batches
+        ]
+        fetched = []
+        for batch, res in zip(batches, await asyncio.gather(*futures, return_exceptions=True)):
+            if isinstance(res, MultiError):
+                res = res.results
+            elif isinstance(res, Exception):
+                logger.warning(f'⚠ Не удалось получить число участников для {len(batch)} чатов: {res}')
+                continue
+            for ci, full in zip(batch, res):
+                count = getattr(getattr(full, 'full_chat', None), 'participants_count', None)
+                if count is not None:
+                    ci.participants = count
+                    fetched.append((ci.id, count))
+        if self._details_cache is None:
+            self._details_cache = ChatDetailsCache.for_session(self.session_name)
+        self._details_cache.store(fetched)
+        return len(fetched)
+
+    async def get_chats(self, use_snapshot: bool = False, full_resync: bool = False) -> List[ChatInfo]:
+        out: List[ChatInfo] = []
+        if use_snapshot:
+            for r in await self._sync_snapshot(full_resync):
+                out.append(self._chat_from_record(r))
+        else:
+            async for r in self._iter_dialog_records():
+                out.append(self._chat_from_record(r))
+        for ci in out:
+            self._chat_map[ci.id] = ci
         return out
 
+    async def _sync_snapshot(self, full_resync: bool) -> List[DialogRecord]:
+        """
+        Обновляет локальный снимок диалогов. Диалоги приходят отсортированными по последнему
+        сообщению (смена названия тоже создаёт сервисное сообщение), поэтому докачиваем их,
+        пока не встретим незакреплённый диалог, совпадающий со снимком.
+        Выход из чатов так не обнаруживается — для этого нужна полная пересинхронизация.
+        """
+        if self._snapshot is None:
+            self._snapshot = DialogSnapshot.for_session(self.session_name)
+        known = self._snapshot.load()
+
+        if full_resync or not known:
+            records = [r async for r in self._iter_dialog_records()]
+            store = self._entity_store()
+            if store is not None and known and not self._partial_scope:
+                # Чаты, пропавшие из полного списка диалогов, покинуты — их access_hash больше не нужен
+                left = known.keys() - {r.id for r in records}
+                store.forget(peer_id('chat' if known[cid].type == 'group' else 'channel', cid) for cid in left)
+            self._snapshot.replace_all(records)
+            self._snapshot.mark_synced(full=True)
+            logger.info(f'💾 Полная синхронизация снимка диалогов: {len(records)} групп/каналов')
+            return records
+
+        changed: List[DialogRecord] = []
+        scanned = 0
+        store = self._entity_store()
+        async for d in self._iter_dialogs():
+            scanned += 1
+            if store is not None:
+                store.add(d.entity)
+            r = self._dialog_record(d)
+            if r is None:
+                continue
+            old = known.get(r.id)
+            if old and old.top_message == r.top_message and old.title == r.title:
+                # Закреплённые диалоги идут вне порядка по дате — по ним не останавливаемся
+                if d.pinned:
+                    continue
+                break
+            changed.append(r)
+
+        if store is not None:
+            store.flush()
+        self._snapshot.upsert(changed)
+        self._snapshot.mark_synced(full=False)
+        logger.info(f'💾 Снимок диалогов обновлён: {len(changed)} изменений (просмотрено {scanned} диалогов)')
+        # Изменившиеся диалоги поднялись в начало списка, остальные сохраняют порядок снимка
+        fresh = {r.id for r in changed}
+        return changed + [r for cid, r in known.items() if cid not in fresh]
+
     async def get_folders(self) -> List[FolderInfo]:
         res = await self.client(GetDialogFiltersRequest())
         out: List[FolderInfo] = []
+        chatlists: Set[int] = set()
         for f in res.filters:
             if not isinstance(f, DialogFilter):
+                # У «Все чаты» (DialogFilterDefault) id нет
+                if getattr(f, 'id', None) is not None:
+                    chatlists.add(f.id)
                 continue
             title = f.title.text if hasattr(f.title, 'text') else str(f.title)
             fi = FolderInfo(
@@ -203,40 +1369,84 @@ class TelegramFolderManager:
             )
             out.append(fi)
             self._folder_map[fi.id] = fi
+        self._chatlist_ids = chatlists
         return out
 
     def _peer_id(self, p) -> Optional[int]:
-        return getattr(p, 'channel_id', None) or getattr(p, 'chat_id', None) or getattr(p, 'user_id', None)
+        return PeerFolderIndex.peer_id(p)
 
     async def _build_map(self):
-        self._chat_folders.clear()
-        for fi in await self.get_folders():
-            for p in fi.include_peers:
-                cid = self._peer_id(p)
-                if cid:
-                    self._chat_folders[cid].append(fi.title)
+        # Папки запрашиваются до очистки: если запрос не прошёл, прежнее состояние остаётся
+        folders = await self.get_folders()
+        self._index.clear()
+        self._folder_map.clear()
+        for fi in folders:
+            self._folder_map[fi.id] = fi
+            self._index.set_folder_peers(fi.id, fi.include_peers)
+        self._index.changed.clear()
+        self._save_folder_snapshot()
+
+    def _save_folder_snapshot(self):
+        """Сохраняет текущее состояние папок в снимок (если снимок используется)"""
+        if self._snapshot is not None:
+            self._snapshot.save_folders(
+                (FolderRecord(fi.id, fi.title, list(fi.include_peers)) for fi in self._folder_map.values()),
+                self._chatlist_ids
+            )
+
+    def _folder_checksums(self) -> Dict[int, str]:
+        """Контрольная сумма каждой папки: название и отсортированный состав"""
+        sums: Dict[int, str] = {}
+        for fid, fi in self._folder_map.items():
+            keys = sorted(repr(k) for k in self._index.peers(fid))
+            sums[fid] = hashlib.sha1('\n'.join([fi.title, *keys]).encode('utf-8')).hexdigest()
+        return sums
+
+    async def verify_folders(self) -> List[str]:
+        """
+        Перечитывает папки с сервера и сравнивает их контрольные суммы с локальной моделью.
+        Возвращает список расхождений; после проверки локальная модель совпадает с сервером.
+        """
+        if self.dry_run:
+            logger.info('[DRY RUN] Проверка папок пропущена: изменения не отправлялись')
+            return []
+
+        local = self._folder_checksums()
+        local_titles = {fid: fi.title for fid, fi in self._folder_map.items()}
+        await self._build_map()
+        remote = self._folder_checksums()
+
+        drift: List[str] = []
+        for fid in sorted(local.keys() | remote.keys()):
+            if fid not in remote:
+                drift.append(f'папки "{local_titles[fid]}" (ID={fid}) нет на сервере')
+            elif fid not in local:
+                drift.append(f'на сервере есть неизвестная папка "{self._folder_map[fid].title}" (ID={fid})')
+            elif local[fid] != remote[fid]:
+                drift.append(f'папка "{self._folder_map[fid].title}" (ID={fid}) отличается от ожидаемой')
+
+        if drift:
+            logger.warning(f'⚠ Состояние папок на сервере расходится с локальным ({len(drift)}):')
+            for d in drift:
+                logger.warning(f'  {d}')
+        else:
+            logger.info(f'✔ Проверка: все {len(remote)} папок совпадают с сервером')
+        return drift
 
     async def _find_duplicates(self) -> List[ChatDuplicateInfo]:
         dup: List[ChatDuplicateInfo] = []
-        for cid, titles in self._chat_folders.items():
-            if len(titles) > 1:
-                ci = self._chat_map[cid]
-                dup.append(ChatDuplicateInfo(ci.title, cid, titles))
+        for cid, fids in self._index.duplicates().items():
+            ci = self._chat_map.get(cid)
+            titles = [self._folder_map[fid].title for fid in fids if fid in self._folder_map]
+            dup.append(ChatDuplicateInfo(ci.title if ci else str(cid), cid, titles))
         return dup
 
     def _count_chats_in_folders(self) -> Dict[str, int]:
         """Подсчёт количества чатов в каждой папке"""
-        folder_counts = defaultdict(int)
-        for fi in self._folder_map.values():
-            chat_count = 0
-            for peer in fi.include_peers:
-                peer_id = self._peer_id(peer)
-                if peer_id and peer_id in self._chat_map:
-                    chat_info = self._chat_map[peer_id]
-                    if chat_info.is_group or chat_info.is_megagroup or chat_info.is_channel:
-                        chat_count += 1
-            folder_counts[fi.title] = chat_count
-        return dict(folder_counts)
+        return {
+            fi.title: sum(1 for cid in self._index.peers(fi.id) if cid in self._chat_map)
+            for fi in self._folder_map.values()
+        }
 
     def _print_folder_stats(self):
         """Вывод статистики по папкам"""
@@ -248,242 +1458,968 @@ class TelegramFolderManager:
         else:
             logger.info("📊 Папки не найдены")
 
-    async def export_folders_to_yaml(self, filename: str, dry_run: bool = False):
-        """Экспорт папок и чатов в YAML файл"""
-        export_data = {
-            'export_date': datetime.now().isoformat(),
-            'dry_run': dry_run,
-            'folders': {}
-        }
+    @staticmethod
+    def _chat_type(ci: ChatInfo) -> str:
+        return ci.type
 
+    def _iter_export_folders(self):
+        """Отдаёт папки по одной, чтобы экспорт не собирал всё в памяти"""
         for fi in self._folder_map.values():
             chats_list = []
-            for peer in fi.include_peers:
-                peer_id = self._peer_id(peer)
-                if peer_id and peer_id in self._chat_map:
-                    chat_info = self._chat_map[peer_id]
-                    chat_type = 'channel'
-                    if chat_info.is_group:
-                        chat_type = 'group'
-                    elif chat_info.is_megagroup:
-                        chat_type = 'megagroup'
-
+            for cid in self._index.peers(fi.id):
+                chat_info = self._chat_map.get(cid)
+                if chat_info:
                     chats_list.append({
                         'id': chat_info.id,
                         'title': chat_info.title,
-                        'type': chat_type
+                        'type': self._chat_type(chat_info)
                     })
-
-            export_data['folders'][fi.title] = {
+            chats_list.sort(key=lambda x: x['title'])
+            yield fi.title, {
                 'folder_id': fi.id,
                 'chats_count': len(chats_list),
-                'chats': sorted(chats_list, key=lambda x: x['title'])
+                'chats': chats_list
             }
 
-        # Сохранение в файл
-        with open(filename, 'w', encoding='utf-8') as f:
-            yaml.dump(export_data, f, allow_unicode=True, sort_keys=False, default_flow_style=False)
+    async def export_folders_to_yaml(self, filename: str, dry_run: bool = False):
+        """Экспорт папок и чатов в YAML файл"""
+        await self.export_folders(filename, dry_run=dry_run, fmt='yaml')
+
+    async def export_folders(self, filename: str, dry_run: bool = False, fmt: str = 'yaml'):
+        """
+        Потоковый экспорт папок и чатов: файл пишется по одной папке.
+        Форматы: yaml, jsonl (заголовок + строка на папку)
+        и msgpack (последовательность объектов: заголовок, затем по объекту на папку).
+        В yaml одноимённые папки различаются по ID в ключе: "Название (ID=5)".
+        """
+        header = {'export_date': datetime.now().isoformat(), 'dry_run': dry_run}
+
+        if fmt == 'yaml':
+            # Эмиттер на чистом Python: C-эмиттер libyaml экранирует эмодзи (\U0001F4C1) даже с allow_unicode
+            with open(filename, 'w', encoding='utf-8') as f:
+                yaml.dump(header, f, allow_unicode=True, sort_keys=False, default_flow_style=False)
+                if not self._folder_map:
+                    f.write('folders: {}\n')
+                else:
+                    f.write('folders:\n')
+                seen: Set[str] = set()
+                for title, data in self._iter_export_folders():
+                    if title in seen:
+                        logger.warning(f'⚠ Несколько папок с названием "{title}": в экспорт записана с ключом '
+                                       f'"{title} (ID={data["folder_id"]})"')
+                        title = f'{title} (ID={data["folder_id"]})'
+                    seen.add(title)
+                    # Каждая папка — отдельный документ со сдвигом на 2 пробела под ключом folders;
+                    # ширина уменьшена на сдвиг, чтобы переносы строк совпадали с обычным yaml.dump
+                    chunk = yaml.dump({title: data}, allow_unicode=True, sort_keys=False,
+                                      default_flow_style=False, width=78)
+                    f.writelines(
+                        '  ' + line if line.strip() else line
+                        for line in chunk.splitlines(keepends=True)
+                    )
+
+        elif fmt == 'jsonl':
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(header, ensure_ascii=False) + '\n')
+                for title, data in self._iter_export_folders():
+                    f.write(json.dumps({'folder': title, **data}, ensure_ascii=False) + '\n')
+
+        elif fmt == 'msgpack':
+            if msgpack is None:
+                raise ValueError('Для export_format=msgpack установите пакет msgpack: pip install msgpack')
+            packer = msgpack.Packer()
+            with open(filename, 'wb') as f:
+                f.write(packer.pack(header))
+                for title, data in self._iter_export_folders():
+                    f.write(packer.pack({'folder': title, **data}))
+
+        else:
+            raise ValueError(f'Неизвестный формат экспорта: {fmt} (ожидается yaml, jsonl или msgpack)')
 
         if dry_run:
             logger.info(f'📤 [DRY RUN] Экспортировано {len(self._folder_map)} папок в файл "{filename}"')
         else:
             logger.info(f'📤 Экспортировано {len(self._folder_map)} папок в файл "{filename}"')
 
+    def _apply_settings(self, settings: Dict):
+        # Устанавливаем режим dry-run и параметры очереди записей из конфига
+        self.dry_run = settings.get('dry_run', False)
+        self.folder_peer_limit = settings.get('folder_peer_limit', DEFAULT_FOLDER_PEER_LIMIT)
+        self.folder_limit = settings.get('folder_limit', DEFAULT_FOLDER_LIMIT)
+        scope = settings.get('dialogs_archived', 'include')
+        if scope not in DIALOG_ARCHIVE_SCOPES:
+            raise ValueError(f'Неизвестное значение dialogs_archived: {scope} (ожидается include, exclude или only)')
+        self.dialogs_archived = DIALOG_ARCHIVE_SCOPES[scope]
+        self.max_dialogs = settings.get('max_dialogs')
+        self.details_batch = settings.get('details_batch', DEFAULT_DETAILS_BATCH)
+        self.details_ttl = settings.get('details_ttl', DEFAULT_DETAILS_TTL)
+        self.details.configure(rate=settings.get('details_rate', 1.0))
+        path = entity_store_path(settings.get('entity_store'), self.session_name)
+        if path != self.entity_store_path:
+            self._close_entity_store()
+            self.entity_store_path = path
+        self.folder_writes.configure(
+            rate=settings.get('write_rate', 1.0),
+            burst=settings.get('write_burst', 3),
+            concurrency=settings.get('write_concurrency', 1)
+        )
+
     async def organize_chats_by_config(self, config_path: str):
-        include_pats, exclude_pats, settings = ConfigLoader.load_config(config_path)
+        metrics = self.metrics = RunMetrics(self.session_name)
 
-        # Устанавливаем режим dry-run из конфига
-        self.dry_run = settings.get('dry_run', False)
+        with metrics.phase('load_config'):
+            config = ConfigLoader.load(config_path)
+        settings = config.settings
+
+        self._apply_settings(settings)
 
         if self.dry_run:
             logger.warning('⚠️ DRY RUN MODE ENABLED - Никакие изменения не будут применены к Telegram')
 
-        chats = await self.get_chats()
-        await self._build_map()
+        matcher = config.matcher
+        cache = None
+        if settings.get('classify_cache', False) and matcher.predicates:
+            # Решение зависит не только от названия — кэш по названиям здесь неприменим
+            logger.info('ℹ️ В конфиге есть условия where — кэш классификации не используется')
+        elif settings.get('classify_cache', False):
+            if self._classify_cache is None:
+                self._classify_cache = ClassificationCache.for_session(self.session_name)
+            cache = self._classify_cache
+            if cache.bind(config.patterns_hash):
+                logger.info('↻ Правила папок изменились — кэш классификации сброшен')
+
+        if settings.get('snapshot_enabled', False):
+            with metrics.phase('get_chats'):
+                chats = await self.get_chats(
+                    use_snapshot=True,
+                    full_resync=settings.get('snapshot_full_resync', False)
+                )
+            targets, unmatched = await self._ingest_chats(config, cache=cache, chats=chats)
+        else:
+            # Время фазы classify входит и в get_chats: сопоставление идёт по мере загрузки страниц
+            with metrics.phase('get_chats'):
+                targets, unmatched = await self._ingest_chats(config, cache=cache)
+        metrics.folder_chats = {name: len(ids) for name, ids in targets.items()}
+        metrics.unmatched_chats = len(unmatched)
+
+        if settings.get('profile_patterns', False):
+            with metrics.phase('profile_patterns'):
+                self._profile_patterns(config)
+
+        with metrics.phase('build_map'):
+            await self._build_map()
 
         # Вывод статистики ДО обработки
         logger.info("📊 Статистика папок ПЕРЕД обработкой:")
         self._print_folder_stats()
 
         if self.warn_dupes:
-            dup = await self._find_duplicates()
+            with metrics.phase('find_duplicates'):
+                dup = await self._find_duplicates()
             if dup:
                 logger.warning('⚠ Дубликаты обнаружены:')
                 for d in dup:
                     logger.warning(f'  {d.chat_title}: {", ".join(d.folders)}')
 
-        targets: Dict[str, Set[int]] = {name: set() for name in include_pats}
-        unmatched: List[ChatInfo] = []
-
-        for ci in chats:
-            primary = ChatMatcher.match_primary(ci.title, include_pats, exclude_pats)
-            if primary:
-                targets[primary].add(ci.id)
-            else:
-                unmatched.append(ci)
-
-        for name, ids in targets.items():
-            await self._process_folder(name, ids)
-
-        await self._handle_unmatched(unmatched, unmatched_folder='Прочие')
+        with metrics.phase('plan'):
+            plan = self._plan_changes(targets, unmatched, unmatched_folder=UNMATCHED_FOLDER)
+        with metrics.phase('apply'):
+            await self._apply_plan(plan)
+        if not self.dry_run:
+            self._save_folder_snapshot()
 
-        # Обновляем карту и выводим статистику ПОСЛЕ обработки
-        await self._build_map()
+        # Локальная модель уже обновлена по подтверждённым записям — перечитывать папки не нужно
+        if settings.get('verify_after_apply', False):
+            with metrics.phase('verify'):
+                metrics.drift_folders = len(await self.verify_folders())
         logger.info("📊 Статистика папок ПОСЛЕ обработки:")
         self._print_folder_stats()
 
         # Экспорт если включён
         if settings.get('enabled', False):
-            await self.export_folders_to_yaml(
-                settings.get('filename', 'folders_export.yaml'),
-                dry_run=self.dry_run
+            with metrics.phase('export'):
+                await self.export_folders(
+                    settings.get('filename', 'folders_export.yaml'),
+                    dry_run=self.dry_run,
+                    fmt=settings.get('format', 'yaml')
+                )
+
+        metrics.finish()
+        self._report_metrics(metrics, settings)
+
+    def _profile_patterns(self, config: CompiledConfig):
+        """Профилирует правила на названиях текущих чатов и пишет отчёт рядом с экспортом"""
+        profile = PatternProfile(config.matcher, [ci.title for ci in self._chat_map.values()])
+        path = report_path(config.settings.get('filename', 'folders_export.yaml'))
+        profile.write(path)
+        logger.info(
+            f'🔬 Профиль паттернов: {len(profile.patterns)} паттернов, '
+            f'мёртвых {len(profile.with_status("dead"))}, затенённых {len(profile.with_status("shadowed"))}, '
+            f'бесполезных {len(profile.with_status("unused"))}; отчёт записан в "{path}"'
+        )
+        for e in profile.with_status('shadowed'):
+            logger.warning(
+                f'⚠ Папка "{e["folder"]}": "{e["pattern"]}" — все совпадения забирает папка "{e["shadowed_by"]}"'
             )
+        for e in profile.slowest(3):
+            logger.info(f'   🐢 {e["folder"]} / {e["kind"]} "{e["pattern"]}": {e["seconds"] * 1000:.1f} мс')
 
-    async def _process_folder(self, name: str, ids: Set[int]):
-        title_ent = TextWithEntities(text=name, entities=[])
-        peers = [self._chat_map[i].input_peer for i in ids if i in self._chat_map]
-        fi = next((f for f in self._folder_map.values() if f.title == name), None)
-
-        if fi:
-            cur = {self._peer_id(p) for p in fi.include_peers}
-            to_add = ids - cur
-            to_remove = cur - ids
-            if to_add or to_remove:
-                if not self.dry_run:
-                    df = DialogFilter(
-                        id=fi.id, title=title_ent,
-                        pinned_peers=[], include_peers=peers,
-                        exclude_peers=[], contacts=False,
-                        non_contacts=False, groups=False,
-                        broadcasts=False, bots=False,
-                        exclude_muted=False, exclude_read=False,
-                        exclude_archived=False, emoticon=None
-                    )
-                    await self.client(UpdateDialogFilterRequest(id=fi.id, filter=df))
-                    logger.info(f'✎ Updated folder "{name}" ({len(peers)} chats)')
-                else:
-                    logger.info(f'✎ [DRY RUN] Would update folder "{name}" ({len(peers)} chats)')
-        else:
-            nid = max(self._folder_map.keys(), default=1) + 1
-            if not self.dry_run:
-                df = DialogFilter(
-                    id=nid, title=title_ent,
-                    pinned_peers=[], include_peers=peers,
-                    exclude_peers=[], contacts=False,
-                    non_contacts=False, groups=False,
-                    broadcasts=False, bots=False,
-                    exclude_muted=False, exclude_read=False,
-                    exclude_archived=False, emoticon=None
-                )
-                await self.client(UpdateDialogFilterRequest(id=nid, filter=df))
-                logger.info(f'✚ Created folder "{name}" (ID={nid}, {len(peers)} chats)')
-            else:
-                logger.info(f'✚ [DRY RUN] Would create folder "{name}" (ID={nid}, {len(peers)} chats)')
+    def _report_metrics(self, metrics: RunMetrics, settings: Dict):
+        phases = ', '.join(f'{name} {sec:.2f}' for name, sec in metrics.phases.items())
+        logger.info(f'⏱ {metrics.total_seconds:.2f} сек ({phases}); '
+                    f'RPC: {sum(metrics.rpc_counts.values())}, FLOOD_WAIT: {metrics.flood_wait_seconds} сек')
+        # {session} в пути подставляется, чтобы аккаунты не перезаписывали отчёты друг друга
+        if settings.get('metrics_file'):
+            path = settings['metrics_file'].format(session=self.session_name)
+            metrics.write_json(path)
+            logger.info(f'📈 Метрики запуска записаны в "{path}"')
+        if settings.get('metrics_prometheus_file'):
+            path = settings['metrics_prometheus_file'].format(session=self.session_name)
+            metrics.write_prometheus(path)
+            logger.info(f'📈 Метрики Prometheus записаны в "{path}"')
 
-            self._folder_map[nid] = FolderInfo(
-                id=nid, title=name,
-                include_peers=peers,
-                pinned_peers=[], exclude_peers=[]
+    async def sync_snapshot(self, full_resync: bool = False):
+        """Обновляет снимок диалогов и папок для последующего офлайн-планирования"""
+        await self.get_chats(use_snapshot=True, full_resync=full_resync)
+        await self._build_map()
+        logger.info(f'💾 Снимок папок сохранён: {len(self._folder_map)} папок')
+
+    def _load_offline_state(self):
+        path = DialogSnapshot.path_for(self.session_name)
+        if not os.path.exists(path):
+            raise ValueError(f'Снимок "{path}" не найден: сначала выполните sync')
+        self._snapshot = DialogSnapshot(path)
+        if self._snapshot.get_meta('folders_synced') is None:
+            raise ValueError(f'В снимке "{path}" нет состояния папок: сначала выполните sync')
+
+        for r in self._snapshot.load().values():
+            ci = self._chat_from_record(r)
+            self._chat_map[ci.id] = ci
+        self._index.clear()
+        self._folder_map.clear()
+        for f in self._snapshot.load_folders():
+            self._folder_map[f.id] = FolderInfo(
+                id=f.id, title=f.title, include_peers=f.include_peers, pinned_peers=[], exclude_peers=[]
+            )
+            self._index.set_folder_peers(f.id, f.include_peers)
+        self._index.changed.clear()
+        self._chatlist_ids = set(self._snapshot.load_chatlist_ids())
+
+    def plan_offline(self, config_path: str, plan_path: str) -> List[FolderOperation]:
+        """
+        Строит план по снимку без подключения к Telegram и записывает его в plan_path:
+        для каждой папки — добавляемые пиры и id удаляемых, плюс контрольная сумма исходного состава.
+        """
+        config = ConfigLoader.load(config_path)
+        self._apply_settings(config.settings)
+        # План ничего не отправляет — операции логируются как в dry-run
+        self.dry_run = True
+        try:
+            self._load_offline_state()
+            synced = self._snapshot.get_meta('folders_synced')
+            logger.info(
+                f'📂 Офлайн-план по снимку от {synced}: {len(self._chat_map)} чатов, {len(self._folder_map)} папок'
             )
+            # Без подключения условия по числу участников опираются только на кэш GetFullChannel
+            known = self._cached_participants(config.matcher)
+            for ci in self._chat_map.values():
+                if ci.participants is None and ci.id in known:
+                    ci.participants = known[ci.id]
+            targets, unmatched = self._classify(list(self._chat_map.values()), config)
+            plan = self._plan_changes(targets, unmatched, unmatched_folder=UNMATCHED_FOLDER)
+            base = self._folder_checksums()
 
-        # Remove these chats from other folders
-        for other in list(self._folder_map.values()):
-            if other.title == name:
+            folders = []
+            for op in plan:
+                before = self._index.peers(op.folder_id) if self._index.has_folder(op.folder_id) else {}
+                after = {PeerFolderIndex.peer_key(op.folder_id, i, p): p for i, p in enumerate(op.include_peers)}
+                folders.append({
+                    'op': op.kind.value,
+                    'id': op.folder_id,
+                    'title': op.title,
+                    'base': base.get(op.folder_id),
+                    'add': [e for e in (encode_peer(after[k]) for k in after.keys() - before.keys()) if e],
+                    'remove': sorted(k for k in before.keys() - after.keys() if isinstance(k, int)),
+                    'shard_of': op.shard_of
+                })
+            with open(plan_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'version': 1,
+                    'created_at': datetime.now().isoformat(),
+                    'session': self.session_name,
+                    'config_hash': config.content_hash,
+                    'snapshot_synced_at': synced,
+                    'folders': folders
+                }, f, ensure_ascii=False, separators=(',', ':'))
+        finally:
+            if self._snapshot:
+                self._snapshot.close()
+                self._snapshot = None
+            if self._details_cache:
+                self._details_cache.close()
+                self._details_cache = None
+            self._close_match_pool()
+
+        for op in plan:
+            self._log_operation(op)
+        logger.info(f'📝 План записан в "{plan_path}": {len(plan)} операций')
+        return plan
+
+    async def apply_plan_file(self, plan_path: str, config_path: str):
+        """
+        Применяет план из plan_offline поверх текущего состояния папок на сервере:
+        один GetDialogFiltersRequest, затем только те записи, которые что-то меняют.
+        Если папка изменилась после построения плана, diff всё равно накладывается — с предупреждением.
+        """
+        with open(plan_path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != 1:
+            raise ValueError(f'Неподдерживаемая версия плана: {data.get("version")}')
+        if data.get('session') != self.session_name:
+            logger.warning(f'⚠ План построен для сессии "{data.get("session")}", а применяется к "{self.session_name}"')
+
+        config = ConfigLoader.load(config_path)
+        self._apply_settings(config.settings)
+        if config.content_hash != data.get('config_hash'):
+            logger.warning(f'⚠ "{config_path}" изменился после построения плана')
+
+        await self._build_map()
+        current = self._folder_checksums()
+        ops: List[FolderOperation] = []
+        for item in data['folders']:
+            fid, title = item['id'], item['title']
+            exists = self._index.has_folder(fid)
+            if item['op'] == FolderOperationType.DELETE.value:
+                if exists:
+                    ops.append(FolderOperation(
+                        FolderOperationType.DELETE, fid, title, [], removed=len(self._index.peers(fid))
+                    ))
                 continue
-            new_peers = [p for p in other.include_peers if self._peer_id(p) not in ids]
-            if len(new_peers) != len(other.include_peers):
-                removed_count = len(other.include_peers) - len(new_peers)
-
-                if not self.dry_run:
-                    if not new_peers:
-                        # Если папка стала пустой - удаляем её
-                        await self.client(UpdateDialogFilterRequest(id=other.id, filter=None))
-                        logger.info(f'− Deleted folder "{other.title}" because it became empty')
-                    else:
-                        # Иначе просто обновляем
-                        df = DialogFilter(
-                            id=other.id,
-                            title=TextWithEntities(text=other.title, entities=[]),
-                            pinned_peers=[], include_peers=new_peers,
-                            exclude_peers=[], contacts=False,
-                            non_contacts=False, groups=False,
-                            broadcasts=False, bots=False,
-                            exclude_muted=False, exclude_read=False,
-                            exclude_archived=False, emoticon=None
+            if item['op'] == FolderOperationType.CREATE.value and (
+                    fid in self._chatlist_ids or exists and self._folder_map[fid].title != title
+            ):
+                # ID заняли папкой, созданной после построения плана, — берём свободный
+                taken = [
+                    *self._folder_map, *self._chatlist_ids,
+                    *(i['id'] for i in data['folders']), *(op.folder_id for op in ops)
+                ]
+                owner = self._folder_map[fid].title if exists else 'общей папкой'
+                logger.warning(f'⚠ ID={fid} уже занят: {owner}, "{title}" получит новый ID')
+                fid, exists = _free_folder_id(taken), False
+                if fid is None:
+                    logger.error(f'✗ Для папки "{title}" не осталось свободного ID, пропускаем')
+                    continue
+            if item['op'] == FolderOperationType.UPDATE.value and not exists:
+                logger.error(f'✗ Папка "{title}" (ID={fid}) удалена после построения плана, пропускаем')
+                continue
+            before = self._index.peers(fid) if exists else {}
+            peers = dict(before)
+            for key in item['remove']:
+                peers.pop(key, None)
+            for i, encoded in enumerate(item['add']):
+                peer = decode_peer(encoded)
+                peers.setdefault(PeerFolderIndex.peer_key(fid, len(before) + i, peer), peer)
+            if peers.keys() == before.keys():
+                continue
+            if exists and item['base'] and current.get(fid) != item['base']:
+                logger.warning(f'⚠ Папка "{title}" изменилась после построения плана, изменения накладываются поверх')
+            added = len(peers.keys() - before.keys())
+            removed = len(before.keys() - peers.keys())
+            if not peers:
+                ops.append(FolderOperation(FolderOperationType.DELETE, fid, title, [], removed=removed))
+            else:
+                kind = FolderOperationType.UPDATE if exists else FolderOperationType.CREATE
+                ops.append(FolderOperation(
+                    kind, fid, title, list(peers.values()), added=added, removed=removed, shard_of=item.get('shard_of')
+                ))
+
+        # Порядок как у _diff_plan: удаления, обновления, создания
+        order = [FolderOperationType.DELETE, FolderOperationType.UPDATE, FolderOperationType.CREATE]
+        ops.sort(key=lambda op: order.index(op.kind))
+        await self._apply_plan(ops)
+
+        if not self.dry_run and os.path.exists(DialogSnapshot.path_for(self.session_name)):
+            if self._snapshot is None:
+                self._snapshot = DialogSnapshot.for_session(self.session_name)
+            self._save_folder_snapshot()
+        return ops
+
+    def _classify(
+            self,
+            chats: List[ChatInfo],
+            config: CompiledConfig,
+            cache: Optional[ClassificationCache] = None
+    ) -> (Dict[str, Set[int]], List[ChatInfo]):
+        """
+        Раскладывает уже загруженные чаты по папкам. С кэшем правила прогоняются только для новых и
+        переименованных чатов; chats должен быть полным списком — остальные записи кэша удаляются.
+        """
+        # Весь список уже в памяти — сопоставляем одной пачкой, чтобы пул процессов получил её целиком
+        classifier = ChatClassifier(
+            config, cache, flush_size=max(1, len(chats)), metrics=self.metrics,
+            executor=self._match_executor(config.settings)
+        )
+        for ci in chats:
+            classifier.add(ci)
+        return classifier.finish()
+
+    def _match_executor(self, settings: dict) -> Optional[ProcessPoolExecutor]:
+        """Пул процессов под classify_processes; None — сопоставлять в текущем процессе"""
+        workers = settings.get('classify_processes', 1) or os.cpu_count() or 1
+        if workers == 1:
+            return None
+        if self._match_pool is None or self._match_workers != workers:
+            self._close_match_pool()
+            self._match_pool = ProcessPoolExecutor(max_workers=workers)
+            self._match_workers = workers
+        return self._match_pool
+
+    def _close_match_pool(self):
+        if self._match_pool is not None:
+            self._match_pool.shutdown()
+            self._match_pool = None
+            self._match_workers = 0
+
+    async def watch(self, config_path: str, debounce_seconds: float = 5.0, config_poll_seconds: float = 10.0):
+        """
+        Долгоживущий режим: после полной сортировки подписывается на обновления Telegram
+        (вступление/выход из чатов, смена названия, изменение папок в другом клиенте)
+        и пересортировывает только затронутые чаты. События копятся debounce_seconds,
+        после чего все изменения применяются одним планом. config.yaml перечитывается
+        при изменении mtime. Недописанный конфиг и сетевые ошибки не останавливают наблюдение:
+        остаются прежние правила, а несделанная пачка повторяется на следующем круге.
+        """
+        await self.organize_chats_by_config(config_path)
+        config = ConfigLoader.load(config_path)
+        config_mtime = os.path.getmtime(config_path)
+        me = await self.client.get_me()
+
+        dirty: Dict[int, type] = {}
+        gone: Set[int] = set()
+        folders_changed = False
+        wake = asyncio.Event()
+
+        async def on_chat_action(event):
+            if not (event.new_title or event.created or me.id in (event.user_ids or [])):
+                return
+            cid, peer_type = utils.resolve_id(event.chat_id)
+            if (event.user_left or event.user_kicked) and me.id in (event.user_ids or []):
+                gone.add(cid)
+            else:
+                dirty[cid] = peer_type
+            wake.set()
+
+        async def on_raw(update):
+            nonlocal folders_changed
+            if isinstance(update, (UpdateDialogFilter, UpdateDialogFilters)):
+                folders_changed = True
+            elif isinstance(update, UpdateChannel):
+                dirty[update.channel_id] = PeerChannel
+            else:
+                return
+            wake.set()
+
+        self.client.add_event_handler(on_chat_action, events.ChatAction())
+        self.client.add_event_handler(on_raw, events.Raw())
+        logger.info(f'👀 Режим наблюдения: изменения применяются пачками раз в {debounce_seconds:g} сек')
+
+        full_reclassify = False
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout=config_poll_seconds)
+                    # Даём накопиться соседним событиям, чтобы записать их одним планом
+                    await asyncio.sleep(debounce_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+
+                try:
+                    mtime = os.path.getmtime(config_path)
+                    if mtime != config_mtime:
+                        # Повторная попытка — при следующем сохранении файла
+                        config_mtime = mtime
+                        new_config = ConfigLoader.load(config_path)
+                        try:
+                            self._apply_settings(new_config.settings)
+                        except ValueError:
+                            self._apply_settings(config.settings)
+                            raise
+                        config = new_config
+                        full_reclassify = True
+                        logger.info(f'↻ Конфигурация "{config_path}" изменилась, правила перезагружены')
+                except (yaml.YAMLError, ValueError, OSError) as e:
+                    logger.error(f'❌ Конфигурация "{config_path}" не загружена, действуют прежние правила: {e}')
+
+                batch_dirty, batch_gone = dict(dirty), set(gone)
+                dirty.clear()
+                gone.clear()
+                try:
+                    if folders_changed:
+                        folders_changed = False
+                        await self._build_map()
+                        full_reclassify = True
+                        logger.info('↻ Папки изменены в другом клиенте, состояние перечитано')
+
+                    batch_gone |= await self._refresh_chats(batch_dirty)
+                    for cid in batch_gone:
+                        self._chat_map.pop(cid, None)
+
+                    if full_reclassify:
+                        targets, unmatched = await self._ingest_chats(config, chats=list(self._chat_map.values()))
+                        plan = self._plan_changes(targets, unmatched, UNMATCHED_FOLDER, gone=batch_gone)
+                    elif batch_dirty or batch_gone:
+                        assignments = await self._match_chats(
+                            [self._chat_map[cid] for cid in batch_dirty if cid in self._chat_map], config.matcher
                         )
-                        await self.client(UpdateDialogFilterRequest(id=other.id, filter=df))
-                        logger.info(f'− Removed {removed_count} chat(s) from "{other.title}" after moving to "{name}"')
-                else:
-                    if not new_peers:
-                        logger.info(f'− [DRY RUN] Would delete folder "{other.title}" because it became empty')
+                        plan = self._plan_reassign(assignments, batch_gone, UNMATCHED_FOLDER)
                     else:
-                        logger.info(
-                            f'− [DRY RUN] Would remove {removed_count} chat(s) from "{other.title}" after moving to "{name}"')
-                other.include_peers = new_peers
+                        plan = None
+
+                    if plan:
+                        await self._apply_plan(plan)
+                    full_reclassify = False
+                except (RPCError, OSError) as e:
+                    # ConnectionError и таймауты — подклассы OSError. Пачка возвращается в очередь,
+                    # папки перечитываются заново: часть записей могла уйти до ошибки
+                    logger.error(f'❌ Ошибка при обработке изменений, повтор через {config_poll_seconds:g} сек: {e}')
+                    for cid, peer_type in batch_dirty.items():
+                        dirty.setdefault(cid, peer_type)
+                    gone.update(batch_gone)
+                    folders_changed = True
+        finally:
+            self.client.remove_event_handler(on_chat_action)
+            self.client.remove_event_handler(on_raw)
+
+    async def _match_chats(self, chats: List[ChatInfo], matcher: ChatMatcher) -> Dict[int, Optional[str]]:
+        """Папки для нескольких чатов; число участников для условий where дозапрашивается"""
+        out = {ci.id: matcher.match(ci.title, ci) for ci in chats}
+        undecided = [ci for ci in chats if out[ci.id] is ChatMatcher.UNDECIDED]
+        if undecided:
+            await self._fetch_participants(undecided)
+            for ci in undecided:
+                out[ci.id] = matcher.match(ci.title, ci, final=True)
+        return out
+
+    async def _refresh_chats(self, ids: Dict[int, type]) -> Set[int]:
+        """Перечитывает затронутые чаты и обновляет _chat_map; возвращает id чатов, из которых мы вышли"""
+        gone: Set[int] = set()
+        store = self._entity_store()
+        for cid, peer_type in ids.items():
+            pid = peer_id('channel' if peer_type is PeerChannel else 'chat', cid)
+            # С access_hash из справочника чат не нужно искать в кэше сессии Telethon
+            stored = store.get(pid) if store is not None else None
+            try:
+                e = await self.client.get_entity(stored.input_peer if stored else peer_type(cid))
+            except (ValueError, RPCError) as exc:
+                logger.warning(f'⚠ Не удалось обновить чат {cid}: {exc}')
+                if stored and isinstance(exc, (ChannelInvalidError, ChannelPrivateError, ChatIdInvalidError)):
+                    store.forget([pid])
+                continue
+            if store is not None:
+                store.add(e)
+            # Событие о чате — само по себе сервисное сообщение, так что чат активен сейчас
+            record = self._entity_record(e, last_activity=int(time.time()))
+            if record is None or getattr(e, 'left', False) or getattr(e, 'deactivated', False):
+                gone.add(cid)
+                if store is not None:
+                    store.forget([pid])
+                continue
+            ci = self._chat_from_record(record)
+            old = self._chat_map.get(cid)
+            if ci.participants is None and old is not None:
+                ci.participants = old.participants
+            self._chat_map[cid] = ci
+        if store is not None:
+            store.flush()
+        return gone
+
+    def _make_filter(self, fid: int, title: str, peers: List[any]) -> DialogFilter:
+        return DialogFilter(
+            id=fid, title=TextWithEntities(text=title, entities=[]),
+            pinned_peers=[], include_peers=peers,
+            exclude_peers=[], contacts=False,
+            non_contacts=False, groups=False,
+            broadcasts=False, bots=False,
+            exclude_muted=False, exclude_read=False,
+            exclude_archived=False, emoticon=None
+        )
+
+    def _folder_id(
+            self,
+            planned: PeerFolderIndex,
+            titles: Dict[int, str],
+            name: str,
+            shard_of: Optional[str] = None
+    ) -> Optional[int]:
+        """
+        id папки по названию (шарды других папок не в счёт); новая папка получает наименьший
+        свободный id. None — новую папку создать нельзя: достигнут лимит числа папок.
+        Общие папки в titles не попадают, но их id заняты и в лимите они считаются.
+        """
+        if shard_of is None:
+            fid = next((i for i, t in titles.items() if t == name and i not in self._plan_shards), None)
+            if fid is not None:
+                return fid
+        fid = _free_folder_id([*titles, *self._chatlist_ids])
+        count = len(titles) + len(self._chatlist_ids)
+        if fid is None or (self.folder_limit and count >= self.folder_limit):
+            logger.warning(f'⚠ Папка "{name}" не создана: у аккаунта уже {count} папок, '
+                           f'лимит Telegram — {self.folder_limit or FOLDER_ID_MAX - FOLDER_ID_MIN + 1} (folder_limit)')
+            return None
+        titles[fid] = name
+        planned.set_folder(fid, ())
+        if shard_of is not None:
+            self._plan_shards[fid] = shard_of
+        return fid
+
+    @staticmethod
+    def _shard_title(name: str, k: int) -> str:
+        return name if k == 1 else f'{name} {k}'
 
-    async def _handle_unmatched(self, unmatched: List[ChatInfo], unmatched_folder: str):
-        if self.strategy == UnmatchedChatsStrategy.IGNORE:
+    @staticmethod
+    def _shard_number(title: str, name: str) -> Optional[int]:
+        """Номер шарда по названию "Name N" (N >= 2) или None"""
+        if title.startswith(name + ' '):
+            suffix = title[len(name) + 1:]
+            if suffix.isdigit() and int(suffix) >= 2:
+                return int(suffix)
+        return None
+
+    def _shard_ids(self) -> Dict[int, str]:
+        """Реестр шардов, созданных менеджером; читается при первом обращении"""
+        if self._shards is None:
+            self._shards = ShardRegistry.for_session(self.session_name).load()
+        return self._shards
+
+    def _save_shards(self):
+        # Шарды, удалённые или переименованные в другом клиенте, из реестра выбывают
+        shards = self._shard_ids()
+        for fid in list(shards):
+            fi = self._folder_map.get(fid)
+            if fi is None or self._shard_number(fi.title, shards[fid]) is None:
+                del shards[fid]
+        ShardRegistry.for_session(self.session_name).save(shards)
+
+    def _shard_group(self, titles: Dict[int, str], name: str) -> Dict[int, int]:
+        """
+        Шарды папки: номер → id папки ("Name" — 1, "Name 2" — 2, ...). Папки "Name N" считаются
+        шардами, только если их создал менеджер: одноимённые папки пользователя и конфига не трогаются.
+        """
+        group: Dict[int, int] = {}
+        for fid, title in titles.items():
+            if fid in self._plan_shards:
+                k = self._shard_number(title, name) if self._plan_shards[fid] == name else None
+                if k is not None:
+                    group.setdefault(k, fid)
+            elif title == name:
+                group.setdefault(1, fid)
+        return group
+
+    def _new_shard(self, planned: PeerFolderIndex, titles: Dict[int, str], name: str, after: int) -> Optional[tuple]:
+        """
+        Создаёт шард папки name с номером больше after и возвращает (номер, id папки).
+        Номера, чьи названия заняты другими папками или папками конфига, пропускаются.
+        None — упёрлись в лимит папок.
+        """
+        k = after + 1
+        if k == 1:
+            fid = self._folder_id(planned, titles, name)
+        else:
+            taken = set(titles.values()) | self._config_folders
+            while self._shard_title(name, k) in taken:
+                k += 1
+            fid = self._folder_id(planned, titles, self._shard_title(name, k), shard_of=name)
+        return None if fid is None else (k, fid)
+
+    def _place_in_shards(
+            self,
+            planned: PeerFolderIndex,
+            titles: Dict[int, str],
+            name: str,
+            items: List[tuple]
+    ):
+        """
+        Задаёт состав папки name целиком. Если чатов больше лимита Telegram на папку,
+        они раскладываются по шардам "Name", "Name 2", ... Чат, уже лежащий в одном
+        из шардов, остаётся в нём; новые чаты заполняют шарды по порядку, так что
+        повторные запуски не перекладывают чаты между шардами.
+        """
+        limit = self.folder_peer_limit
+        group = self._shard_group(titles, name)
+        if not limit or (len(items) <= limit and set(group) <= {1}):
+            fid = self._folder_id(planned, titles, name)
+            if fid is not None:
+                planned.set_folder(fid, items)
             return
 
-        title_ent = TextWithEntities(text=unmatched_folder, entities=[])
-        peers = [c.input_peer for c in unmatched]
+        home: Dict[any, int] = {}
+        for k, fid in sorted(group.items()):
+            for key in self._index.peers(fid):
+                home.setdefault(key, k)
+
+        shards: Dict[int, List[tuple]] = defaultdict(list)
+        new: List[tuple] = []
+        for key, peer in items:
+            k = home.get(key)
+            if k is not None and len(shards[k]) < limit:
+                shards[k].append((key, peer))
+            else:
+                new.append((key, peer))
+        order = sorted(group)
+        i = 0
+        for n, item in enumerate(new):
+            while i < len(order) and len(shards[order[i]]) >= limit:
+                i += 1
+            if i == len(order):
+                shard = self._new_shard(planned, titles, name, order[-1] if order else 0)
+                if shard is None:
+                    logger.warning(f'⚠ {len(new) - n} чатов папки "{name}" не разложены: не хватает папок')
+                    break
+                group[shard[0]] = shard[1]
+                order.append(shard[0])
+            shards[order[i]].append(item)
+
+        for k, fid in group.items():
+            planned.set_folder(fid, shards.get(k, []))
 
-        if self.strategy == UnmatchedChatsStrategy.LOG_ONLY:
+    def _fill_shards(
+            self,
+            planned: PeerFolderIndex,
+            titles: Dict[int, str],
+            name: str,
+            items: Iterable[tuple]
+    ):
+        """
+        Добавляет чаты (пары ключ, пир) в папку name, не трогая уже разложенные: чат, который есть
+        в одном из шардов, там и остаётся, остальные идут в первый шард со свободным местом.
+        Шарды ищутся один раз, заполненные пропускаются; когда место кончается, создаётся
+        следующий шард, а если папок больше создать нельзя — оставшиеся чаты пропускаются.
+        """
+        group = self._shard_group(titles, name)
+        shard_ids = set(group.values())
+        limit = self.folder_peer_limit
+        order = sorted(group)
+        i = 0
+        skipped = 0
+        for key, peer in items:
+            if not shard_ids.isdisjoint(planned.folders_of(key)):
+                continue
+            while i < len(order) and limit and len(planned.peers(group[order[i]])) >= limit:
+                i += 1
+            if i == len(order):
+                shard = None if skipped else self._new_shard(planned, titles, name, order[-1] if order else 0)
+                if shard is None:
+                    skipped += 1
+                    continue
+                group[shard[0]] = shard[1]
+                order.append(shard[0])
+                shard_ids.add(shard[1])
+            planned.add(group[order[i]], key, peer)
+        if skipped:
+            logger.warning(f'⚠ {skipped} чатов папки "{name}" не разложены: не хватает папок')
+
+    def _plan_unmatched(
+            self,
+            planned: PeerFolderIndex,
+            titles: Dict[int, str],
+            unmatched: List[ChatInfo],
+            unmatched_folder: str
+    ):
+        if self.strategy == UnmatchedChatsStrategy.LOG_ONLY and unmatched:
             logger.warning(f'Несопоставленные чаты ({len(unmatched)}):')
             for c in unmatched:
                 logger.warning(f'  {c.title}')
-            return
 
-        fi = next((f for f in self._folder_map.values() if f.title == unmatched_folder), None)
-        fid = fi.id if fi else max(self._folder_map.keys(), default=1) + 1
-
-        if self.strategy == UnmatchedChatsStrategy.MOVE_TO_FOLDER:
-            existing = fi.include_peers if fi else []
-            combined = existing + peers
-            unique, seen = [], set()
-            for p in combined:
-                pid = self._peer_id(p)
-                if pid and pid not in seen:
-                    seen.add(pid)
-                    unique.append(p)
-
-            if not self.dry_run:
-                df = DialogFilter(
-                    id=fid, title=title_ent,
-                    pinned_peers=[], include_peers=unique,
-                    exclude_peers=[], contacts=False,
-                    non_contacts=False, groups=False,
-                    broadcasts=False, bots=False,
-                    exclude_muted=False, exclude_read=False,
-                    exclude_archived=False, emoticon=None
-                )
-                await self.client(UpdateDialogFilterRequest(id=fid, filter=df))
-                logger.info(f'✚ Moved {len(peers)} unmatched chats to "{unmatched_folder}"')
-            else:
-                logger.info(f'✚ [DRY RUN] Would move {len(peers)} unmatched chats to "{unmatched_folder}"')
+        elif self.strategy == UnmatchedChatsStrategy.MOVE_TO_FOLDER and unmatched:
+            self._fill_shards(planned, titles, unmatched_folder, ((c.id, c.input_peer) for c in unmatched))
 
         elif self.strategy == UnmatchedChatsStrategy.REMOVE_FROM_FOLDERS:
-            rem = {c.id for c in unmatched}
-            total_removed = 0
-            for other in self._folder_map.values():
-                kept = [p for p in other.include_peers if self._peer_id(p) not in rem]
-                if len(kept) != len(other.include_peers):
-                    removed_count = len(other.include_peers) - len(kept)
-                    total_removed += removed_count
-                    if not self.dry_run:
-                        df = DialogFilter(
-                            id=other.id,
-                            title=TextWithEntities(text=other.title, entities=[]),
-                            pinned_peers=[], include_peers=kept,
-                            exclude_peers=[], contacts=False,
-                            non_contacts=False, groups=False,
-                            broadcasts=False, bots=False,
-                            exclude_muted=False, exclude_read=False,
-                            exclude_archived=False, emoticon=None
-                        )
-                        await self.client(UpdateDialogFilterRequest(id=other.id, filter=df))
+            for c in unmatched:
+                for other in list(planned.folders_of(c.id)):
+                    planned.discard(other, c.id)
+
+    def _plan_changes(
+            self,
+            targets: Dict[str, Set[int]],
+            unmatched: List[ChatInfo],
+            unmatched_folder: str,
+            gone: Set[int] = frozenset()
+    ) -> List[FolderOperation]:
+        """
+        Вычисляет итоговый состав всех папок поверх индекса (копия-при-записи) и сравнивает
+        затронутые папки с текущими. Возвращает минимальный упорядоченный список операций:
+        не больше одной записи на папку. Чаты из gone убираются из всех папок.
+        """
+        planned = self._index.overlay()
+        titles: Dict[int, str] = {fi.id: fi.title for fi in self._folder_map.values()}
+        self._plan_shards = dict(self._shard_ids())
+
+        for cid in gone:
+            for other in list(planned.folders_of(cid)):
+                planned.discard(other, cid)
+
+        self._config_folders = set(targets) | {unmatched_folder}
+        for name, ids in targets.items():
+            # Не создаём пустые папки: Telegram их всё равно не примет
+            if not ids and not self._shard_group(titles, name):
+                continue
+            group = set(self._shard_group(titles, name).values())
+            for i in ids:
+                for other in list(planned.folders_of(i)):
+                    if other not in group:
+                        planned.discard(other, i)
+            items = {i: self._chat_map[i].input_peer for i in sorted(ids) if i in self._chat_map}
+            if self._partial_scope:
+                # Чаты за пределами просмотренных диалогов остаются в папке как есть
+                for fid in sorted(group):
+                    for key, peer in planned.peers(fid).items():
+                        if key not in self._chat_map:
+                            items.setdefault(key, peer)
+            self._place_in_shards(planned, titles, name, list(items.items()))
+
+        self._plan_unmatched(planned, titles, unmatched, unmatched_folder)
+        return self._diff_plan(planned, titles)
+
+    def _plan_reassign(
+            self,
+            assignments: Dict[int, Optional[str]],
+            gone: Set[int],
+            unmatched_folder: str
+    ) -> List[FolderOperation]:
+        """
+        Инкрементальный вариант _plan_changes: переносит только перечисленные чаты
+        (id → папка или None) и убирает из всех папок чаты, которых больше нет.
+        """
+        planned = self._index.overlay()
+        titles: Dict[int, str] = {fi.id: fi.title for fi in self._folder_map.values()}
+        self._plan_shards = dict(self._shard_ids())
+        unmatched: List[ChatInfo] = []
+
+        for cid in gone:
+            for other in list(planned.folders_of(cid)):
+                planned.discard(other, cid)
+
+        for cid, name in assignments.items():
+            ci = self._chat_map.get(cid)
+            if ci is None:
+                continue
+            if name is None:
+                unmatched.append(ci)
+                continue
+            group = set(self._shard_group(titles, name).values())
+            for other in list(planned.folders_of(cid)):
+                if other not in group:
+                    planned.discard(other, cid)
+            self._fill_shards(planned, titles, name, [(cid, ci.input_peer)])
+
+        self._plan_unmatched(planned, titles, unmatched, unmatched_folder)
+        return self._diff_plan(planned, titles)
 
-            if not self.dry_run:
-                logger.info(f'− Removed {total_removed} unmatched chats from all folders')
+    def _diff_plan(self, planned: PeerFolderIndex, titles: Dict[int, str]) -> List[FolderOperation]:
+        deletes, updates, creates = [], [], []
+        for fid in sorted(planned.changed):
+            peers = planned.peers(fid)
+            if not self._index.has_folder(fid):
+                if peers:
+                    creates.append(FolderOperation(
+                        FolderOperationType.CREATE, fid, titles[fid],
+                        list(peers.values()), added=len(peers), shard_of=self._plan_shards.get(fid)
+                    ))
+                continue
+            before = self._index.peers(fid)
+            if before.keys() == peers.keys():
+                continue
+            added = len(peers.keys() - before.keys())
+            removed = len(before.keys() - peers.keys())
+            if not peers:
+                deletes.append(FolderOperation(
+                    FolderOperationType.DELETE, fid, titles[fid], [], removed=removed
+                ))
             else:
-                logger.info(f'− [DRY RUN] Would remove {total_removed} unmatched chats from all folders')
+                updates.append(FolderOperation(
+                    FolderOperationType.UPDATE, fid, titles[fid],
+                    list(peers.values()), added=added, removed=removed, shard_of=self._plan_shards.get(fid)
+                ))
+
+        # Удаления идут первыми: они освобождают место под лимит количества папок
+        return deletes + updates + creates
+
+    async def _apply_plan(self, plan: List[FolderOperation]):
+        """
+        Применяет план через планировщик записей (или только логирует его в режиме dry-run).
+        Удаления отправляются первыми, затем обновления и создания. Локальное состояние
+        меняется только по подтверждённым записям; ошибка одной записи не прерывает остальные.
+        """
+        if not plan:
+            prefix = '[DRY RUN] ' if self.dry_run else ''
+            logger.info(f'✔ {prefix}Папки уже соответствуют конфигурации, изменений нет')
+            return
+
+        if self.dry_run:
+            for op in plan:
+                self._log_operation(op)
+                self._apply_local(op)
+            return
+
+        try:
+            await self._write_plan(plan)
+        finally:
+            self._save_shards()
+
+    async def _write_plan(self, plan: List[FolderOperation]):
+        deletes = [op for op in plan if op.kind == FolderOperationType.DELETE]
+        writes = [op for op in plan if op.kind != FolderOperationType.DELETE]
+        for batch in (deletes, writes):
+            if not batch:
+                continue
+            futures = [
+                self.folder_writes.submit(op.folder_id, UpdateDialogFilterRequest(
+                    id=op.folder_id,
+                    filter=None if op.kind == FolderOperationType.DELETE
+                    else self._make_filter(op.folder_id, op.title, op.include_peers)
+                ))
+                for op in batch
+            ]
+            logger.info(f'📨 В очереди записи папок: {self.folder_writes.queue_depth}')
+            results = await asyncio.gather(*futures, return_exceptions=True)
+            for op, res in zip(batch, results):
+                if isinstance(res, Exception):
+                    logger.error(f'✗ Не удалось записать папку "{op.title}" (ID={op.folder_id}): {res}')
+                    continue
+                self._log_operation(op)
+                self._apply_local(op)
+
+    def _log_operation(self, op: FolderOperation):
+        prefix = '[DRY RUN] ' if self.dry_run else ''
+        if op.kind == FolderOperationType.DELETE:
+            verb = 'Would delete' if self.dry_run else 'Deleted'
+            logger.info(f'− {prefix}{verb} folder "{op.title}" because it became empty')
+        elif op.kind == FolderOperationType.CREATE:
+            verb = 'Would create' if self.dry_run else 'Created'
+            logger.info(
+                f'✚ {prefix}{verb} folder "{op.title}" (ID={op.folder_id}, {len(op.include_peers)} chats)'
+            )
+        else:
+            verb = 'Would update' if self.dry_run else 'Updated'
+            logger.info(
+                f'✎ {prefix}{verb} folder "{op.title}" '
+                f'({len(op.include_peers)} chats, +{op.added}/−{op.removed})'
+            )
+
+    def _apply_local(self, op: FolderOperation):
+        if op.kind == FolderOperationType.DELETE:
+            self._folder_map.pop(op.folder_id, None)
+            self._index.remove_folder(op.folder_id)
+            return
+        if op.shard_of is not None and not self.dry_run:
+            self._shard_ids()[op.folder_id] = op.shard_of
+        if op.kind == FolderOperationType.CREATE:
+            self._folder_map[op.folder_id] = FolderInfo(
+                id=op.folder_id, title=op.title,
+                include_peers=op.include_peers,
+                pinned_peers=[], exclude_peers=[]
+            )
+        else:
+            self._folder_map[op.folder_id].include_peers = op.include_peers
+        self._index.set_folder_peers(op.folder_id, op.include_peers)
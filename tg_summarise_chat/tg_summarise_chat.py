@@ -1,7 +1,12 @@
 # tg_summarise_chat.py
 
 import os
+import re
+import math
 import sys
+import json
+import hashlib
+import asyncio
 import argparse
 import yaml
 from typing import List, Dict, Optional, Union
@@ -10,10 +15,19 @@ import logging
 from pathlib import Path
 
 from dotenv import load_dotenv
-from telethon import TelegramClient
+from telethon import TelegramClient, utils
+from telethon.errors import ChannelInvalidError, ChannelPrivateError, ChatIdInvalidError, PeerIdInvalidError
+from telethon.tl.functions.messages import GetDialogFiltersRequest
 from telethon.tl.types import Message
 import httpx
 
+try:
+    import h2  # noqa: F401
+except ImportError:  # необязательная зависимость, нужна только для HTTP/2 (pip install httpx[http2])
+    h2 = None
+
+from tg_folder_manager.entity_store import EntityStore, entity_store_path
+
 # Загружаем переменные окружения
 load_dotenv()
 
@@ -24,6 +38,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Сколько чатов одновременно загружается из Telegram в пакетном режиме
+DEFAULT_TELEGRAM_CONCURRENCY = 3
+
+# Сколько токенов переписки отправлять в LLM за раз (с запасом для промпта и ответа в контексте 4096)
+DEFAULT_CHUNK_TOKENS = 3000
+# Грубая оценка без токенизатора: для русского текста токен в среднем короче, чем для английского
+DEFAULT_CHARS_PER_TOKEN = 3.0
+
+DEFAULT_INSTRUCTION = "Создай краткое резюме:"
+MAP_INSTRUCTION = "Создай краткое резюме части диалога за день (часть {part} из {total}):"
+REDUCE_INSTRUCTION = (
+    "Ниже резюме последовательных частей одного диалога за день. "
+    "Объедини их в одно краткое резюме без повторов:"
+)
+
+# Начало строки сообщения в format_for_llm: "[HH:MM:SS] отправитель: текст"
+_MESSAGE_START = re.compile(r'\n(?=\[(?:\d\d:\d\d:\d\d|N/A)\] )')
+
 
 def get_local_timezone_offset() -> timezone:
     """
@@ -46,6 +78,17 @@ def get_local_timezone_offset() -> timezone:
     return timezone(offset)
 
 
+def _chat_key(chat_identifier) -> Union[str, int]:
+    """Идентификатор чата для вывода: как передан, а для InputPeer — id с меткой типа."""
+    if isinstance(chat_identifier, (str, int)):
+        return chat_identifier
+    try:
+        return utils.get_peer_id(chat_identifier)
+    except (TypeError, ValueError):
+        # Например, InputPeerSelf («Избранное»)
+        return type(chat_identifier).__name__
+
+
 class TelegramConfig:
     """Конфигурация для подключения к Telegram API."""
 
@@ -55,6 +98,8 @@ class TelegramConfig:
         self.app_title = os.getenv('app_title')
         self.app_short_name = os.getenv('app_short_name')
         self.session_name = self.app_short_name or 'session'
+        # Справочник сущностей, общий с tg_folder_manager: тот же ключ entity_store и тот же путь по умолчанию
+        self.entity_store = entity_store_path()
 
         self._validate()
 
@@ -80,12 +125,23 @@ class LMStudioConfig:
         self.temperature = None
         self.max_tokens = None
         self.timeout_seconds = None
+        # Сколько запросов к LLM выполнять одновременно в пакетном режиме
+        self.concurrency = None
+        # HTTP/2 для LLM API (если установлен пакет h2 и сервер его поддерживает)
+        self.http2 = None
+        # Map-reduce для длинных переписок: размер части в токенах (0 — не делить),
+        # сколько частей суммаризировать одновременно и оценка числа символов на токен
+        self.chunk_tokens = None
+        self.chunk_concurrency = None
+        self.chars_per_token = None
 
         # Для GigaChat
         self.gigachat_auth_method = None  # "credentials" или "token"
         self.gigachat_client_id = None
         self.gigachat_secret = None
         self.gigachat_token = None
+        # Файл, где access token GigaChat хранится до истечения срока
+        self.gigachat_token_cache = None
 
         self._load_config()
 
@@ -122,6 +178,11 @@ class LMStudioConfig:
         self.temperature = llm_config.get('temperature')
         self.max_tokens = llm_config.get('max_tokens')
         self.timeout_seconds = llm_config.get('timeout_seconds')
+        self.concurrency = llm_config.get('concurrency')
+        self.http2 = bool(llm_config.get('http2', True))
+        self.chunk_tokens = llm_config.get('chunk_tokens')
+        self.chunk_concurrency = llm_config.get('chunk_concurrency')
+        self.chars_per_token = llm_config.get('chars_per_token')
 
         if not self.model:
             raise ValueError(
@@ -133,6 +194,14 @@ class LMStudioConfig:
             self.temperature = float(self.temperature) if self.temperature is not None else 0.3
             self.max_tokens = int(self.max_tokens) if self.max_tokens is not None else 500
             self.timeout_seconds = float(self.timeout_seconds) if self.timeout_seconds is not None else 3600.0
+            self.concurrency = max(1, int(self.concurrency)) if self.concurrency is not None else 1
+            self.chunk_tokens = int(self.chunk_tokens) if self.chunk_tokens is not None else DEFAULT_CHUNK_TOKENS
+            self.chunk_concurrency = (
+                max(1, int(self.chunk_concurrency)) if self.chunk_concurrency is not None else self.concurrency
+            )
+            self.chars_per_token = (
+                float(self.chars_per_token) if self.chars_per_token is not None else DEFAULT_CHARS_PER_TOKEN
+            )
         except (ValueError, TypeError) as e:
             raise ValueError(f"Ошибка конфигурации: параметры должны быть числами: {e}")
 
@@ -158,6 +227,11 @@ class LMStudioConfig:
                     raise ValueError("Для auth.method=token требуется token")
             else:
                 raise ValueError("auth.method должен быть 'credentials' или 'token'")
+            # По умолчанию — в пользовательском кэше, вне проекта, чтобы токен не попал в репозиторий;
+            # false отключает кэш
+            cache_home = Path(os.getenv('XDG_CACHE_HOME') or Path.home() / '.cache')
+            token_cache = auth.get('token_cache', str(cache_home / 'tg_summarise_chat' / 'gigachat_token.json'))
+            self.gigachat_token_cache = Path(token_cache) if token_cache else None
 
         logger.info(f"✓ Конфигурация LLM загружена из {self.config_path}")
         logger.info(f"  • Type: {self.llm_type}")
@@ -167,6 +241,10 @@ class LMStudioConfig:
         logger.info(f"  • Temperature: {self.temperature}")
         logger.info(f"  • Max tokens: {self.max_tokens}")
         logger.info(f"  • Timeout: {self.timeout_seconds} сек ({self.timeout_seconds / 60:.0f} мин)")
+        logger.info(f"  • Concurrency: {self.concurrency}")
+        logger.info(f"  • HTTP/2: {'да' if self.http2 and h2 is not None else 'нет'}")
+        if self.chunk_tokens > 0:
+            logger.info(f"  • Chunks: до {self.chunk_tokens} токенов, параллельно {self.chunk_concurrency}")
 
 
 class TelegramMessageExtractor:
@@ -175,6 +253,7 @@ class TelegramMessageExtractor:
     def __init__(self, tg_config: TelegramConfig):
         self.tg_config = tg_config
         self.client = None
+        self.entities: Optional[EntityStore] = None
 
     async def _connect(self):
         """Подключается к Telegram API."""
@@ -186,13 +265,102 @@ class TelegramMessageExtractor:
             )
             await self.client.start()
             logger.info("✓ Подключено к Telegram API")
+        if self.entities is None and self.tg_config.entity_store:
+            self.entities = EntityStore(self.tg_config.entity_store)
 
     async def disconnect(self):
         """Отключается от Telegram API."""
+        if self.entities:
+            self.entities.close()
+            self.entities = None
         if self.client:
             await self.client.disconnect()
             logger.info("✓ Отключено от Telegram API")
 
+    async def _resolve_chat(self, chat_identifier: Union[str, int], use_store: bool = True) -> tuple:
+        """
+        Находит чат: сначала в справочнике сущностей (без запросов к Telegram), затем через get_entity.
+
+        Returns:
+            tuple: (InputPeer или сущность, Название чата, id записи справочника или None)
+        """
+        # InputPeer (например, из папки) ищется в справочнике по id; у InputPeerSelf его нет
+        key = _chat_key(chat_identifier)
+        if not isinstance(chat_identifier, (str, int)) and not isinstance(key, int):
+            key = None
+        stored = self.entities.lookup(key) if self.entities and use_store and key is not None else None
+        if stored:
+            logger.info(f"✓ Найден чат: {stored.name} (справочник сущностей)")
+            return stored.input_peer, stored.name, stored.peer_id
+
+        chat = await self.client.get_entity(chat_identifier)
+        if self.entities:
+            self.entities.remember([chat])
+        chat_name = self._get_chat_name(chat)
+        logger.info(f"✓ Найден чат: {chat_name}")
+        return chat, chat_name, None
+
+    async def get_folder_peers(self, folder_name: str) -> list:
+        """
+        Возвращает чаты папки Telegram (закреплённые и явно добавленные) по её названию.
+
+        Args:
+            folder_name: Название папки
+
+        Returns:
+            list: InputPeer чатов папки
+
+        Raises:
+            ValueError: Если папка не найдена
+        """
+        await self._connect()
+        result = await self.client(GetDialogFiltersRequest())
+        filters = [f for f in getattr(result, 'filters', result) if hasattr(f, 'include_peers')]
+
+        def title(f) -> str:
+            return f.title.text if hasattr(f.title, 'text') else str(f.title)
+
+        folder = next((f for f in filters if title(f) == folder_name), None) or next(
+            (f for f in filters if title(f).lower() == folder_name.lower()), None
+        )
+        if folder is None:
+            available = ", ".join(title(f) for f in filters) or "нет"
+            raise ValueError(f"Папка '{folder_name}' не найдена (есть: {available})")
+
+        if any(getattr(folder, flag, False) for flag in ('contacts', 'non_contacts', 'groups', 'broadcasts', 'bots')):
+            logger.warning(f"⚠ Папка '{folder_name}' включает чаты по типам — обрабатываются только добавленные явно")
+
+        peers, seen = [], set()
+        for peer in list(folder.pinned_peers) + list(folder.include_peers):
+            try:
+                pid = utils.get_peer_id(peer)
+            except (TypeError, ValueError):
+                # Например, InputPeerSelf («Избранное») — id у него нет
+                pid = type(peer).__name__
+            if pid not in seen:
+                seen.add(pid)
+                peers.append(peer)
+        logger.info(f"✓ Папка '{title(folder)}': {len(peers)} чатов")
+        return peers
+
+    async def _collect_messages(self, chat, start_utc: datetime, end_utc: datetime) -> List[Message]:
+        """Сообщения чата в интервале [start_utc, end_utc) в хронологическом порядке."""
+        messages = []
+        async for message in self.client.iter_messages(
+                chat,
+                offset_date=end_utc,
+                reverse=False
+        ):
+            # Останавливаемся при достижении начала дня
+            if message.date < start_utc:
+                break
+
+            messages.append(message)
+
+        # Разворачиваем для хронологического порядка
+        messages.reverse()
+        return messages
+
     async def get_today_messages(
             self,
             chat_identifier: Union[str, int]
@@ -227,29 +395,24 @@ class TelegramMessageExtractor:
         tomorrow_start_local = today_start_local + timedelta(days=1)
         tomorrow_start_utc = tomorrow_start_local.astimezone(timezone.utc)
 
-        messages = []
-
         try:
-            chat = await self.client.get_entity(chat_identifier)
-
-            # Получаем название чата для отображения
-            chat_name = self._get_chat_name(chat)
-            logger.info(f"✓ Найден чат: {chat_name}")
+            chat, chat_name, stored_id = await self._resolve_chat(chat_identifier)
 
             # Получаем сообщения за текущий день
-            async for message in self.client.iter_messages(
-                    chat,
-                    offset_date=tomorrow_start_utc,
-                    reverse=False
-            ):
-                # Останавливаемся при достижении начала дня
-                if message.date < today_start_utc:
-                    break
-
-                messages.append(message)
-
-            # Разворачиваем для хронологического порядка
-            messages.reverse()
+            try:
+                messages = await self._collect_messages(chat, today_start_utc, tomorrow_start_utc)
+            except (ChannelInvalidError, ChannelPrivateError, ChatIdInvalidError, PeerIdInvalidError):
+                if stored_id is None:
+                    raise
+                # Запись устарела (вышли из чата, сменился access_hash) — удаляем и ищем через Telegram
+                logger.warning(f"⚠ Запись справочника для '{chat_identifier}' устарела, ищу чат через Telegram")
+                self.entities.forget([stored_id])
+                chat, chat_name, _ = await self._resolve_chat(chat_identifier, use_store=False)
+                messages = await self._collect_messages(chat, today_start_utc, tomorrow_start_utc)
+
+            # Отправители приходят вместе с сообщениями — запоминаем их для следующих запусков
+            if self.entities:
+                self.entities.remember(m.sender for m in messages if getattr(m, 'sender', None))
 
             logger.info(f"✓ Получено сообщений: {len(messages)}")
             return messages, chat_name
@@ -295,23 +458,26 @@ class TelegramMessageExtractor:
 class MessageFormatter:
     """Класс для форматирования сообщений для LLM."""
 
-    def __init__(self, client: TelegramClient):
+    def __init__(self, client: TelegramClient, entities: Optional[EntityStore] = None):
         """
         Инициализирует форматер.
 
         Args:
             client: Авторизованный клиент Telethon
+            entities: Справочник сущностей, из которого берутся имена известных отправителей
         """
         self.client = client
+        self.entities = entities
         self._user_cache: Dict[int, str] = {}
         self.local_tz = get_local_timezone_offset()
 
-    async def _get_sender_name(self, sender_id: int) -> str:
+    async def _get_sender_name(self, sender_id: int, sender=None) -> str:
         """
         Получает имя или никнейм отправителя сообщения.
 
         Args:
             sender_id: ID отправителя
+            sender: Отправитель, пришедший вместе с сообщением (если есть, запрос не нужен)
 
         Returns:
             str: Имя отправителя в формате "Ник (ID)" или "ID"
@@ -320,9 +486,21 @@ class MessageFormatter:
         if sender_id in self._user_cache:
             return self._user_cache[sender_id]
 
+        # Известный справочнику отправитель не требует запроса к Telegram
+        stored = self.entities.get(sender_id) if sender is None and self.entities else None
+        if stored:
+            if stored.username:
+                name = f"@{stored.username} ({sender_id})"
+            elif stored.kind == 'user' and stored.title:
+                name = f"{stored.title} ({sender_id})"
+            else:
+                name = str(sender_id)
+            self._user_cache[sender_id] = name
+            return name
+
         try:
             # Получаем информацию о пользователе
-            user = await self.client.get_entity(sender_id)
+            user = sender or await self.client.get_entity(sender_id)
 
             # Пытаемся получить никнейм
             if hasattr(user, 'username') and user.username:
@@ -381,7 +559,7 @@ class MessageFormatter:
         for msg in messages:
             # Получаем имя отправителя
             if msg.sender_id:
-                sender = await self._get_sender_name(msg.sender_id)
+                sender = await self._get_sender_name(msg.sender_id, getattr(msg, 'sender', None))
             else:
                 sender = "Система"
 
@@ -412,38 +590,74 @@ class MessageFormatter:
         }
 
 
+def create_http_client(lm_config: LMStudioConfig, concurrency: Optional[int] = None) -> httpx.AsyncClient:
+    """
+    Долгоживущий HTTP-клиент для LLM API: соединения переиспользуются между запросами
+    (keep-alive). В пакетном режиме прямые суммаризации (concurrency, по умолчанию llm_api.concurrency)
+    идут одновременно с частями длинных чатов (chunk_concurrency), поэтому пул рассчитан на их сумму
+    плюс одно соединение на получение токена.
+    HTTP/2 включается, если установлен пакет h2; по http:// (LM Studio) остаётся HTTP/1.1.
+    """
+    size = (concurrency or lm_config.concurrency) + lm_config.chunk_concurrency + 1
+    return httpx.AsyncClient(
+        timeout=lm_config.timeout_seconds,
+        http2=lm_config.http2 and h2 is not None,
+        limits=httpx.Limits(max_connections=size, max_keepalive_connections=size)
+    )
+
+
 class LMStudioSummarizer:
     """Суммаризация через LM Studio."""
 
     def __init__(self, lm_config: LMStudioConfig):
         self.lm_config = lm_config
+        self.concurrency = lm_config.concurrency
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = create_http_client(self.lm_config, self.concurrency)
+        return self._client
+
+    async def set_concurrency(self, concurrency: int):
+        """Размер пула под число одновременных запросов (например, --llm-concurrency)."""
+        if concurrency != self.concurrency:
+            self.concurrency = concurrency
+            # Пул пересоздаётся при следующем запросе уже нужного размера
+            await self.close()
+
+    async def close(self):
+        """Закрывает пул соединений."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
-    async def summarize(self, formatted_text: str) -> str:
+    async def summarize(self, formatted_text: str, instruction: str = DEFAULT_INSTRUCTION) -> str:
         if not formatted_text:
             raise ValueError("Текст сообщений пуст")
 
         try:
             logger.info("📝 Отправляю сообщения в LM Studio для суммаризации...")
-            async with httpx.AsyncClient(timeout=self.lm_config.timeout_seconds) as client:
-                url = f"{self.lm_config.base_url}/v1/chat/completions"
-                payload = {
-                    "model": self.lm_config.model,
-                    "messages": [
-                        {"role": "system", "content": (
-                            "Ты профессиональный асситент, который создает краткое резюме диалога. "
-                            "Выделяй ключевые моменты, решения и действия. "
-                            "Форматируй ответ с использованием маркированных списков. Ответ должен быть строго на русском языке."
-                        )},
-                        {"role": "user", "content": f"Создай краткое резюме:\n\n{formatted_text}"}
-                    ],
-                    "temperature": self.lm_config.temperature,
-                    "max_tokens": self.lm_config.max_tokens
-                }
-                response = await client.post(url, json=payload)
-                if response.status_code != 200:
-                    raise Exception(f"Ошибка {response.status_code}: {response.text}")
-                result = response.json()
-                return result['choices'][0]['message']['content']
+            url = f"{self.lm_config.base_url}/v1/chat/completions"
+            payload = {
+                "model": self.lm_config.model,
+                "messages": [
+                    {"role": "system", "content": (
+                        "Ты профессиональный асситент, который создает краткое резюме диалога. "
+                        "Выделяй ключевые моменты, решения и действия. "
+                        "Форматируй ответ с использованием маркированных списков. Ответ должен быть строго на русском языке."
+                    )},
+                    {"role": "user", "content": f"{instruction}\n\n{formatted_text}"}
+                ],
+                "temperature": self.lm_config.temperature,
+                "max_tokens": self.lm_config.max_tokens
+            }
+            response = await self.client.post(url, json=payload)
+            if response.status_code != 200:
+                raise Exception(f"Ошибка {response.status_code}: {response.text}")
+            result = response.json()
+            return result['choices'][0]['message']['content']
         except Exception as e:
             logger.error(f"✗ Ошибка LM Studio: {e}")
             raise
@@ -456,12 +670,89 @@ class GigaChatSummarizer:
         self.lm_config = lm_config
         self._access_token: Optional[str] = None
         self._token_expires_at: Optional[datetime] = None
+        self.concurrency = lm_config.concurrency
+        self._client: Optional[httpx.AsyncClient] = None
+        # Параллельные запросы пакетного режима не должны получать токен одновременно
+        self._token_lock = asyncio.Lock()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = create_http_client(self.lm_config, self.concurrency)
+        return self._client
+
+    async def set_concurrency(self, concurrency: int):
+        """Размер пула под число одновременных запросов (например, --llm-concurrency)."""
+        if concurrency != self.concurrency:
+            self.concurrency = concurrency
+            # Пул пересоздаётся при следующем запросе уже нужного размера
+            await self.close()
+
+    async def close(self):
+        """Закрывает пул соединений."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
-    async def _get_access_token(self, client: httpx.AsyncClient) -> str:
-        """Получает access token для GigaChat."""
-        if self._access_token and self._token_expires_at and datetime.now() < self._token_expires_at:
+    def _credentials_key(self) -> str:
+        """Хеш учётных данных: токен из кэша другого аккаунта не используется."""
+        if self.lm_config.gigachat_auth_method == "credentials":
+            creds = f"{self.lm_config.gigachat_client_id}:{self.lm_config.gigachat_secret}"
+        else:
+            creds = self.lm_config.gigachat_token
+        return hashlib.sha256(creds.encode()).hexdigest()
+
+    def _load_cached_token(self):
+        """Читает access token из token_cache, если он выдан для тех же учётных данных."""
+        path = self.lm_config.gigachat_token_cache
+        if not path or not path.exists():
+            return
+        try:
+            data = json.loads(path.read_text(encoding='utf-8'))
+            if data.get("key") != self._credentials_key():
+                return
+            self._access_token = data["access_token"]
+            self._token_expires_at = datetime.fromtimestamp(data["expires_at"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.debug(f"Не удалось прочитать кэш токена GigaChat: {e}")
+
+    def _save_cached_token(self):
+        path = self.lm_config.gigachat_token_cache
+        if not path:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Токен — секрет: файл доступен только владельцу
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "key": self._credentials_key(),
+                    "access_token": self._access_token,
+                    "expires_at": self._token_expires_at.timestamp()
+                }, f)
+        except OSError as e:
+            logger.warning(f"⚠ Не удалось сохранить токен GigaChat в {path}: {e}")
+
+    def _token_valid(self) -> bool:
+        # Запас в минуту, чтобы токен не истёк посреди запроса
+        return bool(self._access_token and self._token_expires_at
+                    and datetime.now() + timedelta(seconds=60) < self._token_expires_at)
+
+    async def _get_access_token(self) -> str:
+        """Получает access token для GigaChat (из памяти, из token_cache или у сервера)."""
+        if self._token_valid():
             return self._access_token
 
+        async with self._token_lock:
+            if self._token_valid():
+                return self._access_token
+            self._load_cached_token()
+            if self._token_valid():
+                logger.info("✓ Access token GigaChat взят из кэша")
+                return self._access_token
+            return await self._request_access_token()
+
+    async def _request_access_token(self) -> str:
         url = "https://ngw.devices.sberbank.ru/api/v2/oauth"
         headers = {
             "Content-Type": "application/x-www-form-urlencoded",
@@ -481,55 +772,191 @@ class GigaChatSummarizer:
             data = {"scope": "GIGACHAT_API_PERS"}
 
         try:
-            response = await client.post(url, headers=headers, data=data)
+            response = await self.client.post(url, headers=headers, data=data)
             if response.status_code != 200:
                 raise Exception(f"Auth failed {response.status_code}: {response.text}")
 
             auth_data = response.json()
             self._access_token = auth_data["access_token"]
-            expires_in = auth_data.get("expires_in", 3600)
-            self._token_expires_at = datetime.now() + timedelta(seconds=expires_in)
+            if "expires_at" in auth_data:
+                # GigaChat отдаёт срок действия в миллисекундах unix-времени
+                self._token_expires_at = datetime.fromtimestamp(auth_data["expires_at"] / 1000)
+            else:
+                expires_in = auth_data.get("expires_in", 3600)
+                self._token_expires_at = datetime.now() + timedelta(seconds=expires_in)
+            self._save_cached_token()
             logger.info("✓ Получен новый access token для GigaChat")
             return self._access_token
         except Exception as e:
             logger.error(f"✗ Ошибка аутентификации GigaChat: {e}")
             raise
 
-    async def summarize(self, formatted_text: str) -> str:
+    async def summarize(self, formatted_text: str, instruction: str = DEFAULT_INSTRUCTION) -> str:
         if not formatted_text:
             raise ValueError("Текст сообщений пуст")
 
         try:
             logger.info("📝 Отправляю сообщения в GigaChat для суммаризации...")
-            async with httpx.AsyncClient(timeout=self.lm_config.timeout_seconds) as client:
-                token = await self._get_access_token(client)
-                url = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {token}"
-                }
-                payload = {
-                    "model": self.lm_config.model,
-                    "messages": [
-                        {"role": "system", "content": (
-                            "Ты профессиональный ассистент. Создай краткое резюме диалога. "
-                            "Выдели ключевые моменты, решения, действия. Используй маркированные списки."
-                        )},
-                        {"role": "user", "content": f"Создай краткое резюме:\n\n{formatted_text}"}
-                    ],
-                    "temperature": self.lm_config.temperature,
-                    "max_tokens": self.lm_config.max_tokens
-                }
-                response = await client.post(url, json=payload, headers=headers)
-                if response.status_code != 200:
-                    raise Exception(f"Ошибка {response.status_code}: {response.text}")
-                result = response.json()
-                return result['choices'][0]['message']['content']
+            token = await self._get_access_token()
+            url = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {token}"
+            }
+            payload = {
+                "model": self.lm_config.model,
+                "messages": [
+                    {"role": "system", "content": (
+                        "Ты профессиональный ассистент. Создай краткое резюме диалога. "
+                        "Выдели ключевые моменты, решения, действия. Используй маркированные списки."
+                    )},
+                    {"role": "user", "content": f"{instruction}\n\n{formatted_text}"}
+                ],
+                "temperature": self.lm_config.temperature,
+                "max_tokens": self.lm_config.max_tokens
+            }
+            response = await self.client.post(url, json=payload, headers=headers)
+            if response.status_code == 401:
+                # Токен отозван или истёк раньше срока — получаем новый и повторяем запрос.
+                # Параллельные запросы получают 401 разом: новый токен запрашивает первый,
+                # остальные под блокировкой видят, что токен уже сменился
+                async with self._token_lock:
+                    if self._access_token in (token, None):
+                        self._access_token = None
+                        token = await self._request_access_token()
+                    else:
+                        token = self._access_token
+                headers["Authorization"] = f"Bearer {token}"
+                response = await self.client.post(url, json=payload, headers=headers)
+            if response.status_code != 200:
+                raise Exception(f"Ошибка {response.status_code}: {response.text}")
+            result = response.json()
+            return result['choices'][0]['message']['content']
         except Exception as e:
             logger.error(f"✗ Ошибка GigaChat: {e}")
             raise
 
 
+def estimate_tokens(text: str, chars_per_token: float = DEFAULT_CHARS_PER_TOKEN) -> int:
+    """Оценка числа токенов по длине текста (без токенизатора модели)."""
+    return math.ceil(len(text) / chars_per_token)
+
+
+def _split_long(text: str, max_chars: int) -> List[str]:
+    """Делит слишком длинное сообщение на куски не длиннее max_chars, по возможности по пробелам."""
+    pieces = []
+    start = 0
+    while start < len(text):
+        end = start + max_chars
+        if end < len(text):
+            cut = max(text.rfind(' ', start, end), text.rfind('\n', start, end))
+            if cut > start:
+                end = cut
+        piece = text[start:end].strip()
+        if piece:
+            pieces.append(piece)
+        start = end
+    return pieces
+
+
+def _pack(parts: List[str], max_chars: int, separator: str) -> List[str]:
+    """Жадно собирает части подряд в группы не длиннее max_chars (часть длиннее лимита — отдельная группа)."""
+    groups: List[str] = []
+    current: List[str] = []
+    size = 0
+    for part in parts:
+        extra = len(part) + (len(separator) if current else 0)
+        if current and size + extra > max_chars:
+            groups.append(separator.join(current))
+            current, size, extra = [], 0, len(part)
+        current.append(part)
+        size += extra
+    if current:
+        groups.append(separator.join(current))
+    return groups
+
+
+def split_transcript(
+        text: str,
+        max_tokens: int,
+        chars_per_token: float = DEFAULT_CHARS_PER_TOKEN
+) -> List[str]:
+    """
+    Делит переписку из format_for_llm на части не больше max_tokens по границам сообщений.
+
+    Args:
+        text: Отформатированная переписка
+        max_tokens: Максимальный размер части в токенах
+        chars_per_token: Оценка числа символов на токен
+
+    Returns:
+        List[str]: Части переписки в исходном порядке
+    """
+    max_chars = max(1, int(max_tokens * chars_per_token))
+    messages = []
+    for message in _MESSAGE_START.split(text):
+        # Сообщение длиннее части делится по словам
+        messages.extend([message] if len(message) <= max_chars else _split_long(message, max_chars))
+    return _pack(messages, max_chars, "\n")
+
+
+class MapReduceSummarizer:
+    """
+    Суммаризация длинной переписки по частям поверх LMStudioSummarizer / GigaChatSummarizer.
+
+    Переписка, которая не помещается в llm_api.chunk_tokens, делится по границам сообщений;
+    части суммаризируются параллельно (не больше llm_api.chunk_concurrency запросов одновременно),
+    затем частичные резюме сливаются в одно. Если и они не помещаются в один запрос,
+    слияние идёт в несколько уровней.
+    """
+
+    def __init__(self, summarizer, lm_config: LMStudioConfig):
+        self.summarizer = summarizer
+        self.lm_config = lm_config
+        self._semaphore = asyncio.Semaphore(lm_config.chunk_concurrency)
+
+    async def set_concurrency(self, concurrency: int):
+        await self.summarizer.set_concurrency(concurrency)
+
+    async def close(self):
+        """Закрывает пул соединений summarizer."""
+        await self.summarizer.close()
+
+    async def _call(self, text: str, instruction: str) -> str:
+        async with self._semaphore:
+            return await self.summarizer.summarize(text, instruction)
+
+    async def summarize(self, formatted_text: str, instruction: str = DEFAULT_INSTRUCTION) -> str:
+        limit = self.lm_config.chunk_tokens
+        tokens = estimate_tokens(formatted_text, self.lm_config.chars_per_token)
+        if limit <= 0 or tokens <= limit:
+            return await self.summarizer.summarize(formatted_text, instruction)
+
+        chunks = split_transcript(formatted_text, limit, self.lm_config.chars_per_token)
+        logger.info(f"🧩 Переписка ~{tokens} токенов — суммаризирую по частям: {len(chunks)}")
+        partials = await asyncio.gather(*(
+            self._call(chunk, MAP_INSTRUCTION.format(part=i, total=len(chunks)))
+            for i, chunk in enumerate(chunks, 1)
+        ))
+        return await self._reduce(list(partials), depth=1)
+
+    async def _reduce(self, partials: List[str], depth: int) -> str:
+        """Сливает частичные резюме; если они не помещаются в один запрос — сначала группами."""
+        texts = [f"Часть {i}:\n{p}" for i, p in enumerate(partials, 1)]
+        max_chars = int(self.lm_config.chunk_tokens * self.lm_config.chars_per_token)
+        groups = _pack(texts, max_chars, "\n\n")
+        if len(groups) == 1:
+            return await self._call(groups[0], REDUCE_INSTRUCTION)
+        if len(groups) == len(texts):
+            # Каждое резюме занимает больше половины части — сливаем попарно: так каждый уровень
+            # хотя бы вдвое сокращает число резюме и рекурсия гарантированно сходится
+            groups = ["\n\n".join(texts[i:i + 2]) for i in range(0, len(texts), 2)]
+
+        logger.info(f"🧩 Слияние резюме, уровень {depth}: {len(partials)} → {len(groups)}")
+        merged = await asyncio.gather(*(self._call(group, REDUCE_INSTRUCTION) for group in groups))
+        return await self._reduce(list(merged), depth + 1)
+
+
 class TgSummariseChat:
     """Главный класс модуля для суммаризации чатов Telegram."""
 
@@ -551,6 +978,8 @@ class TgSummariseChat:
             self.summarizer = LMStudioSummarizer(self.lm_config)
         elif self.lm_config.llm_type == 'gigachat':
             self.summarizer = GigaChatSummarizer(self.lm_config)
+        # Длинные переписки суммаризируются по частям
+        self.summarizer = MapReduceSummarizer(self.summarizer, self.lm_config)
 
     async def summarize_chat_today(
             self,
@@ -566,37 +995,153 @@ class TgSummariseChat:
             dict: Результат с суммаризацией и статистикой
         """
         try:
-            messages, chat_name = await self.extractor.get_today_messages(chat_identifier)
-            if not messages:
-                logger.warning(f"⚠ В чате '{chat_name}' нет сообщений за сегодня")
-                return {
-                    "chat_name": chat_name,
-                    "total_messages": 0,
-                    "summary": "Нет сообщений для суммаризации",
-                    "statistics": {}
-                }
-
-            self.message_formatter = MessageFormatter(self.extractor.client)
-            formatted_text = await self.message_formatter.format_for_llm(messages)
-            stats = self.message_formatter.get_statistics(messages)
-            summary = await self.summarizer.summarize(formatted_text)
-
-            result = {
-                "chat_name": chat_name,
-                "total_messages": stats['total_messages'],
-                "summary": summary,
-                "statistics": stats
-            }
+            result, formatted_text = await self._prepare_chat(chat_identifier)
+            if formatted_text is None:
+                return result
 
-            logger.info(f"✓ Результат готов для чата '{chat_name}'")
+            result["summary"] = await self.summarizer.summarize(formatted_text)
+            logger.info(f"✓ Результат готов для чата '{result['chat_name']}'")
             return result
 
         except Exception as e:
             logger.error(f"✗ Ошибка при обработке чата: {e}")
             raise
 
+    async def _prepare_chat(self, chat_identifier) -> tuple:
+        """
+        Загружает сообщения чата за текущий день и готовит текст для LLM.
+
+        Returns:
+            tuple: (Результат без суммаризации, Текст для LLM или None, если сообщений нет)
+        """
+        messages, chat_name = await self.extractor.get_today_messages(chat_identifier)
+        if not messages:
+            logger.warning(f"⚠ В чате '{chat_name}' нет сообщений за сегодня")
+            return {
+                "chat_name": chat_name,
+                "total_messages": 0,
+                "summary": "Нет сообщений для суммаризации",
+                "statistics": {}
+            }, None
+
+        # Один форматер на все чаты: имена отправителей из общих чатов не запрашиваются повторно
+        if self.message_formatter is None:
+            self.message_formatter = MessageFormatter(self.extractor.client, self.extractor.entities)
+        formatted_text = await self.message_formatter.format_for_llm(messages)
+        stats = self.message_formatter.get_statistics(messages)
+        return {
+            "chat_name": chat_name,
+            "total_messages": stats['total_messages'],
+            "summary": None,
+            "statistics": stats
+        }, formatted_text
+
+    async def summarize_chats_today(
+            self,
+            chat_identifiers: list,
+            output_path: Optional[str] = None,
+            telegram_concurrency: int = DEFAULT_TELEGRAM_CONCURRENCY,
+            llm_concurrency: Optional[int] = None
+    ) -> List[dict]:
+        """
+        Суммаризирует несколько чатов за одно подключение к Telegram.
+
+        Сообщения следующих чатов загружаются, пока LLM занята текущими: загрузка и суммаризация
+        идут в отдельных воркерах со своими ограничениями параллельности. Каждый результат
+        дописывается строкой JSON Lines в output_path (или в stdout), как только готов.
+        Ошибка в одном чате не останавливает остальные — она попадает в поле "error".
+
+        Args:
+            chat_identifiers: Имена, username, ID чатов или InputPeer
+            output_path: Файл JSON Lines; None — stdout
+            telegram_concurrency: Сколько чатов загружать одновременно
+            llm_concurrency: Сколько запросов к LLM выполнять одновременно (по умолчанию llm_api.concurrency)
+
+        Returns:
+            List[dict]: Результаты в порядке chat_identifiers
+        """
+        # Как и для Telegram, хотя бы один обработчик: иначе все результаты молча остались бы None
+        llm_concurrency = max(1, llm_concurrency if llm_concurrency is not None else self.lm_config.concurrency)
+        await self.summarizer.set_concurrency(llm_concurrency)
+        await self.extractor._connect()
+
+        pending: asyncio.Queue = asyncio.Queue()
+        for item in enumerate(chat_identifiers):
+            pending.put_nowait(item)
+        # Очередь к LLM ограничена, чтобы не держать в памяти переписку всех чатов сразу
+        ready: asyncio.Queue = asyncio.Queue(maxsize=llm_concurrency * 2)
+        results: List[Optional[dict]] = [None] * len(chat_identifiers)
+        out = open(output_path, 'w', encoding='utf-8') if output_path else sys.stdout
+
+        def finish(index: int, chat_identifier, result: dict):
+            result = {"chat": _chat_key(chat_identifier), **result}
+            results[index] = result
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+
+        async def fetch_worker():
+            while not pending.empty():
+                index, chat_identifier = pending.get_nowait()
+                try:
+                    result, formatted_text = await self._prepare_chat(chat_identifier)
+                except Exception as e:
+                    logger.error(f"✗ Ошибка при загрузке чата '{_chat_key(chat_identifier)}': {e}")
+                    finish(index, chat_identifier, {"chat_name": None, "total_messages": 0, "summary": None,
+                                                    "statistics": {}, "error": str(e)})
+                    continue
+                if formatted_text is None:
+                    finish(index, chat_identifier, result)
+                else:
+                    await ready.put((index, chat_identifier, result, formatted_text))
+
+        async def llm_worker():
+            while True:
+                item = await ready.get()
+                if item is None:
+                    return
+                index, chat_identifier, result, formatted_text = item
+                try:
+                    result["summary"] = await self.summarizer.summarize(formatted_text)
+                    logger.info(f"✓ Результат готов для чата '{result['chat_name']}'")
+                except Exception as e:
+                    logger.error(f"✗ Ошибка суммаризации чата '{result['chat_name']}': {e}")
+                    result["error"] = str(e)
+                finish(index, chat_identifier, result)
+
+        fetchers = [asyncio.create_task(fetch_worker()) for _ in range(max(1, telegram_concurrency))]
+        summarizers = [asyncio.create_task(llm_worker()) for _ in range(llm_concurrency)]
+        try:
+            await asyncio.gather(*fetchers)
+            for _ in summarizers:
+                await ready.put(None)
+            await asyncio.gather(*summarizers)
+        finally:
+            for task in fetchers + summarizers:
+                task.cancel()
+            if output_path:
+                out.close()
+
+        failed = sum(1 for r in results if r and r.get("error"))
+        logger.info(f"✓ Обработано чатов: {len(results)} (с ошибкой: {failed})")
+        return results
+
+    async def summarize_folder_today(self, folder_name: str, **kwargs) -> List[dict]:
+        """
+        Суммаризирует все чаты папки Telegram (см. summarize_chats_today).
+
+        Args:
+            folder_name: Название папки
+            **kwargs: Параметры summarize_chats_today
+
+        Returns:
+            List[dict]: Результаты по чатам папки
+        """
+        peers = await self.extractor.get_folder_peers(folder_name)
+        return await self.summarize_chats_today(peers, **kwargs)
+
     async def close(self):
         """Закрывает все соединения."""
+        await self.summarizer.close()
         await self.extractor.disconnect()
         logger.info("✓ Модуль завершил работу")
 
@@ -619,6 +1164,12 @@ Examples:
 
   # С пользовательским конфигом
   python -m tg_summarise_chat --chat-name "my_chat" --config /path/to/config.yaml
+
+  # Несколько чатов за один запуск, результаты в JSON Lines
+  python -m tg_summarise_chat --chats "my_chat" "@username" -1001234567890 --output summaries.jsonl
+
+  # Все чаты папки Telegram
+  python -m tg_summarise_chat --folder "Работа" --tg-concurrency 4 --llm-concurrency 2
         """
     )
 
@@ -633,6 +1184,16 @@ Examples:
         type=int,
         help='ID чата Telegram (например: -1001234567890)'
     )
+    group.add_argument(
+        '--chats',
+        nargs='+',
+        help='Несколько чатов (имена, username или ID) — пакетный режим'
+    )
+    group.add_argument(
+        '--folder',
+        type=str,
+        help='Название папки Telegram, все чаты которой нужно суммаризировать — пакетный режим'
+    )
 
     parser.add_argument(
         '--config',
@@ -640,6 +1201,22 @@ Examples:
         default='config.yaml',
         help='Путь к файлу конфигурации (по умолчанию: config.yaml)'
     )
+    parser.add_argument(
+        '--output',
+        type=str,
+        help='Файл JSON Lines для результатов пакетного режима (по умолчанию: stdout)'
+    )
+    parser.add_argument(
+        '--tg-concurrency',
+        type=int,
+        default=DEFAULT_TELEGRAM_CONCURRENCY,
+        help=f'Сколько чатов загружать из Telegram одновременно (по умолчанию: {DEFAULT_TELEGRAM_CONCURRENCY})'
+    )
+    parser.add_argument(
+        '--llm-concurrency',
+        type=int,
+        help='Сколько запросов к LLM выполнять одновременно (по умолчанию: llm_api.concurrency)'
+    )
 
     return parser
 
@@ -675,9 +1252,21 @@ async def main():
         tg_summarise = TgSummariseChat(config_path=args.config)
 
         try:
-            chat_identifier = args.chat_name if args.chat_name else args.chat_id
-            result = await tg_summarise.summarize_chat_today(chat_identifier)
-            print_result(result)
+            batch = {
+                'output_path': args.output,
+                'telegram_concurrency': args.tg_concurrency,
+                'llm_concurrency': args.llm_concurrency
+            }
+            if args.folder:
+                await tg_summarise.summarize_folder_today(args.folder, **batch)
+            elif args.chats:
+                # Числа в списке — ID чатов
+                chats = [int(c) if c.lstrip('-').isdigit() else c for c in args.chats]
+                await tg_summarise.summarize_chats_today(chats, **batch)
+            else:
+                chat_identifier = args.chat_name if args.chat_name else args.chat_id
+                result = await tg_summarise.summarize_chat_today(chat_identifier)
+                print_result(result)
 
         finally:
             await tg_summarise.close()
@@ -692,6 +1281,4 @@ async def main():
 
 
 if __name__ == '__main__':
-    import asyncio
-
     asyncio.run(main())
\ No newline at end of file